@@ -0,0 +1,76 @@
+# Copyright 2022 EMBL - European Bioinformatics Institute
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Compare the in-process record counter with the "zcat | grep -v ^# | wc -l" pipeline it replaces.
+# Usage (with the package installed or on the PYTHONPATH):
+#   python benchmarks/benchmark_count_records.py [--vcf-file file.vcf.gz ...] [--num-records 2000000]
+
+import argparse
+import os
+import subprocess
+import tempfile
+import time
+
+from covid19dp_submission.bgzf import BgzfWriter
+from covid19dp_submission.vcf_reader import count_records
+
+
+def write_synthetic_vcf(vcf_file, num_records):
+    with BgzfWriter(vcf_file) as writer:
+        writer.write(b'##fileformat=VCFv4.1\n##contig=<ID=MN908947.3>\n'
+                     b'#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tSAMPLE\n')
+        for pos in range(1, num_records + 1):
+            writer.write(f'MN908947.3\t{pos % 29903 + 1}\t.\tA\tG\t.\tPASS\tDP=12\tGT\t1\n'.encode())
+
+
+def time_call(function, repeats):
+    durations = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        result = function()
+        durations.append(time.perf_counter() - start_time)
+    return result, min(durations)
+
+
+def benchmark(vcf_file, repeats):
+    shell_count, shell_duration = time_call(lambda: int(subprocess.check_output(
+        f"zcat {vcf_file} | grep -v ^# | wc -l", shell=True)), repeats)
+    print(f'{os.path.basename(vcf_file)} ({os.path.getsize(vcf_file) / 1e6:.1f}MB)')
+    print(f'  zcat | grep | wc     {shell_duration:8.3f}s  {shell_count} records')
+    for num_threads in (1, 2, 4, 8):
+        count, duration = time_call(lambda: count_records(vcf_file, num_threads), repeats)
+        assert count == shell_count, f'{count} records counted instead of {shell_count}'
+        print(f'  count_records x{num_threads:<3}  {duration:8.3f}s  speedup {shell_duration / duration:.2f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the record counter against the shell pipeline')
+    parser.add_argument("--vcf-file", help="VCF files to count (a synthetic BGZF VCF is generated if not provided)",
+                        nargs='+', required=False)
+    parser.add_argument("--num-records", help="Number of records in the synthetic VCF", type=int, default=2000000)
+    parser.add_argument("--repeats", help="Number of runs of each method, the fastest is reported", type=int,
+                        default=3)
+    args = parser.parse_args()
+    if args.vcf_file:
+        for vcf_file in args.vcf_file:
+            benchmark(vcf_file, args.repeats)
+        return
+    with tempfile.TemporaryDirectory() as temp_dir:
+        vcf_file = os.path.join(temp_dir, 'synthetic.vcf.gz')
+        write_synthetic_vcf(vcf_file, args.num_records)
+        benchmark(vcf_file, args.repeats)
+
+
+if __name__ == "__main__":
+    main()
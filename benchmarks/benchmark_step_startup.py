@@ -0,0 +1,133 @@
+# Copyright 2022 EMBL - European Bioinformatics Institute
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Measure the cold start of each step module as the Nextflow processes run it, with the step package on the
+# PYTHONPATH: the wall time of an interpreter importing the module and, from "python -X importtime", the time spent
+# importing the module and the packages it imports. Interpreter startup (site) is not counted in the import time.
+# With --baseline, exit with an error when a step imports a package it did not import in the baseline or takes longer
+# to import than the baseline plus the tolerance, and with --save-baseline, record the current measures.
+# Usage (from the root of the repository):
+#   python benchmarks/benchmark_step_startup.py [--repeats 5] [--save-baseline startup.json | --baseline startup.json]
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT_PATH = os.path.join(ROOT_DIR, 'covid19dp_submission')
+# Packages that none of the steps should import when they start
+FORBIDDEN_PACKAGES = ['ebi_eva_common_pyutils', 'more_itertools', 'networkx', 'numpy', 'requests', 'yaml']
+
+
+def get_step_modules():
+    step_modules = []
+    for dir_path, _, file_names in os.walk(os.path.join(SCRIPT_PATH, 'steps')):
+        package = os.path.relpath(dir_path, SCRIPT_PATH).replace(os.sep, '.')
+        step_modules.extend(f'{package}.{file_name[:-3]}' for file_name in file_names
+                            if file_name.endswith('.py') and file_name != '__init__.py')
+    return sorted(step_modules)
+
+
+def run_with_import_time(args):
+    """
+    Run the interpreter as the Nextflow processes do and return its exit code and the cumulative time spent importing
+    each module after the interpreter startup (site), in microseconds, from the output of python -X importtime.
+    """
+    env = {**os.environ, 'PYTHONPATH': os.pathsep.join([SCRIPT_PATH, ROOT_DIR])}
+    process = subprocess.run([sys.executable, '-X', 'importtime'] + args, env=env, cwd=ROOT_DIR,
+                             stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    import_times = {}
+    after_site = False
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        _, cumulative_us, name = line[len('import time:'):].split('|')
+        if name.strip() == 'site' and not name.startswith('  '):
+            after_site = True
+            continue
+        if after_site:
+            import_times[name.strip()] = int(cumulative_us)
+    return process.returncode, import_times
+
+
+def get_imported_packages(import_times: dict) -> list:
+    return sorted({name.split('.')[0] for name in import_times})
+
+
+def measure_step_startup(module, repeats):
+    import_times, wall_times = [], []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        returncode, module_import_times = run_with_import_time(['-c', f'import {module}'])
+        wall_times.append(time.perf_counter() - start_time)
+        if returncode != 0:
+            raise RuntimeError(f'Importing {module} failed with exit code {returncode}')
+        import_times.append(module_import_times[module])
+        imported_packages = get_imported_packages(module_import_times)
+    # The minimum is the least affected by the other processes of the machine
+    return {'import_ms': min(import_times) / 1000, 'wall_ms': min(wall_times) * 1000,
+            'imported_packages': imported_packages}
+
+
+def compare_with_baseline(measures, baseline, tolerance, slack_ms):
+    regressions = []
+    for module, measure in measures.items():
+        if module not in baseline:
+            continue
+        new_packages = set(measure['imported_packages']) - set(baseline[module]['imported_packages'])
+        if new_packages:
+            regressions.append(f'{module} now imports {", ".join(sorted(new_packages))}')
+        max_import_ms = baseline[module]['import_ms'] * (1 + tolerance) + slack_ms
+        if measure['import_ms'] > max_import_ms:
+            regressions.append(f'{module} takes {measure["import_ms"]:.1f}ms to import, more than '
+                               f'{max_import_ms:.1f}ms')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the cold start of the step modules')
+    parser.add_argument("--repeats", help="Number of times each module is imported", type=int, default=5)
+    parser.add_argument("--baseline", help="JSON file of measures to compare with", required=False)
+    parser.add_argument("--save-baseline", help="JSON file to write the measures to", required=False)
+    parser.add_argument("--tolerance", help="Fraction of the baseline import time allowed on top of it", type=float,
+                        default=0.5)
+    parser.add_argument("--slack-ms", help="Milliseconds allowed on top of the baseline import time", type=float,
+                        default=10)
+    args = parser.parse_args()
+    measures = {}
+    failures = []
+    for module in get_step_modules():
+        measures[module] = measure_step_startup(module, args.repeats)
+        print(f'{module:60} import {measures[module]["import_ms"]:7.1f}ms  '
+              f'cold start {measures[module]["wall_ms"]:7.1f}ms')
+        forbidden_packages = set(measures[module]['imported_packages']).intersection(FORBIDDEN_PACKAGES)
+        if forbidden_packages:
+            failures.append(f'{module} imports {", ".join(sorted(forbidden_packages))} when it starts')
+    if args.baseline:
+        with open(args.baseline) as open_file:
+            failures.extend(compare_with_baseline(measures, json.load(open_file), args.tolerance, args.slack_ms))
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as open_file:
+            json.dump(measures, open_file, indent=2, sort_keys=True)
+    for failure in failures:
+        print(f'REGRESSION: {failure}')
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
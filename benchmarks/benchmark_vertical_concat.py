@@ -0,0 +1,97 @@
+# Copyright 2022 EMBL - European Bioinformatics Institute
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Compare the native concatenation engine with the tree of "bcftools concat" processes it can replace, on small
+# SARS-CoV-2 like VCF files. The bcftools tree is run with the dynamic scheduler, which does not need Nextflow, and
+# is skipped when bcftools is not in the PATH.
+# Usage (with the package installed or on the PYTHONPATH):
+#   python benchmarks/benchmark_vertical_concat.py [--num-files 2000] [--records-per-file 30]
+
+import argparse
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+
+from covid19dp_submission.bgzf import BgzfWriter
+from covid19dp_submission.steps.vcf_vertical_concat.dynamic_scheduler import DynamicConcatScheduler
+from covid19dp_submission.steps.vcf_vertical_concat.native_concat import native_vcf_concat
+from covid19dp_submission.vcf_reader import iter_data_lines
+
+HEADER = '##fileformat=VCFv4.1\n##contig=<ID=MN908947.3>\n' \
+         '##INFO=<ID=DP,Number=1,Type=Integer,Description="Raw Depth">\n' \
+         '##INFO=<ID=AF,Number=1,Type=Float,Description="Allele Frequency">\n' \
+         '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n'
+
+
+def write_synthetic_vcfs(vcf_dir, num_files, records_per_file):
+    # Positions are drawn from a small set so that many records are duplicated across files like in real snapshots
+    random_generator = random.Random(42)
+    vcf_files = []
+    for file_index in range(num_files):
+        vcf_file = os.path.join(vcf_dir, f'sample{file_index:06}.vcf.gz')
+        positions = sorted(random_generator.sample(range(1, 29904, 10), records_per_file))
+        with BgzfWriter(vcf_file) as writer:
+            writer.write(HEADER.encode())
+            for pos in positions:
+                alt = 'GCT'[pos % 3]
+                writer.write(f'MN908947.3\t{pos}\t.\tA\t{alt}\t{pos % 5000}\tPASS\tDP={pos % 900};'
+                             f'AF={(pos % 997) / 997:.6f}\n'.encode())
+        vcf_files.append(vcf_file)
+    return vcf_files
+
+
+def bcftools_tree_concat(vcf_files, processing_dir, result_file, concat_chunk_size, num_workers):
+    for vcf_file in vcf_files:
+        subprocess.run(['bcftools', 'index', '--csi', vcf_file], check=True)
+    DynamicConcatScheduler(processing_dir, concat_chunk_size, 'bcftools', num_workers).run(vcf_files, result_file)
+
+
+def time_call(function):
+    start_time = time.perf_counter()
+    function()
+    return time.perf_counter() - start_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the native concatenation engine against bcftools')
+    parser.add_argument("--num-files", help="Number of synthetic VCF files", type=int, default=2000)
+    parser.add_argument("--records-per-file", help="Number of records in each file", type=int, default=30)
+    parser.add_argument("--concat-chunk-size", help="Files concatenated by each bcftools process", type=int,
+                        default=100)
+    parser.add_argument("--num-workers", help="bcftools processes running at the same time", type=int, default=4)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as temp_dir:
+        vcf_files = write_synthetic_vcfs(temp_dir, args.num_files, args.records_per_file)
+        print(f'{args.num_files} files of {args.records_per_file} records')
+        native_result_file = os.path.join(temp_dir, 'native', 'result.vcf.gz')
+        native_duration = time_call(lambda: native_vcf_concat(vcf_files, native_result_file))
+        print(f'  native               {native_duration:8.3f}s')
+        if shutil.which('bcftools') is None:
+            print('  bcftools not found in the PATH, skipping the bcftools tree')
+            return
+        bcftools_result_file = os.path.join(temp_dir, 'bcftools', 'result.vcf.gz')
+        bcftools_duration = time_call(lambda: bcftools_tree_concat(
+            vcf_files, os.path.join(temp_dir, 'bcftools'), bcftools_result_file, args.concat_chunk_size,
+            args.num_workers))
+        print(f'  bcftools tree x{args.num_workers:<3}   {bcftools_duration:8.3f}s  '
+              f'native speedup {bcftools_duration / native_duration:.2f}')
+        assert list(iter_data_lines(native_result_file)) == list(iter_data_lines(bcftools_result_file)), \
+            'The native and bcftools outputs differ'
+
+
+if __name__ == "__main__":
+    main()
@@ -30,6 +30,9 @@ def main():
                         help="full path to the file containing all the processed analyses")
     parser.add_argument("--ignored-analyses-file", required=True,
                         help="full path to the file containing a list of analyses to skip when processing.")
+    parser.add_argument("--analysis-registry-db", required=False, default=None,
+                        help="full path to a SQLite analysis registry used instead of the processed and ignored "
+                             "analyses files. It is populated from these files when it is first created.")
     parser.add_argument("--accepted-taxonomies", required=True, nargs='+', type=int,
                         help="taxonomy id of the data that should be downloaded from ENA. "
                              "The first on in this list will be used to annotate the variant")
@@ -49,7 +52,7 @@ def main():
     ingest_covid19dp_submission(args.project, args.project_dir, args.num_analyses,
                                 args.processed_analyses_file, args.ignored_analyses_file, args.accepted_taxonomies,
                                 args.assembly, args.app_config_file, args.nextflow_config_file,
-                                args.resume_snapshot)
+                                args.resume_snapshot, args.analysis_registry_db)
 
 
 if __name__ == "__main__":
@@ -1,10 +1,17 @@
 import os
-import covid19dp_submission
 
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
 
-ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))  # This is your Project Root
+ROOT_DIR = os.path.dirname(PACKAGE_DIR)  # This is your Project Root
 
-NEXTFLOW_DIR = os.path.join(os.path.dirname(os.path.abspath(covid19dp_submission.__file__)), 'nextflow')
+NEXTFLOW_DIR = os.path.join(PACKAGE_DIR, 'nextflow')
 
-__version__ = open(os.path.join(os.path.dirname(os.path.abspath(covid19dp_submission.__file__)),
-                                'VERSION')).read().strip()
+
+def __getattr__(name):
+    # The version is read when it is first asked for rather than by every step importing the package
+    if name == '__version__':
+        with open(os.path.join(PACKAGE_DIR, 'VERSION')) as open_file:
+            version = open_file.read().strip()
+        globals()['__version__'] = version
+        return version
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
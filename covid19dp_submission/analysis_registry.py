@@ -0,0 +1,305 @@
+# Copyright 2022 EMBL - European Bioinformatics Institute
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import json
+import os
+import sqlite3
+from abc import ABC, abstractmethod
+from datetime import datetime
+
+from ebi_eva_common_pyutils.logger import logging_config
+from more_itertools import chunked
+
+logger = logging_config.get_logger(__name__)
+
+PROCESSED = 'processed'
+IGNORED = 'ignored'
+# Key of the metadata row recording that the CSV files were completely imported in the SQLite registry
+CSV_IMPORTED_KEY = 'csv_imported'
+
+
+class AnalysisRegistry(ABC):
+    """
+    Keep track of the analyses that have already been processed or that should be ignored in future ingestions.
+    """
+
+    @abstractmethod
+    def get_known_analyses(self, analysis_accessions) -> set:
+        """
+        Return the subset of analysis_accessions that have already been processed or ignored.
+        """
+
+    def add_processed_analyses(self, analyses_array):
+        self._add_analyses(analyses_array, PROCESSED)
+
+    def add_ignored_analyses(self, analyses_array):
+        self._add_analyses(analyses_array, IGNORED)
+
+    @abstractmethod
+    def _add_analyses(self, analyses_array, status):
+        pass
+
+    @abstractmethod
+    def get_watermark(self, project) -> dict or None:
+        """
+        Return the watermark recorded for the project as a dict with the latest first_public date seen
+        ('watermark') and the time of the last full reconciliation sweep ('last_full_sweep').
+        """
+
+    @abstractmethod
+    def set_watermark(self, project, watermark, full_sweep_started=None):
+        """
+        Record the watermark of the project and, when it results from a full sweep, the time that sweep started.
+        """
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class CsvAnalysisRegistry(AnalysisRegistry):
+    """
+    Registry stored in the processed and ignored CSV files containing one "accession,ftp_path" per line.
+    The files are only read once and new analyses are appended to them.
+    """
+
+    def __init__(self, processed_analyses_file, ignored_analysis_file=None):
+        self.analyses_files = {PROCESSED: processed_analyses_file, IGNORED: ignored_analysis_file}
+        self.watermark_file = f'{processed_analyses_file}.watermarks.json'
+        self._known_analyses = None
+
+    @property
+    def known_analyses(self):
+        if self._known_analyses is None:
+            self._known_analyses = {}
+            for status, analyses_file in self.analyses_files.items():
+                for accession, _ in read_analyses_file(analyses_file):
+                    self._known_analyses.setdefault(accession, status)
+        return self._known_analyses
+
+    def get_known_analyses(self, analysis_accessions) -> set:
+        return set(analysis_accessions).intersection(self.known_analyses)
+
+    def _add_analyses(self, analyses_array, status):
+        analyses_file = self.analyses_files[status]
+        if not analyses_file:
+            raise ValueError(f'No file provided to record {status} analyses')
+        with open(analyses_file, 'a') as open_file:
+            for analysis in analyses_array:
+                accession = analysis['analysis_accession']
+                # Processed analyses are always recorded while ignored ones are only recorded once
+                if status == IGNORED and accession in self.known_analyses:
+                    continue
+                open_file.write(f"{accession},{analysis['submitted_ftp']}\n")
+                if self._known_analyses is not None:
+                    self._known_analyses.setdefault(accession, status)
+
+    def _load_watermarks(self):
+        if os.path.isfile(self.watermark_file):
+            with open(self.watermark_file) as open_file:
+                return json.load(open_file)
+        return {}
+
+    def get_watermark(self, project):
+        return self._load_watermarks().get(project)
+
+    def set_watermark(self, project, watermark, full_sweep_started=None):
+        watermarks = self._load_watermarks()
+        project_watermark = watermarks.get(project, {'last_full_sweep': None})
+        project_watermark['watermark'] = watermark
+        if full_sweep_started:
+            project_watermark['last_full_sweep'] = full_sweep_started
+        watermarks[project] = project_watermark
+        # Write to a temporary file first so the watermarks are never left half written
+        with open(self.watermark_file + '.tmp', 'w') as open_file:
+            json.dump(watermarks, open_file)
+        os.replace(self.watermark_file + '.tmp', self.watermark_file)
+
+
+class SqliteAnalysisRegistry(AnalysisRegistry):
+    """
+    Registry stored in an indexed SQLite database in WAL mode. Each analysis is recorded with the snapshot that
+    processed or ignored it.
+    """
+    # Stay below the maximum number of host parameters of older SQLite versions
+    query_chunk_size = 500
+
+    def __init__(self, registry_db, snapshot_name=None):
+        self.registry_db = registry_db
+        self.snapshot_name = snapshot_name
+        self.connection = sqlite3.connect(registry_db)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS analysis ('
+                'analysis_accession TEXT PRIMARY KEY, '
+                'submitted_ftp TEXT, '
+                'status TEXT NOT NULL, '
+                'snapshot TEXT, '
+                'recorded_at TEXT NOT NULL'
+                ') WITHOUT ROWID'
+            )
+            self.connection.execute('CREATE INDEX IF NOT EXISTS analysis_snapshot ON analysis (snapshot)')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS watermark ('
+                'project TEXT PRIMARY KEY, '
+                'watermark TEXT, '
+                'last_full_sweep TEXT'
+                ')'
+            )
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS registry_metadata ('
+                'key TEXT PRIMARY KEY, '
+                'value TEXT'
+                ')'
+            )
+
+    def get_known_analyses(self, analysis_accessions) -> set:
+        known_analyses = set()
+        for accessions in chunked(analysis_accessions, self.query_chunk_size):
+            cursor = self.connection.execute(
+                f'SELECT analysis_accession FROM analysis '
+                f'WHERE analysis_accession IN ({",".join("?" * len(accessions))})',
+                accessions
+            )
+            known_analyses.update(accession for accession, in cursor)
+        return known_analyses
+
+    def _add_analyses(self, analyses_array, status):
+        with self.connection:
+            self._insert_analyses(analyses_array, status, self.snapshot_name)
+
+    def _insert_analyses(self, analyses_array, status, snapshot_name):
+        # An analysis keeps its first record, except that being processed replaces having been ignored, as in the
+        # CSV registry where the processed file takes precedence
+        recorded_at = datetime.now().isoformat(timespec='seconds')
+        self.connection.executemany(
+            'INSERT INTO analysis (analysis_accession, submitted_ftp, status, snapshot, recorded_at) '
+            'VALUES (?, ?, ?, ?, ?) '
+            'ON CONFLICT(analysis_accession) DO UPDATE SET submitted_ftp = excluded.submitted_ftp, '
+            'status = excluded.status, snapshot = excluded.snapshot, recorded_at = excluded.recorded_at '
+            f"WHERE excluded.status = '{PROCESSED}' AND analysis.status != '{PROCESSED}'",
+            ((analysis['analysis_accession'], analysis.get('submitted_ftp'), status, snapshot_name, recorded_at)
+             for analysis in analyses_array)
+        )
+
+    def get_watermark(self, project):
+        row = self.connection.execute('SELECT watermark, last_full_sweep FROM watermark WHERE project = ?',
+                                      (project,)).fetchone()
+        if row:
+            return {'watermark': row[0], 'last_full_sweep': row[1]}
+
+    def set_watermark(self, project, watermark, full_sweep_started=None):
+        with self.connection:
+            self.connection.execute('INSERT OR IGNORE INTO watermark (project) VALUES (?)', (project,))
+            self.connection.execute('UPDATE watermark SET watermark = ? WHERE project = ?', (watermark, project))
+            if full_sweep_started:
+                self.connection.execute('UPDATE watermark SET last_full_sweep = ? WHERE project = ?',
+                                        (full_sweep_started, project))
+
+    def count_analyses(self, status=None, snapshot_name=None) -> int:
+        query = 'SELECT COUNT(*) FROM analysis WHERE 1=1'
+        parameters = []
+        if status:
+            query += ' AND status = ?'
+            parameters.append(status)
+        if snapshot_name:
+            query += ' AND snapshot = ?'
+            parameters.append(snapshot_name)
+        return self.connection.execute(query, parameters).fetchone()[0]
+
+    def is_csv_imported(self) -> bool:
+        return self.connection.execute('SELECT 1 FROM registry_metadata WHERE key = ?',
+                                       (CSV_IMPORTED_KEY,)).fetchone() is not None
+
+    def import_csv_files(self, processed_analyses_file, ignored_analysis_file=None):
+        """
+        Load the content of the existing processed and ignored CSV files. Analyses already in the registry are kept
+        as they are, unless they were ignored and are processed in the CSV file. The import is a single transaction
+        that also records it as done, so an interrupted import leaves nothing behind and is run again.
+        """
+        with self.connection:
+            for status, analyses_file in ((PROCESSED, processed_analyses_file), (IGNORED, ignored_analysis_file)):
+                number_of_analyses = self.count_analyses(status)
+                for analyses in chunked(read_analyses_file(analyses_file), 10000):
+                    self._insert_analyses(
+                        ({'analysis_accession': accession, 'submitted_ftp': ftp_path}
+                         for accession, ftp_path in analyses),
+                        status, snapshot_name=os.path.basename(analyses_file)
+                    )
+                logger.info(f'Imported {self.count_analyses(status) - number_of_analyses} {status} analyses '
+                            f'from {analyses_file}')
+            self.connection.execute('INSERT OR REPLACE INTO registry_metadata (key, value) VALUES (?, ?)',
+                                    (CSV_IMPORTED_KEY, datetime.now().isoformat(timespec='seconds')))
+
+    def close(self):
+        self.connection.close()
+
+
+def read_analyses_file(analyses_file):
+    """
+    Yield the (accession, ftp_path) pairs stored in a processed or ignored CSV file.
+    """
+    if analyses_file and os.path.isfile(analyses_file):
+        with open(analyses_file, 'r') as open_file:
+            for line in open_file:
+                line = line.strip()
+                if line:
+                    accession, _, ftp_path = line.partition(',')
+                    yield accession, ftp_path
+
+
+def get_analysis_registry(processed_analyses_file, ignored_analysis_file, registry_db=None,
+                          snapshot_name=None) -> AnalysisRegistry:
+    """
+    Return the SQLite registry if registry_db is provided, populating it from the CSV files until an import of them
+    has completed. Otherwise return the registry backed by the CSV files.
+    """
+    if not registry_db:
+        return CsvAnalysisRegistry(processed_analyses_file, ignored_analysis_file)
+    registry = SqliteAnalysisRegistry(registry_db, snapshot_name)
+    if not registry.is_csv_imported():
+        try:
+            registry.import_csv_files(processed_analyses_file, ignored_analysis_file)
+        except BaseException:
+            registry.close()
+            raise
+    return registry
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Import the processed and ignored analyses CSV files into a SQLite '
+                                                 'analysis registry',
+                                     formatter_class=argparse.RawTextHelpFormatter, add_help=False)
+    parser.add_argument("--registry-db", required=True, help="Full path to the SQLite analysis registry")
+    parser.add_argument("--processed-analyses-file", required=True,
+                        help="full path to the file containing all the processed analyses")
+    parser.add_argument("--ignored-analyses-file", required=False,
+                        help="full path to the file containing a list of analyses to skip when processing.")
+    args = parser.parse_args()
+    logging_config.add_stdout_handler()
+
+    with SqliteAnalysisRegistry(args.registry_db) as registry:
+        registry.import_csv_files(args.processed_analyses_file, args.ignored_analyses_file)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+# Copyright 2022 EMBL - European Bioinformatics Institute
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Minimal support for the BGZF format used by bgzip: a series of gzip members of at most 64KB each, whose compressed
+size is stored in a "BC" extra subfield so that the blocks can be located without decompressing them.
+See https://samtools.github.io/hts-specs/SAMv1.pdf section 4.1
+"""
+
+import struct
+import zlib
+
+GZIP_MAGIC = b'\x1f\x8b'
+# gzip header with the FEXTRA flag set and a 6 bytes extra field holding the BC subfield
+BGZF_HEADER = b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00'
+BGZF_HEADER_SIZE = 18
+# Empty block written at the end of BGZF files
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+# Uncompressed data is split in blocks small enough for the compressed block to stay below 64KB
+MAX_BLOCK_DATA_SIZE = 0xff00
+
+
+class BgzfFormatError(ValueError):
+    pass
+
+
+def is_gzip(file_path) -> bool:
+    with open(file_path, 'rb') as open_file:
+        return open_file.read(2) == GZIP_MAGIC
+
+
+def is_bgzf(file_path) -> bool:
+    with open(file_path, 'rb') as open_file:
+        header = open_file.read(BGZF_HEADER_SIZE)
+    return len(header) == BGZF_HEADER_SIZE and header[:4] == b'\x1f\x8b\x08\x04' and header[12:14] == b'BC'
+
+
+def iter_bgzf_blocks(open_file):
+    """
+    Yield the raw deflate data of each block read from a BGZF file opened in binary mode, without decompressing it.
+    """
+    while True:
+        header = open_file.read(12)
+        if not header:
+            return
+        if len(header) < 12 or header[:4] != b'\x1f\x8b\x08\x04':
+            raise BgzfFormatError(f'Invalid BGZF block header at offset {open_file.tell() - len(header)}')
+        extra_length, = struct.unpack('<H', header[10:12])
+        extra = open_file.read(extra_length)
+        block_size = None
+        # Look for the BC subfield among the extra subfields
+        position = 0
+        while position + 4 <= len(extra):
+            subfield_length, = struct.unpack('<H', extra[position + 2:position + 4])
+            if extra[position:position + 2] == b'BC':
+                block_size, = struct.unpack('<H', extra[position + 4:position + 6])
+                break
+            position += 4 + subfield_length
+        if block_size is None:
+            raise BgzfFormatError('BGZF block without BC subfield')
+        # The block size excludes one byte, the remaining data is the deflate stream followed by the CRC32 and size
+        block = open_file.read(block_size + 1 - 12 - extra_length)
+        yield block[:-8]
+
+
+def decompress_block(deflate_data) -> bytes:
+    # zlib releases the GIL while decompressing so blocks can be decompressed concurrently by threads
+    return zlib.decompress(deflate_data, -zlib.MAX_WBITS)
+
+
+class BgzfWriter:
+    """
+    Write data to a BGZF file that can be indexed with tabix or bcftools.
+    """
+
+    def __init__(self, file_path, compression_level=6):
+        self.file_path = file_path
+        self.compression_level = compression_level
+        self._open_file = open(file_path, 'wb')
+        self._buffer = bytearray()
+        # Offset in the compressed file of the block being filled
+        self._block_address = 0
+
+    def write(self, data: bytes):
+        self._buffer.extend(data)
+        while len(self._buffer) >= MAX_BLOCK_DATA_SIZE:
+            self._write_block(bytes(self._buffer[:MAX_BLOCK_DATA_SIZE]))
+            del self._buffer[:MAX_BLOCK_DATA_SIZE]
+
+    def tell(self) -> int:
+        """
+        Return the virtual offset of the next byte written: the offset of its block in the compressed file in the
+        upper 48 bits and its offset in the uncompressed block in the lower 16 bits.
+        """
+        return self._block_address << 16 | len(self._buffer)
+
+    def flush(self):
+        if self._buffer:
+            self._write_block(bytes(self._buffer))
+            self._buffer.clear()
+
+    def _write_block(self, data: bytes):
+        compressor = zlib.compressobj(self.compression_level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        deflate_data = compressor.compress(data) + compressor.flush()
+        block_size = BGZF_HEADER_SIZE + len(deflate_data) + 8
+        self._open_file.write(BGZF_HEADER + struct.pack('<H', block_size - 1))
+        self._open_file.write(deflate_data)
+        self._open_file.write(struct.pack('<II', zlib.crc32(data), len(data)))
+        self._block_address += block_size
+
+    def close(self):
+        if self._open_file.closed:
+            return
+        self.flush()
+        self._open_file.write(BGZF_EOF)
+        self._open_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
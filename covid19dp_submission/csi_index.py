@@ -0,0 +1,243 @@
+# Copyright 2022 EMBL - European Bioinformatics Institute
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Writer for the CSI index of BGZF compressed VCF files, laid out like "bcftools index --csi" lays it out so that
+htslib based tools can query the files.
+See https://samtools.github.io/hts-specs/CSIv1.pdf
+"""
+
+import os
+import struct
+
+from covid19dp_submission.bgzf import BgzfWriter, decompress_block, iter_bgzf_blocks
+
+CSI_MAGIC = b'CSI\x01'
+# Same binning as the CSI indexes of VCF files created by htslib
+DEFAULT_MIN_SHIFT = 14
+DEFAULT_DEPTH = 6
+# Bins whose chunks span less than this compressed distance are merged into their parent bin
+MIN_MARKER_DIST = 0x10000
+# Auxiliary data of VCF indexes: format, sequence, start and end columns, comment character and lines to skip
+VCF_FORMAT = 2
+VCF_AUX_HEADER = struct.pack('<6i', VCF_FORMAT, 1, 2, 0, ord('#'), 0)
+
+
+class CsiIndexError(ValueError):
+    pass
+
+
+def first_bin_of_level(level):
+    return ((1 << (3 * level)) - 1) // 7
+
+
+def parent_bin(bin_number):
+    return (bin_number - 1) >> 3
+
+
+def region_to_bin(beg, end, min_shift, depth):
+    """
+    Return the smallest bin containing the 0-based region [beg, end).
+    """
+    end -= 1
+    shift = min_shift
+    for level in range(depth, 0, -1):
+        if beg >> shift == end >> shift:
+            return first_bin_of_level(level) + (beg >> shift)
+        shift += 3
+    return 0
+
+
+def get_info_end(info: bytes) -> int or None:
+    for info_field in info.split(b';'):
+        if info_field.startswith(b'END='):
+            try:
+                return int(info_field[4:])
+            except ValueError:
+                return None
+    return None
+
+
+class CsiIndexBuilder:
+    """
+    Build the CSI index of a VCF file from the position and virtual offsets of its records, which must be added in
+    the order of the file and sorted by position within each contig.
+    """
+
+    def __init__(self, min_shift=DEFAULT_MIN_SHIFT, depth=DEFAULT_DEPTH):
+        self.min_shift = min_shift
+        self.depth = depth
+        self.num_bins = first_bin_of_level(depth + 1)
+        self.contig_names = []
+        self._contigs = {}
+        self._current = None
+
+    def add(self, contig: str, beg: int, end: int, start_offset: int, end_offset: int):
+        """
+        Add a record covering the 0-based region [beg, end) of contig, stored between the virtual offsets
+        start_offset and end_offset.
+        """
+        contig_index = self._contigs.get(contig)
+        if contig_index is None:
+            contig_index = self._contigs[contig] = {
+                'bins': {}, 'linear_index': {}, 'start_offset': start_offset, 'num_records': 0,
+                'current_bin': None, 'chunk_start': None, 'last_beg': -1
+            }
+            self.contig_names.append(contig)
+        elif self._current is not contig_index:
+            raise CsiIndexError(f'Records of contig {contig} are not contiguous')
+        if beg < contig_index['last_beg']:
+            raise CsiIndexError(f'Records of contig {contig} are not sorted at position {beg + 1}')
+        if self._current is not None and self._current is not contig_index:
+            self._close_chunk(self._current, start_offset)
+        self._current = contig_index
+        contig_index['last_beg'] = beg
+        contig_index['num_records'] += 1
+        contig_index['end_offset'] = end_offset
+        end = max(end, beg + 1)
+        # Each window of the linear index keeps the offset of the first record overlapping it
+        for window in range(beg >> self.min_shift, ((end - 1) >> self.min_shift) + 1):
+            contig_index['linear_index'].setdefault(window, start_offset)
+        record_bin = region_to_bin(beg, end, self.min_shift, self.depth)
+        # Consecutive records of the same bin are stored as a single chunk
+        if record_bin != contig_index['current_bin']:
+            self._close_chunk(contig_index, start_offset)
+            contig_index['current_bin'] = record_bin
+            contig_index['chunk_start'] = start_offset
+
+    @staticmethod
+    def _close_chunk(contig_index, end_offset):
+        if contig_index['current_bin'] is not None:
+            contig_index['bins'].setdefault(contig_index['current_bin'], []).append(
+                [contig_index['chunk_start'], end_offset])
+            contig_index['current_bin'] = None
+
+    def _get_bottom_window(self, bin_number):
+        level = next(level for level in range(self.depth, -1, -1) if bin_number >= first_bin_of_level(level))
+        return (bin_number - first_bin_of_level(level)) << (3 * (self.depth - level))
+
+    def _finish_contig(self, contig_index):
+        self._close_chunk(contig_index, contig_index['end_offset'])
+        bins = contig_index['bins']
+        linear_index = contig_index['linear_index']
+        # Windows without records point to the previous record, like in htslib
+        last_window = max(linear_index)
+        window_offsets = []
+        for window in range(last_window + 1):
+            window_offsets.append(linear_index.get(window, window_offsets[-1] if window_offsets
+                                                   else contig_index['start_offset']))
+        bin_offsets = {bin_number: window_offsets[window] if window < len(window_offsets) else 0
+                       for bin_number, window in ((b, self._get_bottom_window(b)) for b in bins)}
+        # Merge the bins covering a small part of the file into their parent, starting from the lowest level
+        for level in range(self.depth, 0, -1):
+            level_first_bin = first_bin_of_level(level)
+            for bin_number in sorted(b for b in bins if b >= level_first_bin):
+                chunks = sorted(bins[bin_number])
+                bins[bin_number] = chunks
+                if (chunks[-1][1] >> 16) - (chunks[0][0] >> 16) < MIN_MARKER_DIST \
+                        and parent_bin(bin_number) in bins:
+                    bins[parent_bin(bin_number)].extend(bins.pop(bin_number))
+        # Merge the chunks that start in the BGZF block where the previous one ends
+        for bin_number, chunks in bins.items():
+            chunks.sort()
+            merged_chunks = [chunks[0]]
+            for chunk in chunks[1:]:
+                if merged_chunks[-1][1] >> 16 >= chunk[0] >> 16:
+                    merged_chunks[-1][1] = max(merged_chunks[-1][1], chunk[1])
+                else:
+                    merged_chunks.append(chunk)
+            bins[bin_number] = merged_chunks
+        return bins, bin_offsets
+
+    def to_bytes(self) -> bytes:
+        names = b''.join(name.encode() + b'\x00' for name in self.contig_names)
+        aux = VCF_AUX_HEADER + struct.pack('<i', len(names)) + names
+        data = [CSI_MAGIC, struct.pack('<3i', self.min_shift, self.depth, len(aux)), aux,
+                struct.pack('<i', len(self.contig_names))]
+        for contig in self.contig_names:
+            contig_index = self._contigs[contig]
+            bins, bin_offsets = self._finish_contig(contig_index)
+            data.append(struct.pack('<i', len(bins) + 1))
+            for bin_number in sorted(bins):
+                data.append(struct.pack('<IQi', bin_number, bin_offsets.get(bin_number, 0), len(bins[bin_number])))
+                data.extend(struct.pack('<QQ', *chunk) for chunk in bins[bin_number])
+            # Pseudo-bin holding the span of the contig and its number of records
+            data.append(struct.pack('<IQi', self.num_bins + 1, 0, 2))
+            data.append(struct.pack('<QQQQ', contig_index['start_offset'], contig_index['end_offset'],
+                                    contig_index['num_records'], 0))
+        # Number of records without coordinates
+        data.append(struct.pack('<Q', 0))
+        return b''.join(data)
+
+    def write(self, csi_file):
+        with BgzfWriter(csi_file + '.tmp') as writer:
+            writer.write(self.to_bytes())
+        os.replace(csi_file + '.tmp', csi_file)
+
+
+def add_vcf_record(index_builder: CsiIndexBuilder, line: bytes, start_offset: int, end_offset: int):
+    """
+    Add a VCF data line to the index. The record ends at the end of its REF allele or at its END INFO field.
+    """
+    fields = line.split(b'\t', 8)
+    if len(fields) < 8:
+        raise CsiIndexError(f'Malformed record {line[:100]}')
+    try:
+        beg = int(fields[1]) - 1
+    except ValueError:
+        raise CsiIndexError(f'Malformed position in record {line[:100]}')
+    end = beg + len(fields[3])
+    info_end = get_info_end(fields[7])
+    if info_end is not None and info_end > beg:
+        end = info_end
+    index_builder.add(fields[0].decode(), beg, end, start_offset, end_offset)
+
+
+def index_bgzf_vcf(vcf_file, csi_file=None, min_shift=DEFAULT_MIN_SHIFT, depth=DEFAULT_DEPTH) -> str:
+    """
+    Write the CSI index of an existing BGZF compressed VCF file, by default next to it.
+    """
+    csi_file = csi_file or vcf_file + '.csi'
+    index_builder = CsiIndexBuilder(min_shift, depth)
+    line_start_offset = 0
+    line_parts = []
+    with open(vcf_file, 'rb') as open_file:
+        blocks = iter_bgzf_blocks(open_file)
+        block_address = open_file.tell()
+        for deflate_data in blocks:
+            data = decompress_block(deflate_data)
+            # The blocks are read one at a time so the file position is the address of the next block
+            next_block_address = open_file.tell()
+            position = 0
+            while position < len(data):
+                if not line_parts:
+                    line_start_offset = block_address << 16 | position
+                line_end = data.find(b'\n', position)
+                if line_end == -1:
+                    line_parts.append(data[position:])
+                    break
+                line_parts.append(data[position:line_end])
+                position = line_end + 1
+                # Like htslib, a position at the end of a block is the start of the next block
+                line_end_offset = block_address << 16 | position if position < len(data) \
+                    else next_block_address << 16
+                line = b''.join(line_parts)
+                line_parts = []
+                if line and not line.startswith(b'#'):
+                    add_vcf_record(index_builder, line, line_start_offset, line_end_offset)
+            block_address = next_block_address
+    if line_parts and not line_parts[0].startswith(b'#'):
+        add_vcf_record(index_builder, b''.join(line_parts), line_start_offset, block_address << 16)
+    index_builder.write(csi_file)
+    return csi_file
@@ -15,9 +15,18 @@
 import argparse
 import copy
 import glob
+import heapq
+import math
 import os
+import shutil
 import subprocess
-import urllib
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from contextlib import closing
+from datetime import datetime, timedelta
+from itertools import islice
+from urllib.parse import quote
 
 import requests
 from ebi_eva_common_pyutils.command_utils import run_command_with_output
@@ -25,20 +34,33 @@ from ebi_eva_common_pyutils.logger import logging_config
 from more_itertools import chunked
 from retry import retry
 
+from covid19dp_submission.analysis_registry import AnalysisRegistry, CsvAnalysisRegistry
+from covid19dp_submission.file_checksum import get_submitted_md5, verify_md5
+from covid19dp_submission.http_download import HttpDownloader
+from covid19dp_submission.vcf_summary import write_vcf_summary
+
 logger = logging_config.get_logger(__name__)
 
+ANALYSIS_FIELDS = ['run_accession', 'analysis_accession', 'submitted_ftp', 'submitted_aspera', 'tax_id',
+                   'first_public', 'submitted_bytes', 'submitted_md5']
+
 
 class UnfinishedBatchError(Exception):
     pass
 
 
 def download_analyses(project, num_analyses, processed_analyses_file, ignored_analysis_file, accepted_taxonomies,
-                      download_target_dir, ascp, aspera_id_dsa, batch_size=100):
+                      download_target_dir, ascp, aspera_id_dsa, batch_size=100,
+                      analysis_registry: AnalysisRegistry = None, delta_fetch=False, full_sweep_interval_days=7,
+                      max_concurrent_transfers=1, total_bandwidth_mbps=300, http_download_workers=8):
     total_analyses = total_analyses_in_project(project)
     logger.info(f"total analyses in project {project}: {total_analyses}")
 
+    if not analysis_registry:
+        analysis_registry = CsvAnalysisRegistry(processed_analyses_file, ignored_analysis_file)
     analyses_array = get_analyses_to_process(project, num_analyses, processed_analyses_file, ignored_analysis_file,
-                                             accepted_taxonomies)
+                                             accepted_taxonomies, analysis_registry, delta_fetch,
+                                             full_sweep_interval_days)
     logger.info(f"number of analyses to process: {len(analyses_array)}")
 
     os.makedirs(download_target_dir, exist_ok=True)
@@ -47,8 +69,14 @@ def download_analyses(project, num_analyses, processed_analyses_file, ignored_an
     # Also sending an empty list of VCF actually downloaded to be populated by download_files_via_aspera even when
     # retry are used
     vcf_files_downloaded = []
-    download_files_via_aspera(copy.copy(analyses_array), download_target_dir, processed_analyses_file, ascp,
-                              aspera_id_dsa, vcf_files_downloaded, batch_size)
+    if shutil.which(os.path.expanduser(ascp)):
+        download_files_via_aspera(copy.copy(analyses_array), download_target_dir, processed_analyses_file, ascp,
+                                  aspera_id_dsa, vcf_files_downloaded, batch_size, analysis_registry,
+                                  max_concurrent_transfers, total_bandwidth_mbps)
+    else:
+        logger.warning(f"Aspera client {ascp} is not available. Files will be downloaded over HTTP.")
+        download_files(copy.copy(analyses_array), download_target_dir, processed_analyses_file, analysis_registry,
+                       vcf_files_downloaded, http_download_workers)
 
     logger.info(f"total number of files downloaded: {len(vcf_files_downloaded)}")
 
@@ -72,60 +100,218 @@ def total_analyses_in_project(project):
 
 
 def get_analyses_to_process(project, num_analyses, processed_analyses_file, ignored_analysis_file,
-                            accepted_taxonomies):
-    analysis_processed = get_analyses_from_file(processed_analyses_file)
-    analysis_to_ignore = get_analyses_from_file(ignored_analysis_file)
-    analysis_to_skip = analysis_processed.union(analysis_to_ignore)
+                            accepted_taxonomies, analysis_registry: AnalysisRegistry = None, delta_fetch=False,
+                            full_sweep_interval_days=7):
+    """
+    Retrieve the analyses from ENA that have not been processed or ignored yet.
+    In delta_fetch mode, only the analyses made public since the watermark recorded for the project are requested.
+    A full sweep of the project is still done every full_sweep_interval_days to reconcile with ENA. The report is
+    then read to the end, so that the watermark never moves past an analysis left for a later run.
+    """
+    if not analysis_registry:
+        analysis_registry = CsvAnalysisRegistry(processed_analyses_file, ignored_analysis_file)
     new_files_to_ignore = []
 
-    logger.debug(f"Fetching ENA analyses from project {project}")
-    # FIXME: Retrieve all the project's analysis in one go because the offset is not working beyond 1,000,000 analysis
-    # Revert this if this limitation is address on ENA's side
-    analyses_from_ena = get_analyses_from_ena(project)
+    watermark = None
+    if delta_fetch:
+        watermark = get_delta_watermark(analysis_registry, project, full_sweep_interval_days)
+    full_sweep_started = None
+    if watermark:
+        logger.info(f"Fetching ENA analyses from project {project} made public since {watermark}")
+    else:
+        logger.info(f"Fetching all ENA analyses from project {project}")
+        # Analyses made public while the sweep runs may be missed so the sweep is recorded from the time it starts
+        full_sweep_started = datetime.now().isoformat(timespec='seconds')
+    # The report is requested without offset because the offset is not working beyond 1,000,000 analyses on ENA's
+    # side. The analyses are streamed and filtered as they arrive so the whole project is never held in memory, and the
+    # stream is only consumed until enough analyses have been found for processing.
+    stream_status = {'latest_first_public': watermark}
+    analyses_from_ena = track_latest_first_public(stream_analyses_from_ena(project, first_public_since=watermark),
+                                                  stream_status)
     # Filter out based on previously marked analysis
-    unprocessed_analyses = filter_out_processed_analyses(analyses_from_ena, analysis_to_skip)
-    # Filter out based on taxonomy
-    unprocessed_analyses = [a for a in unprocessed_analyses if int(a.get('tax_id') or 0) in accepted_taxonomies]
-    # Gather filtered analysis that had not been previously filtered out
-    new_files_to_ignore.extend([a for a in unprocessed_analyses if int(a.get('tax_id') or 0) not in accepted_taxonomies])
-    analyses_for_processing = unprocessed_analyses[:num_analyses]
-    logger.debug(f"Number of analyses removed in current iteration: {len(analyses_from_ena) - len(unprocessed_analyses)}")
+    unprocessed_analyses = filter_out_processed_analyses(analyses_from_ena, analysis_registry)
+    # Filter out based on taxonomy and gather filtered analysis that had not been previously filtered out
+    unprocessed_analyses = filter_out_rejected_taxonomies(unprocessed_analyses, accepted_taxonomies,
+                                                          new_files_to_ignore)
+    analyses_for_processing = list(islice(unprocessed_analyses, num_analyses))
+    unread_status = {}
+    if delta_fetch:
+        # The report is not ordered by first_public so the analyses left for later are needed to place the watermark
+        unread_status = get_first_public_range(unprocessed_analyses)
+        if unread_status['num_analyses']:
+            logger.info(f"Number of analyses left for a later run: {unread_status['num_analyses']}")
     logger.info(f"Number of analyses found for processing: {len(analyses_for_processing)}")
     logger.info(f"Number of analyses found to be ignored in the future: {len(new_files_to_ignore)}")
 
-    add_to_ignored_file(new_files_to_ignore, ignored_analysis_file)
+    analysis_registry.add_ignored_analyses(new_files_to_ignore)
+    if delta_fetch:
+        update_delta_watermark(analysis_registry, project, stream_status['latest_first_public'], unread_status,
+                               full_sweep_started)
 
     return analyses_for_processing
 
 
-@retry(logger=logger, tries=4, delay=120, backoff=1.2, jitter=(1, 3))
-def get_analyses_from_ena(project, offset=0, limit=0):
+def get_first_public_range(analyses) -> dict:
+    """
+    Consume the analyses and return their number, the earliest first_public date among them and whether some of them
+    have no first_public date.
+    """
+    first_public_range = {'num_analyses': 0, 'earliest_first_public': None, 'has_undated': False}
+    for analysis in analyses:
+        first_public_range['num_analyses'] += 1
+        first_public = analysis.get('first_public')
+        if not first_public:
+            first_public_range['has_undated'] = True
+        elif not first_public_range['earliest_first_public'] \
+                or first_public < first_public_range['earliest_first_public']:
+            first_public_range['earliest_first_public'] = first_public
+    return first_public_range
+
+
+def update_delta_watermark(analysis_registry: AnalysisRegistry, project, latest_first_public, unread_status,
+                           full_sweep_started=None):
+    """
+    Move the watermark of the project forward once its report has been read to the end. The watermark moves to the
+    earliest first_public of the analyses left for a later run, which the next fetch from the watermark includes,
+    or to the latest first_public seen when none is left. A full sweep is recorded with the time it started.
+    """
+    if unread_status['has_undated']:
+        logger.warning(f"Some analyses left for a later run have no first_public date: the watermark of project "
+                       f"{project} is not updated")
+        return
+    new_watermark = unread_status['earliest_first_public'] or latest_first_public
+    if not new_watermark:
+        return
+    logger.info(f"Update watermark for project {project} to {new_watermark}")
+    analysis_registry.set_watermark(project, new_watermark, full_sweep_started)
+
+
+def get_delta_watermark(analysis_registry: AnalysisRegistry, project, full_sweep_interval_days):
+    """
+    Return the watermark to fetch analyses from or None if a full sweep of the project is required.
+    """
+    project_watermark = analysis_registry.get_watermark(project)
+    if not project_watermark or not project_watermark.get('watermark'):
+        logger.info(f"No watermark recorded for project {project}: a full sweep is required")
+        return None
+    last_full_sweep = project_watermark.get('last_full_sweep')
+    if not last_full_sweep or \
+            datetime.fromisoformat(last_full_sweep) + timedelta(days=full_sweep_interval_days) < datetime.now():
+        logger.info(f"Last full sweep of project {project} was done on {last_full_sweep}: a full sweep is required")
+        return None
+    return project_watermark['watermark']
+
+
+def track_latest_first_public(analyses, stream_status):
     """
-    Retrieve analysis of a specific project from ENA API. If offset and limit are not set, it retrieves all the
-    analysis of the project.
+    Record in stream_status the latest first_public date of the analyses going through.
     """
-    analyses_url = (
-        f"https://www.ebi.ac.uk/ena/portal/api/filereport?result=analysis&accession={project}"
-        f"&format=json&fields=run_accession,analysis_accession,submitted_ftp,submitted_aspera,tax_id"
-    )
+    for analysis in analyses:
+        first_public = analysis.get('first_public')
+        if first_public and (not stream_status['latest_first_public']
+                             or first_public > stream_status['latest_first_public']):
+            stream_status['latest_first_public'] = first_public
+        yield analysis
+
+
+@retry(logger=logger, tries=4, delay=120, backoff=1.2, jitter=(1, 3))
+def _open_analyses_stream_from_ena(project, offset=0, limit=0, first_public_since=None):
+    if first_public_since:
+        # The filereport cannot be filtered so use the search endpoint instead
+        query = quote(f'study_accession="{project}" AND first_public>={first_public_since}')
+        analyses_url = (
+            f"https://www.ebi.ac.uk/ena/portal/api/search?result=analysis&query={query}"
+            f"&format=tsv&fields={','.join(ANALYSIS_FIELDS)}"
+        )
+    else:
+        analyses_url = (
+            f"https://www.ebi.ac.uk/ena/portal/api/filereport?result=analysis&accession={project}"
+            f"&format=tsv&fields={','.join(ANALYSIS_FIELDS)}"
+        )
     if offset:
         analyses_url += f'&offset={offset}'
     if limit or limit == 0:
         analyses_url += f'&limit={limit}'
-    response = requests.get(analyses_url)
+    response = requests.get(analyses_url, stream=True)
     if response.status_code != 200:
         logger.error(f"Error fetching analyses info from ENA for {project}")
         response.raise_for_status()
-    return response.json()
+    return response
 
 
-def filter_out_processed_analyses(analyses_array, processed_analyses):
-    unprocessed_analyses = []
-    for analysis in analyses_array:
-        if analysis['analysis_accession'] not in processed_analyses:
-            unprocessed_analyses.append(analysis)
+def _read_analyses_stream(project, offset, limit, first_public_since, resume_after=None):
+    """
+    Yield the analyses of one request to ENA, skipping the ones up to the accession resume_after when it is set.
+    """
+    response = _open_analyses_stream_from_ena(project, offset, limit, first_public_since)
+    with closing(response):
+        if response.encoding is None:
+            response.encoding = 'utf-8'
+        lines = response.iter_lines(decode_unicode=True)
+        header = next(lines, None)
+        if not header:
+            return
+        fields = header.split('\t')
+        for line in lines:
+            if not line:
+                continue
+            analysis = dict(zip(fields, line.split('\t')))
+            if resume_after:
+                if analysis['analysis_accession'] == resume_after:
+                    resume_after = None
+                continue
+            yield analysis
+    if resume_after:
+        raise ValueError(f"Cannot resume the analyses of {project} from ENA: {resume_after} is no longer reported")
+
+
+def stream_analyses_from_ena(project, offset=0, limit=0, first_public_since=None, tries=4, delay=120, backoff=1.2):
+    """
+    Yield analysis of a specific project from ENA API one at a time. The report is requested in TSV and read line by
+    line as it is received so memory usage does not depend on the number of analyses in the project.
+    If offset and limit are not set, it retrieves all the analysis of the project. If first_public_since is set, only
+    the analyses made public on or after that date (YYYY-MM-DD) are retrieved.
+    When the connection is lost while the report is read, it is requested again, up to tries times, and resumed after
+    the last analysis yielded.
+    """
+    last_accession = None
+    for attempt in range(1, tries + 1):
+        try:
+            for analysis in _read_analyses_stream(project, offset, limit, first_public_since, last_accession):
+                last_accession = analysis['analysis_accession']
+                yield analysis
+            return
+        except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError,
+                requests.exceptions.Timeout) as e:
+            if attempt == tries:
+                raise
+            logger.warning(f"Lost the connection to ENA while reading the analyses of {project}: {e}. Resuming after "
+                           f"{last_accession} in {delay:.0f} seconds")
+            time.sleep(delay)
+            delay *= backoff
+
+
+def filter_out_processed_analyses(analyses, analysis_registry: AnalysisRegistry, chunk_size=1000):
+    """
+    Yield the analyses that are not already known to the registry. Membership is checked in bulk for each chunk of
+    analyses.
+    """
+    for analyses_chunk in chunked(analyses, chunk_size):
+        known_analyses = analysis_registry.get_known_analyses([a['analysis_accession'] for a in analyses_chunk])
+        for analysis in analyses_chunk:
+            if analysis['analysis_accession'] not in known_analyses:
+                yield analysis
 
-    return unprocessed_analyses
+
+def filter_out_rejected_taxonomies(analyses, accepted_taxonomies, rejected_analyses):
+    """
+    Yield the analyses from an accepted taxonomy. The other ones are appended to rejected_analyses as they are seen.
+    """
+    for analysis in analyses:
+        if int(analysis.get('tax_id') or 0) in accepted_taxonomies:
+            yield analysis
+        else:
+            rejected_analyses.append(analysis)
 
 
 def add_to_ignored_file(analyses_array, ignored_analysis_file):
@@ -151,60 +337,185 @@ def get_analyses_from_file(processed_analyses_file):
     return analyses_set
 
 
-def download_files(analyses_array, download_target_dir, processed_analyses_file):
+def download_files(analyses_array, download_target_dir, processed_analyses_file,
+                   analysis_registry: AnalysisRegistry = None, downloaded_files=None, max_workers=8):
+    """
+    Download the analyses over HTTP with up to max_workers concurrent transfers. Files are named like the ones
+    downloaded with Aspera. Downloaded analyses are removed from analyses_array and their files added to
+    downloaded_files. Failed transfers leave a partial file that is resumed by the next attempt.
+    """
     logger.info(f"total number of files to download: {len(analyses_array)}")
-    with open(processed_analyses_file, 'a') as f:
-        for analysis in analyses_array:
-            download_url = f"http://{analysis['submitted_ftp']}"
-            download_file_name = f"{analysis['analysis_accession']}.vcf"
-            download_file_path = f"{download_target_dir}/{download_file_name}"
-            try:
-                logger.info(f"downloading file {download_url}")
-                download_file(download_url, download_file_path)
-                logger.info(f"downloaded file {download_file_name}")
-                f.write(f"\n{analysis['analysis_accession']},{analysis['submitted_ftp']}")
-            except:
-                logger.warning(f"Could not download file : {download_file_path}")
-                if os.path.exists(download_file_path):
-                    os.remove(download_file_path)
+    if not analysis_registry:
+        analysis_registry = CsvAnalysisRegistry(processed_analyses_file)
+    if downloaded_files is None:
+        downloaded_files = []
+    analyses_per_file = {
+        os.path.join(download_target_dir, os.path.basename(analysis['submitted_ftp'])): analysis
+        for analysis in analyses_array
+    }
+    downloader = HttpDownloader(max_workers=max_workers)
+    for download_url, download_file_path, error in downloader.download_files(
+            (f"http://{analysis['submitted_ftp']}", download_file_path,
+             get_submitted_md5(analysis, download_file_path))
+            for download_file_path, analysis in analyses_per_file.items()
+    ):
+        if error:
+            logger.warning(f"Could not download file : {download_file_path}")
+            continue
+        logger.info(f"downloaded file {download_file_path}")
+        summarise_downloaded_file(download_file_path)
+        analysis = analyses_per_file[download_file_path]
+        analyses_array.remove(analysis)
+        downloaded_files.append(download_file_path)
+        analysis_registry.add_processed_analyses([analysis])
+    return downloaded_files
 
 
 @retry(exceptions=(UnfinishedBatchError,), logger=logger, tries=4, delay=10, backoff=1.2, jitter=(1, 3))
 def download_files_via_aspera(analyses_array, download_target_dir, processed_analyses_file, ascp, aspera_id_dsa,
-                              downloaded_files, batch_size=100):
+                              downloaded_files, batch_size=100, analysis_registry: AnalysisRegistry = None,
+                              max_concurrent_transfers=1, total_bandwidth_mbps=300, verification_workers=4,
+                              max_requeues=2):
+    """
+    Download the analyses in batches with one ascp command per batch. Up to max_concurrent_transfers batches are
+    transferred at the same time, sharing total_bandwidth_mbps between them. As soon as a batch transfer ends, the
+    MD5 of its files is checked by a pool of verification_workers while the other transfers continue. Valid files are
+    recorded as processed and corrupted ones are deleted and transferred again on their own, up to max_requeues times.
+    """
     logger.info(f"total number of files to download: {len(analyses_array)}")
-    with open(processed_analyses_file, 'a') as open_file:
-        # This copy won't change throughout the iteration
-        for analysis_batch in chunked(copy.copy(analyses_array), batch_size):
-            download_urls = []
-            for analysis in analysis_batch:
-                if analysis.get('submitted_aspera'):
-                    download_urls.append(f"era-fasp@{analysis['submitted_aspera']}")
-                else:
-                    logger.error(f'No Aspera path available for analysis {analysis}')
-            command = f'{ascp} -i {aspera_id_dsa} -QT -l 300m -P 33001 {" ".join(download_urls)} {download_target_dir}'
-            try:
-                run_command_with_output(f"Download batch of covid19 data", command)
-            except subprocess.CalledProcessError:
-                logger.error('Aspera download command failed.')
-            for analysis in analysis_batch:
-                expected_output_file = os.path.join(download_target_dir, os.path.basename(analysis['submitted_aspera']))
-                if os.path.exists(expected_output_file):
-                    open_file.write(f"{analysis['analysis_accession']},{analysis['submitted_ftp']}\n")
+    if not analysis_registry:
+        analysis_registry = CsvAnalysisRegistry(processed_analyses_file)
+    # This copy won't change throughout the iteration
+    analysis_batches = pack_batches_by_size(copy.copy(analyses_array), batch_size)
+    num_transfers = max(1, min(max_concurrent_transfers, len(analysis_batches)))
+    bandwidth_per_transfer = max(1, total_bandwidth_mbps // num_transfers)
+    logger.info(f"Download {len(analysis_batches)} batches with {num_transfers} concurrent transfers "
+                f"of {bandwidth_per_transfer}Mbps")
+    requeues = {}
+    with ThreadPoolExecutor(max_workers=num_transfers) as transfer_executor, \
+            ThreadPoolExecutor(max_workers=verification_workers) as verification_executor:
+        def submit_transfer(analysis_batch):
+            return transfer_executor.submit(download_batch_via_aspera, analysis_batch, download_target_dir, ascp,
+                                            aspera_id_dsa, bandwidth_per_transfer)
+
+        transfers = {submit_transfer(analysis_batch) for analysis_batch in analysis_batches}
+        # verification -> (analysis, downloaded file)
+        verifications = {}
+        # Only this thread updates the analyses, downloaded files and registry so no lock is required
+        while transfers or verifications:
+            done, _ = wait(transfers | set(verifications), return_when=FIRST_COMPLETED)
+            verified_analyses = []
+            for future in done:
+                if future in transfers:
+                    transfers.remove(future)
+                    for analysis, output_file in get_transferred_files(future.result(), download_target_dir):
+                        verification = verification_executor.submit(
+                            verify_and_summarise_downloaded_file, output_file, get_submitted_md5(analysis, output_file)
+                        )
+                        verifications[verification] = (analysis, output_file)
+                    continue
+                analysis, output_file = verifications.pop(future)
+                if future.result():
+                    verified_analyses.append(analysis)
                     # WARNING: This will modify the content of the original analysis array and downloaded files
                     # allowing the retry to only deal with a subset of files to download.
                     analyses_array.remove(analysis)
-                    downloaded_files.append(expected_output_file)
-                else:
-                    logger.warn(f"Failed to download {analysis['submitted_aspera']}")
+                    downloaded_files.append(output_file)
+                    continue
+                logger.warning(f"MD5 of {output_file} does not match {analysis.get('submitted_md5')}")
+                os.remove(output_file)
+                if requeues.get(analysis['analysis_accession'], 0) < max_requeues:
+                    requeues[analysis['analysis_accession']] = requeues.get(analysis['analysis_accession'], 0) + 1
+                    transfers.add(submit_transfer([analysis]))
+            if verified_analyses:
+                # Record the analyses verified together in one transaction
+                analysis_registry.add_processed_analyses(verified_analyses)
     if len(analyses_array) > 0:
         # Trigger a retry
         raise UnfinishedBatchError(f'There are {len(analyses_array)} vcf files that were not downloaded')
 
 
-@retry(logger=logger, tries=4, delay=120, backoff=1.2, jitter=(1, 3))
+def verify_and_summarise_downloaded_file(file_path, expected_md5):
+    if not verify_md5(file_path, expected_md5):
+        return False
+    summarise_downloaded_file(file_path)
+    return True
+
+
+def summarise_downloaded_file(file_path):
+    """
+    Write the summary of a file that just arrived so that the following steps don't need to read it again.
+    Files that cannot be read as VCF are left for the validation to report.
+    """
+    try:
+        write_vcf_summary(file_path, num_threads=1)
+    except (OSError, EOFError, ValueError, zlib.error) as e:
+        logger.warning(f'Could not summarise {file_path}: {e}')
+
+
+def get_submitted_bytes(analysis):
+    # Analyses with several submitted files have their sizes separated by semicolons
+    return sum(int(size) for size in (analysis.get('submitted_bytes') or '').split(';') if size)
+
+
+def pack_batches_by_size(analyses_array, batch_size):
+    """
+    Split the analyses into batches of at most batch_size analyses with a similar number of bytes to transfer.
+    Analyses are assigned largest first to the lightest batch that still has room, and the batches are returned
+    largest first so the longest transfers start first.
+    If the sizes are not known the analyses are split in the order they are provided.
+    """
+    if not any(get_submitted_bytes(analysis) for analysis in analyses_array):
+        return list(chunked(analyses_array, batch_size))
+    num_batches = math.ceil(len(analyses_array) / batch_size)
+    batches = [[] for _ in range(num_batches)]
+    batch_bytes = [0] * num_batches
+    # Heap of (bytes in batch, batch index) for the batches that are not full
+    open_batches = [(0, index) for index in range(num_batches)]
+    for analysis in sorted(analyses_array, key=get_submitted_bytes, reverse=True):
+        _, index = heapq.heappop(open_batches)
+        batches[index].append(analysis)
+        batch_bytes[index] += get_submitted_bytes(analysis)
+        if len(batches[index]) < batch_size:
+            heapq.heappush(open_batches, (batch_bytes[index], index))
+    return [batch for _, batch in sorted(zip(batch_bytes, batches), key=lambda item: item[0], reverse=True)]
+
+
+def download_batch_via_aspera(analysis_batch, download_target_dir, ascp, aspera_id_dsa, bandwidth_mbps):
+    download_urls = []
+    for analysis in analysis_batch:
+        if analysis.get('submitted_aspera'):
+            download_urls.append(f"era-fasp@{analysis['submitted_aspera']}")
+        else:
+            logger.error(f'No Aspera path available for analysis {analysis}')
+    command = (f'{ascp} -i {aspera_id_dsa} -QT -l {bandwidth_mbps}m -P 33001 {" ".join(download_urls)} '
+               f'{download_target_dir}')
+    start_time = time.time()
+    try:
+        run_command_with_output(f"Download batch of covid19 data", command)
+    except subprocess.CalledProcessError:
+        logger.error('Aspera download command failed.')
+    duration = time.time() - start_time
+    batch_bytes = sum(get_submitted_bytes(analysis) for analysis in analysis_batch)
+    logger.info(f"Batch of {len(analysis_batch)} files ({batch_bytes / 1e6:.1f}MB) transferred in {duration:.1f}s "
+                f"({batch_bytes * 8 / 1e6 / max(duration, 0.001):.1f}Mbps)")
+    return analysis_batch
+
+
+def get_transferred_files(analysis_batch, download_target_dir):
+    """
+    Yield the (analysis, file) pairs for the analyses of the batch whose file is present after the transfer.
+    """
+    for analysis in analysis_batch:
+        expected_output_file = os.path.join(download_target_dir, os.path.basename(analysis['submitted_aspera']))
+        if os.path.exists(expected_output_file):
+            yield analysis, expected_output_file
+        else:
+            logger.warning(f"Failed to download {analysis['submitted_aspera']}")
+
+
 def download_file(download_url, download_file_path):
-    urllib.request.urlretrieve(download_url, download_file_path)
+    HttpDownloader(max_workers=1).download_file(download_url, download_file_path)
 
 
 def main():
@@ -0,0 +1,57 @@
+# Copyright 2022 EMBL - European Bioinformatics Institute
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import os
+
+
+class ChecksumMismatchError(Exception):
+    pass
+
+
+def update_md5_from_file(md5, file_path, chunk_size=1024 * 1024):
+    """
+    Feed the content of file_path to the md5 object in chunks so the file is never fully loaded in memory.
+    """
+    with open(file_path, 'rb') as open_file:
+        for chunk in iter(lambda: open_file.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5
+
+
+def compute_md5(file_path) -> str:
+    return update_md5_from_file(hashlib.md5(), file_path).hexdigest()
+
+
+def get_submitted_md5(analysis, file_path):
+    """
+    Return the MD5 provided by ENA for the submitted file of the analysis that has the same name as file_path or None
+    if it is not known. Analyses with several submitted files have their paths and MD5s separated by semicolons.
+    """
+    file_name = os.path.basename(file_path)
+    submitted_paths = (analysis.get('submitted_ftp') or analysis.get('submitted_aspera') or '').split(';')
+    submitted_md5s = (analysis.get('submitted_md5') or '').split(';')
+    for submitted_path, submitted_md5 in zip(submitted_paths, submitted_md5s):
+        if os.path.basename(submitted_path) == file_name:
+            return submitted_md5 or None
+    return None
+
+
+def verify_md5(file_path, expected_md5) -> bool:
+    """
+    Check that file_path has the expected MD5. Files without an expected MD5 are considered valid.
+    """
+    if not expected_md5:
+        return True
+    return compute_md5(file_path) == expected_md5.lower()
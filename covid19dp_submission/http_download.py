@@ -0,0 +1,153 @@
+# Copyright 2022 EMBL - European Bioinformatics Institute
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse
+
+import requests
+from ebi_eva_common_pyutils.logger import logging_config
+
+from covid19dp_submission.file_checksum import ChecksumMismatchError, update_md5_from_file
+
+logger = logging_config.get_logger(__name__)
+
+
+class HttpDownloader:
+    """
+    Download files over HTTP with a bounded pool of threads. Each thread keeps its own session so connections to the
+    same host are reused between files. Interrupted transfers are resumed from the partially downloaded file using
+    Range requests, and failures on a host delay the next requests made to that host with an exponential backoff.
+    The MD5 of each file is computed while it is written so it can be verified as soon as the transfer ends.
+    """
+
+    def __init__(self, max_workers=8, max_attempts=4, backoff=10, max_backoff=300, timeout=60,
+                 chunk_size=64 * 1024):
+        self.max_workers = max_workers
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self._thread_local = threading.local()
+        self._host_lock = threading.Lock()
+        # host -> (number of consecutive failures, time before which no new request should be sent)
+        self._host_status = {}
+
+    @property
+    def session(self) -> requests.Session:
+        if not hasattr(self._thread_local, 'session'):
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=4)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self._thread_local.session = session
+        return self._thread_local.session
+
+    def _wait_for_host(self, host):
+        with self._host_lock:
+            _, next_request_time = self._host_status.get(host, (0, 0))
+        delay = next_request_time - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+    def _record_host_failure(self, host):
+        with self._host_lock:
+            failures, _ = self._host_status.get(host, (0, 0))
+            failures += 1
+            delay = min(self.max_backoff, self.backoff * 2 ** (failures - 1)) * random.uniform(1, 1.2)
+            self._host_status[host] = (failures, time.time() + delay)
+        return delay
+
+    def _record_host_success(self, host):
+        with self._host_lock:
+            self._host_status.pop(host, None)
+
+    def _transfer(self, url, partial_file):
+        """
+        Download url into partial_file, resuming from its current content, and return the MD5 of the whole file.
+        """
+        md5 = hashlib.md5()
+        offset = os.path.getsize(partial_file) if os.path.exists(partial_file) else 0
+        headers = {'Range': f'bytes={offset}-'} if offset else {}
+        with self.session.get(url, headers=headers, stream=True, timeout=self.timeout) as response:
+            if offset and response.status_code == 416:
+                # The partial file already contains the whole content
+                return update_md5_from_file(md5, partial_file).hexdigest()
+            response.raise_for_status()
+            # The server can ignore the Range header and send the whole file
+            if response.status_code == 206:
+                update_md5_from_file(md5, partial_file)
+                mode = 'ab'
+            else:
+                mode = 'wb'
+            with open(partial_file, mode) as open_file:
+                for chunk in response.iter_content(chunk_size=self.chunk_size):
+                    open_file.write(chunk)
+                    md5.update(chunk)
+        return md5.hexdigest()
+
+    def download_file(self, url, target_file, expected_md5=None):
+        """
+        Download url to target_file, retrying and resuming the transfer up to max_attempts times.
+        If expected_md5 is provided, a file with a different MD5 is discarded and downloaded again.
+        """
+        host = urlparse(url).netloc
+        partial_file = target_file + '.part'
+        attempt = 0
+        while True:
+            attempt += 1
+            self._wait_for_host(host)
+            try:
+                md5 = self._transfer(url, partial_file)
+                if expected_md5 and md5 != expected_md5.lower():
+                    os.remove(partial_file)
+                    raise ChecksumMismatchError(f'MD5 of {url} is {md5} instead of {expected_md5}')
+                break
+            except (requests.RequestException, OSError, ChecksumMismatchError) as e:
+                if is_permanent_error(e):
+                    logger.error(f'Could not download {url}: {e}')
+                    raise
+                delay = self._record_host_failure(host)
+                if attempt >= self.max_attempts:
+                    logger.error(f'Could not download {url} after {attempt} attempts: {e}')
+                    raise
+                logger.warning(f'Download of {url} failed ({e}). Resume in {delay:.0f}s')
+        self._record_host_success(host)
+        os.replace(partial_file, target_file)
+        return target_file
+
+    def download_files(self, urls_and_files):
+        """
+        Download each (url, target_file, expected_md5) concurrently and yield (url, target_file, exception) as each
+        download ends. expected_md5 can be None and exception is None when the download succeeded.
+        """
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            downloads = {executor.submit(self.download_file, url, target_file, expected_md5): (url, target_file)
+                         for url, target_file, expected_md5 in urls_and_files}
+            for download in as_completed(downloads):
+                url, target_file = downloads[download]
+                yield url, target_file, download.exception()
+
+
+def is_permanent_error(error):
+    """
+    Client errors such as a missing file will not be solved by retrying, apart from timeouts and rate limiting.
+    """
+    return isinstance(error, requests.HTTPError) and error.response is not None and \
+        400 <= error.response.status_code < 500 and error.response.status_code not in (408, 429)
@@ -25,8 +25,13 @@ from ebi_eva_common_pyutils.logger import logging_config
 from ebi_eva_common_pyutils.spring_properties import SpringPropertiesGenerator
 
 from covid19dp_submission import NEXTFLOW_DIR
+from covid19dp_submission.analysis_registry import get_analysis_registry
 from covid19dp_submission.download_analyses import download_analyses
-from covid19dp_submission.steps.vcf_vertical_concat.run_vcf_vertical_concat_pipeline import get_concat_result_file_name
+from covid19dp_submission.local_workflow import run_local_workflow
+from covid19dp_submission.steps.vcf_vertical_concat.concat_planner import make_concat_plan, write_concat_plan
+from covid19dp_submission.steps.vcf_vertical_concat.run_vcf_vertical_concat_pipeline import \
+    get_concat_result_file_name, get_planned_concat_result_file_name
+from covid19dp_submission.vcf_summary import summarise_vcf_files
 
 logger = logging_config.get_logger(__name__)
 
@@ -41,7 +46,9 @@ def _create_required_dirs(config: dict):
                      config['submission']['concat_processing_dir'],
                      config['submission']['accession_output_dir'],
                      config['submission']['log_dir'],
-                     config['submission']['validation_dir']]
+                     config['submission']['validation_dir'],
+                     config['submission']['validation_cache_dir'],
+                     config['submission']['cumulative_dir']]
     for dir_name in required_dirs:
         os.makedirs(dir_name, exist_ok=True)
 
@@ -97,6 +104,10 @@ def _get_config(project: str, taxonomy_id: int, target_assembly: str, snapshot_n
     concat_processing_dir = os.path.join(download_target_dir, 'processed')
     log_dir = os.path.join(project_dir, '00_logs', snapshot_name)
     validation_dir = os.path.join(log_dir, 'validation')
+    # Validation results are cached across snapshots by the content of the files
+    validation_cache_dir = os.path.join(project_dir, 'validation_cache')
+    # Sorted and deduplicated variants of all the snapshots of the project
+    cumulative_dir = os.path.join(project_dir, 'cumulative')
     accession_output_dir = os.path.join(project_dir, '60_eva_public', snapshot_name)
     public_ftp_dir = os.path.join(config['submission']['public_ftp_dir'], project)
     config['submission'].update(
@@ -110,7 +121,8 @@ def _get_config(project: str, taxonomy_id: int, target_assembly: str, snapshot_n
          'clustering_properties_file': clustering_properties_file,
          'release_properties_file': release_properties_file,
          'public_ftp_dir': public_ftp_dir,
-         'log_dir': log_dir, 'validation_dir': validation_dir
+         'log_dir': log_dir, 'validation_dir': validation_dir, 'validation_cache_dir': validation_cache_dir,
+         'cumulative_dir': cumulative_dir
          })
     config['executable']['python'] = {'interpreter': sys.executable,
                                       'script_path': os.path.dirname(inspect.getmodule(sys.modules[__name__]).__file__)}
@@ -121,7 +133,8 @@ def _get_config(project: str, taxonomy_id: int, target_assembly: str, snapshot_n
 
 def ingest_covid19dp_submission(project: str, project_dir: str, num_analyses: int, processed_analyses_file: str,
                                 ignored_analyses_file: str, accepted_taxonomies: list, assembly: str,
-                                app_config_file: str, nextflow_config_file: str or None, resume: str or None):
+                                app_config_file: str, nextflow_config_file: str or None, resume: str or None,
+                                analysis_registry_db: str or None = None):
     process_new_snapshot = False
     if resume is None:
         snapshot_name = datetime.now().strftime("%Y_%m_%d_%H_%M_%S")
@@ -134,6 +147,35 @@ def ingest_covid19dp_submission(project: str, project_dir: str, num_analyses: in
     # Add default processing batch size
     if 'batch_size' not in config['submission']:
         config['submission']['batch_size'] = 100
+    # Add default number of CPUs used to process each batch
+    if 'batch_cpus' not in config['submission']:
+        config['submission']['batch_cpus'] = 1
+    # Validate each file then check, BGZip and index it in a single read unless the separate steps are asked
+    if 'preprocessing_mode' not in config['submission']:
+        config['submission']['preprocessing_mode'] = 'fused'
+    # Concatenate the files with the fixed tree of Nextflow processes unless the dynamic scheduler is asked
+    if 'concat_scheduler' not in config['submission']:
+        config['submission']['concat_scheduler'] = 'static'
+    if 'concat_workers' not in config['submission']:
+        config['submission']['concat_workers'] = 1
+    # Run the static tree as a nested Nextflow pipeline unless it is asked to run in the concat process
+    if 'concat_executor' not in config['submission']:
+        config['submission']['concat_executor'] = 'nextflow'
+    # Concatenate the files with bcftools unless the in-process merge is asked
+    if 'concat_engine' not in config['submission']:
+        config['submission']['concat_engine'] = 'bcftools'
+    # Concatenate concat_chunk_size files per batch unless the cost model planner is asked
+    if 'concat_planner' not in config['submission']:
+        config['submission']['concat_planner'] = 'fixed'
+    # The planner batches at most as many files as the fixed tree unless the nodes running the merges allow more
+    if 'concat_max_fan_in' not in config['submission']:
+        config['submission']['concat_max_fan_in'] = config['submission']['concat_chunk_size']
+    # Merge each snapshot into the cumulative VCF of the project only when asked
+    if 'cumulative_concat' not in config['submission']:
+        config['submission']['cumulative_concat'] = False
+    # Run the submission workflow with Nextflow unless the asyncio orchestrator in this process is asked
+    if 'workflow_backend' not in config['submission']:
+        config['submission']['workflow_backend'] = 'nextflow'
     if process_new_snapshot:
         _create_required_dirs(config)
     else:
@@ -144,23 +186,47 @@ def ingest_covid19dp_submission(project: str, project_dir: str, num_analyses: in
     list_file = get_analyses_file_list(config['submission']['download_target_dir'])
     if len(list_file) < num_analyses:
         num_analyses = num_analyses - len(list_file)
-        download_analyses(project, num_analyses, processed_analyses_file, ignored_analyses_file, accepted_taxonomies,
-                          config['submission']['download_target_dir'], config['executable']['ascp_bin'],
-                          config['aspera']['aspera_id_dsa_key'], config.get('download_batch_size', 100))
+        with get_analysis_registry(processed_analyses_file, ignored_analyses_file, analysis_registry_db,
+                                   snapshot_name) as analysis_registry:
+            download_analyses(project, num_analyses, processed_analyses_file, ignored_analyses_file,
+                              accepted_taxonomies, config['submission']['download_target_dir'],
+                              config['executable']['ascp_bin'], config['aspera']['aspera_id_dsa_key'],
+                              config.get('download_batch_size', 100), analysis_registry,
+                              config['submission'].get('delta_fetch', False),
+                              config['submission'].get('full_sweep_interval_days', 7),
+                              config.get('download_concurrent_transfers', 1),
+                              config.get('download_bandwidth_mbps', 300),
+                              config.get('download_http_workers', 8))
     else:
         logger.info(f'All {num_analyses} analysis have been downloaded already. Skipping.')
     vcf_files_to_be_downloaded = create_download_file_list(config)
     if len(vcf_files_to_be_downloaded) == 0:
         logger.info("No files to process, done.")
         return
-    config['submission']['concat_result_file'] = get_concat_result_file_name(
-        config['submission']['concat_processing_dir'],
-        len(vcf_files_to_be_downloaded),
-        config['submission']['concat_chunk_size']
-    )
+    # Summarise the files that were not summarised when they were downloaded, e.g. by a previous version
+    summarise_vcf_files(vcf_files_to_be_downloaded)
+    if config['submission']['concat_planner'] == 'cost_model':
+        # The plan is kept outside the concatenation directory, which is cleared before each concatenation
+        concat_plan_file = os.path.join(config['submission']['download_target_dir'], 'concat_plan.json')
+        concat_plan = make_concat_plan(vcf_files_to_be_downloaded, config['submission']['concat_max_fan_in'],
+                                       nextflow_config_file, config['submission'].get('concat_cost_model'))
+        write_concat_plan(concat_plan, concat_plan_file)
+        config['submission']['concat_plan_file'] = concat_plan_file
+        config['submission']['concat_result_file'] = get_planned_concat_result_file_name(
+            config['submission']['concat_processing_dir'], concat_plan)
+    else:
+        config['submission']['concat_result_file'] = get_concat_result_file_name(
+            config['submission']['concat_processing_dir'],
+            len(vcf_files_to_be_downloaded),
+            config['submission']['concat_chunk_size']
+        )
 
     nextflow_file_to_run = os.path.join(NEXTFLOW_DIR, 'submission_workflow.nf')
     yaml.safe_dump(config, open(config['executable']['nextflow_param_file'], "w"))
+    if config['submission']['workflow_backend'] == 'local':
+        # Checkpoints of the steps replace the Nextflow cache when resuming
+        run_local_workflow(config, resume=resume is not None)
+        return
 
     # run the nextflow script in the download directory so that each execution is independent
     run_nextflow_command = (f"cd {config['submission']['download_target_dir']}; " 
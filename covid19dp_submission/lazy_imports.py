@@ -0,0 +1,63 @@
+# Copyright 2022 EMBL - European Bioinformatics Institute
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Stand-ins for the parts of ebi_eva_common_pyutils used by the steps, which only import it when they are first used.
+ebi_eva_common_pyutils.logger alone imports asyncio, so importing it with the modules of the steps slows down the
+start of every step, including the ones that exit on an argument error.
+"""
+
+# Modules that the steps import when they first use them rather than when they start. A process that keeps the steps
+# imported, like the step server, imports them explicitly to have them ready.
+DEFERRED_MODULES = ['ebi_eva_common_pyutils.command_utils', 'ebi_eva_common_pyutils.logger',
+                    'ebi_eva_common_pyutils.nextflow', 'more_itertools', 'numpy']
+
+
+class LazyLogger:
+    """
+    Logger of the logging_config of ebi_eva_common_pyutils, created when it first logs. It then gets the handlers
+    added to logging_config until then, like a logger created at import time would have.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._logger = None
+
+    def __getattr__(self, attribute):
+        if self._logger is None:
+            from ebi_eva_common_pyutils.logger import logging_config as eva_logging_config
+            self._logger = eva_logging_config.get_logger(self.name)
+        return getattr(self._logger, attribute)
+
+
+class LazyLoggingConfig:
+    """
+    Same interface as ebi_eva_common_pyutils.logger.logging_config, whose loggers are only created when they log.
+    """
+
+    @staticmethod
+    def get_logger(name):
+        return LazyLogger(name)
+
+    def __getattr__(self, attribute):
+        from ebi_eva_common_pyutils.logger import logging_config as eva_logging_config
+        return getattr(eva_logging_config, attribute)
+
+
+logging_config = LazyLoggingConfig()
+
+
+def run_command_with_output(*args, **kwargs):
+    from ebi_eva_common_pyutils.command_utils import run_command_with_output as eva_run_command_with_output
+    return eva_run_command_with_output(*args, **kwargs)
@@ -0,0 +1,287 @@
+# Copyright 2022 EMBL - European Bioinformatics Institute
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Run the steps of submission_workflow.nf without Nextflow, as asyncio tasks of this process. Each step runs the same
+command as the Nextflow process of the same name, with the same logs.
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import shutil
+import time
+
+from ebi_eva_common_pyutils.logger import logging_config
+
+from covid19dp_submission import NEXTFLOW_DIR
+
+logger = logging_config.get_logger(__name__)
+
+BATCH_STAGES = ('validate_vcfs', 'asm_check_vcfs', 'bgzip_and_index', 'preprocess_vcfs')
+CHECKPOINT_SUFFIX = '.done'
+
+
+class WorkflowStepError(Exception):
+    pass
+
+
+def get_checkpoint_dir(params: dict) -> str:
+    return os.path.join(params['submission']['download_target_dir'], 'local_workflow')
+
+
+def get_stage_concurrency(params: dict) -> dict:
+    """
+    Return the maximum number of tasks of each stage running at the same time: as many batches as there are
+    batch_cpus in the machine for the stages processing batches of files and one task for the other stages, unless
+    they are set in local_workflow_concurrency.
+    """
+    batch_concurrency = max(1, (os.cpu_count() or 1) // params['submission'].get('batch_cpus', 1))
+    concurrency = {stage: batch_concurrency for stage in BATCH_STAGES}
+    concurrency.update(params['submission'].get('local_workflow_concurrency') or {})
+    return concurrency
+
+
+class LocalSubmissionWorkflow:
+    """
+    The DAG of submission_workflow.nf: the batches of files go through the preprocessing steps independently, each
+    batch moving to its next step as soon as the previous ones are done, then the concatenation and the following
+    steps run one after the other, with the update of the cumulative VCF alongside the accessioning.
+    A checkpoint file is written for each step that succeeds. With resume, the steps whose checkpoint matches their
+    command are not run again. Like Nextflow with errorStrategy 'finish', no step is started after a failure but the
+    running steps are left to finish.
+    """
+
+    def __init__(self, params: dict, resume: bool = False):
+        self.params = params
+        self.submission = params['submission']
+        self.executable = params['executable']
+        self.resume = resume
+        self.checkpoint_dir = get_checkpoint_dir(params)
+        self.normalised_vcf_dir = os.path.join(self.submission['download_target_dir'], 'normalised_vcfs')
+        self.refseq_fasta = os.path.join(self.submission['download_target_dir'], 'refseq_fasta.fa')
+        self.semaphores = {}
+        self.concurrency = get_stage_concurrency(params)
+        self.failure = None
+        self.num_skipped = 0
+
+    def _get_semaphore(self, stage):
+        if stage not in self.semaphores:
+            self.semaphores[stage] = asyncio.Semaphore(self.concurrency.get(stage, 1))
+        return self.semaphores[stage]
+
+    def _python_step(self, module, args: dict, log_name):
+        args_repr = ' '.join(f'--{arg} {value}' for arg, value in args.items() if value is not None)
+        return (f"{self.executable['python']['interpreter']} -m step_client {module} {args_repr} "
+                f">> {os.path.join(self.submission['log_dir'], log_name)} 2>&1")
+
+    def _checkpoint_file(self, task_name):
+        return os.path.join(self.checkpoint_dir, task_name + CHECKPOINT_SUFFIX)
+
+    @staticmethod
+    def _command_hash(command):
+        return hashlib.sha256(command.encode()).hexdigest()
+
+    def _is_done(self, task_name, command):
+        try:
+            with open(self._checkpoint_file(task_name)) as open_file:
+                return json.load(open_file)['command_sha256'] == self._command_hash(command)
+        except (OSError, ValueError, KeyError):
+            return False
+
+    def _write_checkpoint(self, task_name, command, duration):
+        checkpoint_file = self._checkpoint_file(task_name)
+        with open(checkpoint_file + '.tmp', 'w') as open_file:
+            json.dump({'command_sha256': self._command_hash(command), 'duration': duration,
+                       'completed': time.time()}, open_file)
+        os.replace(checkpoint_file + '.tmp', checkpoint_file)
+
+    async def run_task(self, stage, task_name, command):
+        if self.resume and self._is_done(task_name, command):
+            logger.info(f'{task_name} was completed by a previous run')
+            self.num_skipped += 1
+            return
+        async with self._get_semaphore(stage):
+            if self.failure is not None:
+                raise WorkflowStepError(f'{task_name} not started after the failure of {self.failure}')
+            logger.info(f'Starting {task_name}')
+            start_time = time.time()
+            env = {**os.environ, 'PYTHONPATH': self.executable['python']['script_path']}
+            process = await asyncio.create_subprocess_shell(command, env=env,
+                                                            cwd=self.submission['download_target_dir'])
+            return_code = await process.wait()
+            duration = time.time() - start_time
+            if return_code != 0:
+                self.failure = self.failure or task_name
+                raise WorkflowStepError(f'{task_name} failed with exit code {return_code} after {duration:.1f}s: '
+                                        f'{command}')
+            self._write_checkpoint(task_name, command, duration)
+            logger.info(f'{task_name} completed in {duration:.1f}s')
+
+    @staticmethod
+    async def gather(*coroutines):
+        # Wait for all the tasks, including the ones still running after a failure, then report the first failure
+        results = await asyncio.gather(*coroutines, return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+
+    def read_batches(self):
+        with open(self.submission['download_file_list']) as open_file:
+            vcf_files = [line.strip().split(',')[0] for line in open_file if line.strip()]
+        batch_size = self.submission['batch_size']
+        return [vcf_files[start:start + batch_size] for start in range(0, len(vcf_files), batch_size)]
+
+    def _batch_task_name(self, stage, vcf_files):
+        # The name depends on the files so that a checkpoint never applies to another batch
+        return f"{stage}_{hashlib.md5(' '.join(vcf_files).encode()).hexdigest()[:12]}"
+
+    async def preprocess_batch(self, vcf_files):
+        files = ' '.join(vcf_files)
+        batch_cpus = self.submission['batch_cpus']
+        if self.submission['preprocessing_mode'] == 'separate':
+            await self.gather(
+                self.run_task('validate_vcfs', self._batch_task_name('validate_vcfs', vcf_files), self._python_step(
+                    'steps.run_vcf_validator',
+                    {'vcf-file': files, 'validator-binary': self.executable['vcf_validator'],
+                     'output-dir': self.submission['validation_dir'], 'num-workers': batch_cpus,
+                     'cache-dir': self.submission['validation_cache_dir']}, 'validate_vcfs.log')),
+                self.run_task('asm_check_vcfs', self._batch_task_name('asm_check_vcfs', vcf_files), self._python_step(
+                    'steps.run_asm_checker',
+                    {'vcf-file': files, 'assembly-checker-binary': self.executable['vcf_assembly_checker'],
+                     'assembly-report': self.submission['assembly_report'],
+                     'assembly-fasta': self.submission['assembly_fasta'],
+                     'output-dir': self.submission['validation_dir'], 'num-workers': batch_cpus,
+                     'cache-dir': self.submission['validation_cache_dir']}, 'asm_check_vcfs.log'))
+            )
+            await self.run_task('bgzip_and_index', self._batch_task_name('bgzip_and_index', vcf_files),
+                                self._python_step('steps.bgzip_and_index_vcf',
+                                                  {'vcf-file': files,
+                                                   'output-dir': self.submission['download_target_dir'],
+                                                   'bcftools-binary': self.executable['bcftools'],
+                                                   'num-workers': batch_cpus}, 'bgzip_and_index_vcfs.log'))
+        else:
+            await self.run_task('preprocess_vcfs', self._batch_task_name('preprocess_vcfs', vcf_files),
+                                self._python_step(
+                                    'steps.preprocess_vcfs',
+                                    {'vcf-file': files, 'output-dir': self.submission['download_target_dir'],
+                                     'validation-dir': self.submission['validation_dir'],
+                                     'validator-binary': self.executable['vcf_validator'],
+                                     'assembly-checker-binary': self.executable['vcf_assembly_checker'],
+                                     'assembly-report': self.submission['assembly_report'],
+                                     'assembly-fasta': self.submission['assembly_fasta'],
+                                     'num-workers': batch_cpus,
+                                     'cache-dir': self.submission['validation_cache_dir']}, 'preprocess_vcfs.log'))
+
+    def _normalised_concat_vcf(self):
+        return os.path.join(self.normalised_vcf_dir, os.path.basename(self.submission['concat_result_file']))
+
+    async def accession_and_release(self):
+        await self.run_task('accession_vcf', 'accession_vcf', self._python_step(
+            'steps.accession_vcf',
+            {'vcf-file': self._normalised_concat_vcf(),
+             'accessioning-jar-file': self.params['jar']['accession_pipeline'],
+             'accessioning-properties-file': self.submission['accessioning_properties_file'],
+             'accessioning-instance': self.submission['accessioning_instance'],
+             'output-vcf-file': self.submission['accession_output_file'],
+             'bcftools-binary': self.executable['bcftools']}, 'accession_vcf.log'))
+        public_ftp_dir = self.submission['public_ftp_dir']
+        await self.run_task('sync_accessions_to_public_ftp', 'sync_accessions_to_public_ftp',
+                            f"mkdir -p {public_ftp_dir} && (rsync -av {self.submission['accession_output_dir']}/* "
+                            f"{public_ftp_dir}) >> {self.submission['log_dir']}/sync_accessions_to_public_ftp.log 2>&1")
+        await self.run_task('cluster_assembly', 'cluster_assembly', self._python_step(
+            'steps.cluster_assembly',
+            {'clustering-jar-file': self.params['jar']['clustering_pipeline'],
+             'clustering-properties-file': self.submission['clustering_properties_file'],
+             'accessioning-instance': self.submission['clustering_instance']}, 'cluster_assembly.log'))
+        memory_in_gb = self.submission['memory_for_incremental_release_in_gb']
+        await self.run_task('incremental_release', 'incremental_release',
+                            f"(java -Xmx{memory_in_gb}g -jar {self.params['jar']['release_pipeline']} "
+                            f"--spring.config.location={self.submission['release_properties_file']} "
+                            f"--parameters.accessionedVcf=\"{self.submission['accession_output_file']}.gz\") "
+                            f">> {self.submission['log_dir']}/incremental_release.log 2>&1")
+
+    async def run(self):
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+        await self.gather(
+            self.run_task('create_refseq_fasta', 'create_refseq_fasta',
+                          f"sed s/MN908947.3/NC_045512.2/g {self.submission['assembly_fasta']} > {self.refseq_fasta}"),
+            *(self.preprocess_batch(vcf_files) for vcf_files in self.read_batches())
+        )
+        await self.run_task('vertical_concat', 'vertical_concat', self._python_step(
+            'steps.vcf_vertical_concat.run_vcf_vertical_concat_pipeline',
+            {'toplevel-vcf-dir': self.normalised_vcf_dir,
+             'concat-processing-dir': self.submission['concat_processing_dir'],
+             'concat-chunk-size': self.submission['concat_chunk_size'],
+             'bcftools-binary': self.executable['bcftools'], 'nextflow-binary': self.executable['nextflow'],
+             'nextflow-config-file': self.executable['nextflow_config_file'],
+             'scheduler': self.submission['concat_scheduler'], 'engine': self.submission['concat_engine'],
+             'executor': self.submission['concat_executor'],
+             'concat-plan-file': self.submission.get('concat_plan_file'),
+             'num-workers': self.submission['concat_workers']}, 'vertical_concat.log'))
+        concat_result_file = self.submission['concat_result_file']
+        await self.run_task('normalise_concat_vcf', 'normalise_concat_vcf', self._python_step(
+            'steps.normalise_vcfs',
+            {'vcf-files': concat_result_file, 'input-dir': os.path.dirname(concat_result_file),
+             'output-dir': self.normalised_vcf_dir, 'bcftools-binary': self.executable['bcftools'],
+             'refseq-fasta-file': self.refseq_fasta}, 'normalise_concat_vcf.log'))
+        final_steps = [self.accession_and_release()]
+        if self.submission.get('cumulative_concat'):
+            final_steps.append(self.run_task('cumulative_concat', 'cumulative_concat', self._python_step(
+                'steps.vcf_vertical_concat.cumulative_concat',
+                {'cumulative-dir': self.submission['cumulative_dir'], 'vcf-file': self._normalised_concat_vcf(),
+                 'snapshot-name': self.submission['snapshot_name']}, 'cumulative_concat.log')))
+        await self.gather(*final_steps)
+
+
+def run_local_workflow(params: dict, resume: bool = False):
+    """
+    Run the submission workflow described by the Nextflow params in this process. Without resume, the checkpoints
+    of a previous run are removed first.
+    """
+    workflow_file = os.path.join(NEXTFLOW_DIR, 'submission_workflow.nf')
+    if not resume:
+        shutil.rmtree(get_checkpoint_dir(params), ignore_errors=True)
+    start_time = time.time()
+    workflow = LocalSubmissionWorkflow(params, resume)
+    logger.info(f'Starting local run of {workflow_file} with stage concurrency {workflow.concurrency}')
+    try:
+        asyncio.run(workflow.run())
+    except WorkflowStepError:
+        logger.error(f'Local run of {workflow_file} failed! Refer to the logs in {params["submission"]["log_dir"]}')
+        raise
+    # Same message as a successful Nextflow run, which the scripts around the ingestion look for
+    logger.info(f'Local run of {workflow_file} in {time.time() - start_time:.1f}s '
+                f'({workflow.num_skipped} steps completed by a previous run) - completed successfully')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the submission workflow without Nextflow',
+                                     formatter_class=argparse.RawTextHelpFormatter, add_help=False)
+    parser.add_argument("--params-file", help="Full path to the Nextflow params file written by the ingestion",
+                        required=True)
+    parser.add_argument("--resume", help="Do not run again the steps completed by a previous run",
+                        action='store_true', required=False)
+    args = parser.parse_args()
+    logging_config.add_stdout_handler()
+    import yaml
+    with open(args.params_file) as open_file:
+        params = yaml.safe_load(open_file)
+    run_local_workflow(params, args.resume)
+
+
+if __name__ == "__main__":
+    main()
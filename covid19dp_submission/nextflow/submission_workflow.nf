@@ -2,6 +2,11 @@ nextflow.enable.dsl=2
 
 params.NORMALISED_VCF_DIR = "${params.submission.download_target_dir}/normalised_vcfs"
 params.REFSEQ_FASTA = "${params.submission.download_target_dir}/refseq_fasta.fa"
+// The stages of the vertical concatenation follow the plan of the cost model planner when there is one
+params.CONCAT_PLAN_OPTION = params.submission.concat_plan_file ? "--concat-plan-file ${params.submission.concat_plan_file}" : ""
+
+// The steps are run through step_client, which hands them to the step server named by STEP_SERVER_SOCKET if it is
+// running and runs them directly otherwise
 
 // This is needed because "bcftools norm" step requires a FASTA
 // but the VCFs we get from Covid19 data team only have RefSeq contigs
@@ -17,6 +22,7 @@ process create_refseq_fasta {
 }
 
 process validate_vcfs {
+    cpus params.submission.batch_cpus
 
     input:
     path vcf_files
@@ -28,15 +34,18 @@ process validate_vcfs {
     """
     export PYTHONPATH="$params.executable.python.script_path"
     ($params.executable.python.interpreter \
-        -m steps.run_vcf_validator \
+        -m step_client steps.run_vcf_validator \
         --vcf-file  $vcf_files \
         --validator-binary $params.executable.vcf_validator \
         --output-dir $params.submission.validation_dir \
+        --num-workers ${task.cpus} \
+        --cache-dir $params.submission.validation_cache_dir \
     ) >> $params.submission.log_dir/validate_vcfs.log 2>&1
     """
 }
 
 process asm_check_vcfs {
+    cpus params.submission.batch_cpus
 
     input:
     path vcf_files
@@ -48,17 +57,20 @@ process asm_check_vcfs {
     """
     export PYTHONPATH="$params.executable.python.script_path"
     ($params.executable.python.interpreter \
-        -m steps.run_asm_checker \
+        -m step_client steps.run_asm_checker \
         --vcf-file  $vcf_files \
         --assembly-checker-binary $params.executable.vcf_assembly_checker \
         --assembly-report $params.submission.assembly_report \
         --assembly-fasta $params.submission.assembly_fasta \
         --output-dir $params.submission.validation_dir \
+        --num-workers ${task.cpus} \
+        --cache-dir $params.submission.validation_cache_dir \
     ) >> $params.submission.log_dir/asm_check_vcfs.log 2>&1
     """
 }
 
 process bgzip_and_index {
+    cpus params.submission.batch_cpus
 
     input:
     val flag1
@@ -72,15 +84,46 @@ process bgzip_and_index {
     """
     export PYTHONPATH="$params.executable.python.script_path"
     ($params.executable.python.interpreter \
-        -m steps.bgzip_and_index_vcf \
+        -m step_client steps.bgzip_and_index_vcf \
         --vcf-file  $vcf_files \
         --output-dir $params.submission.download_target_dir \
         --bcftools-binary $params.executable.bcftools \
+        --num-workers ${task.cpus} \
     ) >> $params.submission.log_dir/bgzip_and_index_vcfs.log 2>&1
     """
 }
 
+// Single read of each file replacing validate_vcfs, asm_check_vcfs and bgzip_and_index
+process preprocess_vcfs {
+    cpus params.submission.batch_cpus
+
+    input:
+    path vcf_files
+
+    output:
+    val true, emit: preprocess_vcfs_success
+
+    script:
+    """
+    export PYTHONPATH="$params.executable.python.script_path"
+    ($params.executable.python.interpreter \
+        -m step_client steps.preprocess_vcfs \
+        --vcf-file  $vcf_files \
+        --output-dir $params.submission.download_target_dir \
+        --validation-dir $params.submission.validation_dir \
+        --validator-binary $params.executable.vcf_validator \
+        --assembly-checker-binary $params.executable.vcf_assembly_checker \
+        --assembly-report $params.submission.assembly_report \
+        --assembly-fasta $params.submission.assembly_fasta \
+        --num-workers ${task.cpus} \
+        --cache-dir $params.submission.validation_cache_dir \
+    ) >> $params.submission.log_dir/preprocess_vcfs.log 2>&1
+    """
+}
+
 process vertical_concat {
+    cpus params.submission.concat_workers
+
     input:
     val flag
 
@@ -91,13 +134,18 @@ process vertical_concat {
     """
     export PYTHONPATH="$params.executable.python.script_path"
     ($params.executable.python.interpreter \
-        -m steps.vcf_vertical_concat.run_vcf_vertical_concat_pipeline \
+        -m step_client steps.vcf_vertical_concat.run_vcf_vertical_concat_pipeline \
         --toplevel-vcf-dir $params.NORMALISED_VCF_DIR \
         --concat-processing-dir $params.submission.concat_processing_dir \
         --concat-chunk-size $params.submission.concat_chunk_size \
         --bcftools-binary $params.executable.bcftools \
         --nextflow-binary $params.executable.nextflow \
         --nextflow-config-file $params.executable.nextflow_config_file \
+        --scheduler $params.submission.concat_scheduler \
+        --engine $params.submission.concat_engine \
+        --executor $params.submission.concat_executor \
+        $params.CONCAT_PLAN_OPTION \
+        --num-workers ${task.cpus} \
     ) >> $params.submission.log_dir/vertical_concat.log 2>&1
     """
 }
@@ -114,7 +162,7 @@ process normalise_concat_vcf {
     """
     export PYTHONPATH="$params.executable.python.script_path"
     ($params.executable.python.interpreter \
-        -m steps.normalise_vcfs \
+        -m step_client steps.normalise_vcfs \
         --vcf-files  $params.submission.concat_result_file \
         --input-dir `dirname ${params.submission.concat_result_file}` \
         --output-dir $params.NORMALISED_VCF_DIR \
@@ -124,6 +172,27 @@ process normalise_concat_vcf {
     """
 }
 
+process cumulative_concat {
+
+    input:
+    val flag
+
+    output:
+    val true, emit: cumulative_concat_success
+
+    script:
+    """
+    export PYTHONPATH="$params.executable.python.script_path"
+    export NORMALISED_CONCAT_VCF=("${params.NORMALISED_VCF_DIR}/"`basename ${params.submission.concat_result_file}`)
+    ($params.executable.python.interpreter \
+        -m step_client steps.vcf_vertical_concat.cumulative_concat \
+        --cumulative-dir $params.submission.cumulative_dir \
+        --vcf-file \$NORMALISED_CONCAT_VCF \
+        --snapshot-name $params.submission.snapshot_name \
+    ) >> $params.submission.log_dir/cumulative_concat.log 2>&1
+    """
+}
+
 process accession_vcf {
     clusterOptions "-g /accession/$params.submission.accessioning_instance"
 
@@ -139,7 +208,7 @@ process accession_vcf {
     export PYTHONPATH="$params.executable.python.script_path"
     export NORMALISED_CONCAT_VCF=("${params.NORMALISED_VCF_DIR}/"`basename ${params.submission.concat_result_file}`)
     ($params.executable.python.interpreter \
-        -m steps.accession_vcf \
+        -m step_client steps.accession_vcf \
         --vcf-file \$NORMALISED_CONCAT_VCF \
         --accessioning-jar-file $params.jar.accession_pipeline \
         --accessioning-properties-file $params.submission.accessioning_properties_file \
@@ -181,7 +250,7 @@ process cluster_assembly {
     """
     export PYTHONPATH="$params.executable.python.script_path"
     ($params.executable.python.interpreter \
-        -m steps.cluster_assembly \
+        -m step_client steps.cluster_assembly \
         --clustering-jar-file $params.jar.clustering_pipeline \
         --clustering-properties-file $params.submission.clustering_properties_file \
         --accessioning-instance $params.submission.clustering_instance \
@@ -218,9 +287,20 @@ workflow  {
                .map(row -> row[0])
                .buffer( size:params.submission.batch_size, remainder: true )
                .set{vcf_files_list}
-        validate_vcfs(vcf_files_list)
-        asm_check_vcfs(vcf_files_list)
-        bgzip_and_index(validate_vcfs.out.validate_vcfs_success, asm_check_vcfs.out.asm_check_vcfs_success, vcf_files_list)
-        vertical_concat(bgzip_and_index.out.bgzip_and_index_success.collect()) | \
-        normalise_concat_vcf | accession_vcf | sync_accessions_to_public_ftp | cluster_assembly | incremental_release
+        if (params.submission.preprocessing_mode == 'separate') {
+            validate_vcfs(vcf_files_list)
+            asm_check_vcfs(vcf_files_list)
+            bgzip_and_index(validate_vcfs.out.validate_vcfs_success, asm_check_vcfs.out.asm_check_vcfs_success, vcf_files_list)
+            preprocessing_success = bgzip_and_index.out.bgzip_and_index_success
+        } else {
+            preprocess_vcfs(vcf_files_list)
+            preprocessing_success = preprocess_vcfs.out.preprocess_vcfs_success
+        }
+        vertical_concat(preprocessing_success.collect()) | normalise_concat_vcf
+        normalise_concat_vcf.out.normalise_concat_vcf_success | \
+        accession_vcf | sync_accessions_to_public_ftp | cluster_assembly | incremental_release
+        // The cumulative VCF of the project is updated alongside the accessioning of the snapshot
+        if (params.submission.cumulative_concat) {
+            cumulative_concat(normalise_concat_vcf.out.normalise_concat_vcf_success)
+        }
 }
@@ -0,0 +1,141 @@
+# Copyright 2022 EMBL - European Bioinformatics Institute
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import re
+
+from covid19dp_submission.lazy_imports import logging_config
+from covid19dp_submission.reference_fasta import MemoryMappedFasta, read_assembly_report_aliases
+from covid19dp_submission.vcf_reader import iter_data_lines
+
+logger = logging_config.get_logger(__name__)
+
+# REF alleles that can be compared base by base with the reference
+CHECKABLE_REF = re.compile(rb'^[ACGTN]+$', re.IGNORECASE)
+
+
+class UndecidableFileError(Exception):
+    pass
+
+
+class RefCheckResult:
+
+    def __init__(self, vcf_file, num_records=0, num_matches=0, undecidable_reason=None):
+        self.vcf_file = vcf_file
+        self.num_records = num_records
+        self.num_matches = num_matches
+        self.undecidable_reason = undecidable_reason
+
+    @property
+    def passed(self):
+        return self.undecidable_reason is None and self.num_matches == self.num_records
+
+    @property
+    def match_percentage(self):
+        return 100 * self.num_matches / self.num_records if self.num_records else 100
+
+
+class ReferenceAlleleChecker:
+    """
+    Check the REF alleles of VCF files against a memory-mapped FASTA. Contigs can be named like any of the names of
+    the sequence in the assembly report as long as it has a GenBank accession, like vcf_assembly_checker
+    --require-genbank expects. Files with records that cannot be checked this way are reported as undecidable.
+    """
+
+    def __init__(self, assembly_fasta, assembly_report):
+        self.reference = MemoryMappedFasta(assembly_fasta)
+        self.aliases = read_assembly_report_aliases(assembly_report, set(self.reference.contig_names))
+
+    def parse_record(self, line: bytes) -> tuple:
+        """
+        Return the contig, 0-based start and REF of a VCF data line.
+        """
+        fields = line.split(b'\t', 4)
+        if len(fields) < 5:
+            raise UndecidableFileError(f'Malformed record {line[:100]}')
+        chrom, pos, _, ref = fields[:4]
+        contig = self.aliases.get(chrom.decode(errors='replace'))
+        if contig is None:
+            raise UndecidableFileError(f'Contig {chrom.decode(errors="replace")} not found in the assembly report')
+        if not pos.isdigit() or not CHECKABLE_REF.match(ref):
+            raise UndecidableFileError(f'Record cannot be checked {line[:100]}')
+        start = int(pos) - 1
+        if start < 0 or start + len(ref) > len(self.reference.get_sequence_array(contig)):
+            raise UndecidableFileError(f'Record outside of contig {contig}: {line[:100]}')
+        return contig, start, ref.upper()
+
+    def check_files(self, vcf_files) -> list:
+        """
+        Check the REF alleles of all the records of vcf_files and return a RefCheckResult per file.
+        """
+        results_and_records = []
+        for vcf_file in vcf_files:
+            try:
+                records = [self.parse_record(line) for line in iter_data_lines(vcf_file)]
+                results_and_records.append((RefCheckResult(vcf_file, num_records=len(records)), records))
+            except (UndecidableFileError, OSError, EOFError, ValueError) as e:
+                results_and_records.append((RefCheckResult(vcf_file, undecidable_reason=str(e)), []))
+        return self.check_records(results_and_records)
+
+    def check_records(self, results_and_records: list) -> list:
+        """
+        Count the matching REF alleles of the records parsed from each file, given as (RefCheckResult, records)
+        pairs, with one vectorised comparison per contig. Return the results.
+        """
+        results = [result for result, _ in results_and_records]
+        # Records of all the files, with the index of the file they come from
+        contigs, starts, refs, file_indices = [], [], [], []
+        for index, (_, records) in enumerate(results_and_records):
+            for contig, start, ref in records:
+                contigs.append(contig)
+                starts.append(start)
+                refs.append(ref)
+            file_indices.extend([index] * len(records))
+        if not refs:
+            return results
+
+        import numpy as np
+        contigs = np.array(contigs)
+        starts = np.array(starts, dtype=np.int64)
+        lengths = np.array([len(ref) for ref in refs], dtype=np.int64)
+        ref_bases = np.frombuffer(b''.join(refs), dtype=np.uint8)
+        file_indices = np.array(file_indices, dtype=np.int64)
+        # Offset of the first base of each record in ref_bases
+        record_offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+        matches = np.zeros(len(refs), dtype=bool)
+        for contig in np.unique(contigs):
+            in_contig = np.flatnonzero(contigs == contig)
+            contig_lengths = lengths[in_contig]
+            # Position of every REF base in the contig and in ref_bases
+            base_offsets = np.arange(contig_lengths.sum()) - np.repeat(np.cumsum(contig_lengths) - contig_lengths,
+                                                                       contig_lengths)
+            reference_positions = np.repeat(starts[in_contig], contig_lengths) + base_offsets
+            ref_positions = np.repeat(record_offsets[in_contig], contig_lengths) + base_offsets
+            base_matches = self.reference.get_sequence_array(contig)[reference_positions] == ref_bases[ref_positions]
+            # A record matches if all its bases match
+            matches[in_contig] = np.logical_and.reduceat(base_matches,
+                                                         np.cumsum(contig_lengths) - contig_lengths)
+        num_matches_per_file = np.bincount(file_indices, weights=matches, minlength=len(results))
+        for index, result in enumerate(results):
+            if result.undecidable_reason is None:
+                result.num_matches = int(num_matches_per_file[index])
+        return results
+
+    def close(self):
+        self.reference.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
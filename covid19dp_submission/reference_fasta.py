@@ -0,0 +1,165 @@
+# Copyright 2022 EMBL - European Bioinformatics Institute
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mmap
+import os
+
+from covid19dp_submission.lazy_imports import logging_config
+
+logger = logging_config.get_logger(__name__)
+
+
+def get_fasta_index_file(fasta_file):
+    return fasta_file + '.fai'
+
+
+def compute_fasta_index(fasta_file) -> dict:
+    """
+    Return the (length, offset of the first base, bases per line, bytes per line) of each sequence of fasta_file,
+    like samtools faidx records them.
+    """
+    fasta_index = {}
+    current_entry = None
+    offset = 0
+    with open(fasta_file, 'rb') as open_file:
+        for line in open_file:
+            line_length = len(line)
+            if line.startswith(b'>'):
+                current_entry = [0, offset + line_length, 0, 0]
+                fasta_index[line[1:].split()[0].decode()] = current_entry
+            elif current_entry is not None:
+                bases = len(line.rstrip(b'\r\n'))
+                if current_entry[2] == 0:
+                    current_entry[2] = bases
+                    current_entry[3] = line_length
+                current_entry[0] += bases
+            offset += line_length
+    return {name: tuple(entry) for name, entry in fasta_index.items()}
+
+
+def index_fasta(fasta_file):
+    """
+    Write the samtools faidx index of fasta_file.
+    """
+    fai_file = get_fasta_index_file(fasta_file)
+    # Write to a temporary file first so that concurrent readers never see a partial index
+    with open(fai_file + '.tmp', 'w') as open_file:
+        for name, entry in compute_fasta_index(fasta_file).items():
+            open_file.write('\t'.join(str(value) for value in (name,) + entry) + '\n')
+    os.replace(fai_file + '.tmp', fai_file)
+    return fai_file
+
+
+def is_fasta_index_up_to_date(fasta_file):
+    fai_file = get_fasta_index_file(fasta_file)
+    return os.path.exists(fai_file) and os.path.getmtime(fai_file) >= os.path.getmtime(fasta_file)
+
+
+def ensure_fasta_index(fasta_file):
+    """
+    Index fasta_file unless it already has an index more recent than the FASTA, so that the tools reading it
+    concurrently don't all try to create the index at the same time.
+    """
+    if not is_fasta_index_up_to_date(fasta_file):
+        logger.info(f'Indexing reference {fasta_file}')
+        index_fasta(fasta_file)
+    return get_fasta_index_file(fasta_file)
+
+
+def read_fasta_index(fai_file) -> dict:
+    """
+    Return the (length, offset, bases per line, bytes per line) of each sequence listed in a .fai file.
+    """
+    fasta_index = {}
+    with open(fai_file) as open_file:
+        for line in open_file:
+            name, length, offset, line_bases, line_width = line.rstrip('\n').split('\t')[:5]
+            fasta_index[name] = (int(length), int(offset), int(line_bases), int(line_width))
+    return fasta_index
+
+
+def read_assembly_report_aliases(assembly_report, contig_names) -> dict:
+    """
+    Map every name of the sequences in the NCBI assembly report (sequence name, GenBank, RefSeq and UCSC names) to
+    the name used for the same sequence among contig_names. Sequences without a GenBank accession are left out.
+    """
+    aliases = {name: name for name in contig_names}
+    with open(assembly_report) as open_file:
+        for line in open_file:
+            if line.startswith('#') or not line.strip():
+                continue
+            columns = line.rstrip('\n').split('\t')
+            names = [name for name in (columns[0], columns[4], columns[6], columns[9] if len(columns) > 9 else 'na')
+                     if name and name != 'na']
+            contig_name = next((name for name in names if name in contig_names), None)
+            if contig_name is None or columns[4] in ('', 'na'):
+                continue
+            for name in names:
+                aliases.setdefault(name, contig_name)
+    return aliases
+
+
+class MemoryMappedFasta:
+    """
+    Read the sequences of a FASTA through a memory map. Each sequence is loaded once as an upper case NumPy array of
+    bytes, without its line breaks. The .fai index is used if it is up to date, otherwise the FASTA is indexed in
+    memory.
+    """
+
+    def __init__(self, fasta_file):
+        self.fasta_file = fasta_file
+        if is_fasta_index_up_to_date(fasta_file):
+            self.fasta_index = read_fasta_index(get_fasta_index_file(fasta_file))
+        else:
+            self.fasta_index = compute_fasta_index(fasta_file)
+        self._open_file = open(fasta_file, 'rb')
+        self._mmap = mmap.mmap(self._open_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._sequences = {}
+
+    @property
+    def contig_names(self):
+        return list(self.fasta_index)
+
+    def get_sequence_array(self, contig) -> 'np.ndarray':
+        # numpy is only imported by the steps that check reference alleles
+        import numpy as np
+        if contig not in self._sequences:
+            length, offset, line_bases, line_width = self.fasta_index[contig]
+            num_full_lines, last_line_bases = divmod(length, line_bases)
+            raw = np.frombuffer(self._mmap, dtype=np.uint8, count=num_full_lines * line_width + last_line_bases,
+                                offset=offset)
+            # Drop the line breaks at the end of each full line
+            full_lines = raw[:num_full_lines * line_width].reshape(num_full_lines, line_width)[:, :line_bases]
+            sequence = np.concatenate([full_lines.ravel(), raw[num_full_lines * line_width:]])
+            lower_case = (sequence >= ord('a')) & (sequence <= ord('z'))
+            sequence[lower_case] -= ord('a') - ord('A')
+            self._sequences[contig] = sequence
+        return self._sequences[contig]
+
+    def get_sequence(self, contig, start, end) -> str:
+        """
+        Return the bases between the 1-based positions start and end included.
+        """
+        return self.get_sequence_array(contig)[start - 1:end].tobytes().decode()
+
+    def close(self):
+        self._sequences.clear()
+        self._mmap.close()
+        self._open_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
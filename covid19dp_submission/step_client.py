@@ -0,0 +1,116 @@
+# Copyright 2022 EMBL - European Bioinformatics Institute
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Run a step module through the step server listening on the Unix socket named by the STEP_SERVER_SOCKET environment
+variable, or directly with this interpreter when there is no such server:
+
+    python -m step_client steps.run_vcf_validator --vcf-file ...
+
+is the same as "python -m steps.run_vcf_validator --vcf-file ...". The standard input, output and error of the client
+are handed to the server, so redirections apply to the step, and the client exits with the exit code of the step.
+Only the standard library is imported so that the client starts quickly.
+"""
+
+import array
+import json
+import os
+import socket
+import struct
+import sys
+
+STEP_SERVER_SOCKET_VARIABLE = 'STEP_SERVER_SOCKET'
+# Requests are a JSON document preceded by its length, responses the exit code of the step
+LENGTH_FORMAT = '!I'
+EXIT_CODE_FORMAT = '!i'
+NUM_STANDARD_FDS = 3
+
+
+def send_message(connection: socket.socket, message: dict, fds=()):
+    data = json.dumps(message).encode()
+    # The file descriptors are sent along with the first bytes of the message
+    ancillary_data = [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds))] if fds else []
+    connection.sendmsg([struct.pack(LENGTH_FORMAT, len(data)) + data], ancillary_data)
+
+
+def _receive_exactly(connection: socket.socket, size: int) -> bytes:
+    data = b''
+    while len(data) < size:
+        chunk = connection.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError('Connection closed before the end of the message')
+        data += chunk
+    return data
+
+
+def receive_message(connection: socket.socket, max_fds=NUM_STANDARD_FDS) -> (dict, list):
+    """
+    Return the message and the file descriptors sent with send_message. socket.recv_fds is not available before
+    Python 3.9 so the ancillary data is read with recvmsg.
+    """
+    fds = array.array('i')
+    header, ancillary_data, _, _ = connection.recvmsg(struct.calcsize(LENGTH_FORMAT),
+                                                      socket.CMSG_SPACE(max_fds * fds.itemsize))
+    for level, message_type, data in ancillary_data:
+        if level == socket.SOL_SOCKET and message_type == socket.SCM_RIGHTS:
+            fds.frombytes(data[:len(data) - (len(data) % fds.itemsize)])
+    if not header:
+        raise ConnectionError('Connection closed before the message')
+    header += _receive_exactly(connection, struct.calcsize(LENGTH_FORMAT) - len(header))
+    length, = struct.unpack(LENGTH_FORMAT, header)
+    return json.loads(_receive_exactly(connection, length)), list(fds)
+
+
+def run_step_on_server(socket_path: str, module: str, args: list) -> int or None:
+    """
+    Run the step on the server and return its exit code, or None if the server cannot be reached.
+    """
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            connection.connect(socket_path)
+        except OSError:
+            return None
+        send_message(connection, {'module': module, 'args': args, 'cwd': os.getcwd(), 'env': dict(os.environ)},
+                     fds=range(NUM_STANDARD_FDS))
+        try:
+            exit_code, = struct.unpack(EXIT_CODE_FORMAT,
+                                       _receive_exactly(connection, struct.calcsize(EXIT_CODE_FORMAT)))
+        except ConnectionError:
+            # The step may have started so it is not run again
+            sys.stderr.write(f'The step server {socket_path} stopped while running {module}\n')
+            return 1
+        return exit_code
+    finally:
+        connection.close()
+
+
+def main():
+    if len(sys.argv) < 2:
+        sys.stderr.write('Usage: python -m step_client <module> [arguments]\n')
+        sys.exit(2)
+    module, args = sys.argv[1], sys.argv[2:]
+    socket_path = os.environ.get(STEP_SERVER_SOCKET_VARIABLE)
+    if socket_path:
+        exit_code = run_step_on_server(socket_path, module, args)
+        if exit_code is not None:
+            sys.exit(exit_code)
+    # No server: replace this process with the step, as if it had been started directly
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.execv(sys.executable, [sys.executable, '-m', module] + args)
+
+
+if __name__ == "__main__":
+    main()
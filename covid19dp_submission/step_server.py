@@ -0,0 +1,181 @@
+# Copyright 2022 EMBL - European Bioinformatics Institute
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import importlib
+import os
+import pkgutil
+import runpy
+import socket
+import socketserver
+import struct
+import sys
+import traceback
+
+from ebi_eva_common_pyutils.logger import logging_config
+
+from covid19dp_submission.lazy_imports import DEFERRED_MODULES
+from covid19dp_submission.step_client import EXIT_CODE_FORMAT, NUM_STANDARD_FDS, receive_message
+
+logger = logging_config.get_logger(__name__)
+
+DEFAULT_MAX_WORKERS = 8
+# Directory on the PYTHONPATH of the Nextflow processes, which run the steps as steps.<module>
+DEFAULT_SCRIPT_PATH = os.path.dirname(os.path.abspath(__file__))
+
+
+def preload_step_modules(script_path: str) -> list:
+    """
+    Import the step modules found in script_path, and with them their dependencies, so that the processes forked for
+    the jobs start with everything imported. The dependencies the steps only import when they use them are imported
+    explicitly. Return the names of the modules imported.
+    """
+    if script_path not in sys.path:
+        sys.path.insert(0, script_path)
+    steps_package = importlib.import_module('steps')
+    module_names = [module_info.name for module_info in pkgutil.walk_packages(steps_package.__path__, prefix='steps.')]
+    preloaded_modules = []
+    for module_name in module_names + DEFERRED_MODULES:
+        try:
+            importlib.import_module(module_name)
+            preloaded_modules.append(module_name)
+        except Exception as e:
+            logger.warning(f'Could not preload {module_name}: {e}')
+    return preloaded_modules
+
+
+def run_step(module: str, args: list, cwd: str, env: dict) -> int:
+    """
+    Run a step module as "python -m module args" would, in the current process, and return its exit code.
+    """
+    os.chdir(cwd)
+    os.environ.clear()
+    os.environ.update(env)
+    for path in reversed(env.get('PYTHONPATH', '').split(os.pathsep)):
+        if path and path not in sys.path:
+            sys.path.insert(0, path)
+    # The handlers of the server would write to the output of the job, the step adds its own
+    logging_config.reset()
+    # The step runs as __main__ from a fresh copy of its module, its dependencies stay imported
+    sys.modules.pop(module, None)
+    sys.argv = [module] + args
+    try:
+        runpy.run_module(module, run_name='__main__', alter_sys=True)
+        exit_code = 0
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            exit_code = e.code or 0
+        else:
+            print(e.code, file=sys.stderr)
+            exit_code = 1
+    except BaseException:
+        traceback.print_exc()
+        exit_code = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+    return exit_code
+
+
+class StepRequestHandler(socketserver.BaseRequestHandler):
+    """
+    Run the job of a client in the process forked for the request, with the standard input, output and error of the
+    client, and send its exit code back.
+    """
+
+    def handle(self):
+        fds = []
+        try:
+            job, fds = receive_message(self.request)
+            if len(fds) != NUM_STANDARD_FDS:
+                raise ValueError(f'Expected {NUM_STANDARD_FDS} file descriptors, got {len(fds)}')
+            for target_fd, fd in enumerate(fds):
+                os.dup2(fd, target_fd)
+            exit_code = run_step(job['module'], job['args'], job['cwd'], job['env'])
+        except Exception:
+            traceback.print_exc()
+            exit_code = 1
+        finally:
+            for fd in fds:
+                os.close(fd)
+        self.request.sendall(struct.pack(EXIT_CODE_FORMAT, exit_code))
+
+
+class StepServer(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+    """
+    Unix socket server that forks a process for each job, up to max_children at the same time, from a process where
+    the step modules are already imported. socketserver.ForkingUnixStreamServer only exists from Python 3.12.
+    """
+    # Clients submitting at the same time wait in the queue of the socket until a job finishes
+    request_queue_size = 128
+
+    def __init__(self, socket_path, max_workers=DEFAULT_MAX_WORKERS):
+        self.max_children = max_workers
+        if os.path.exists(socket_path):
+            # A socket left by a server that did not stop cleanly
+            os.remove(socket_path)
+        # Only the user running the server can submit jobs
+        previous_umask = os.umask(0o077)
+        try:
+            super().__init__(socket_path, StepRequestHandler)
+        finally:
+            os.umask(previous_umask)
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+def is_server_running(socket_path) -> bool:
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(socket_path)
+        return True
+    except OSError:
+        return False
+    finally:
+        connection.close()
+
+
+def serve(socket_path, script_path=DEFAULT_SCRIPT_PATH, max_workers=DEFAULT_MAX_WORKERS):
+    if is_server_running(socket_path):
+        raise RuntimeError(f'A step server is already listening on {socket_path}')
+    module_names = preload_step_modules(script_path)
+    logger.info(f'Preloaded {len(module_names)} step modules and dependencies from {script_path}')
+    with StepServer(socket_path, max_workers) as server:
+        logger.info(f'Step server listening on {socket_path} with up to {max_workers} jobs at the same time')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            logger.info('Step server stopped')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the steps submitted by step_client in processes forked from a '
+                                                 'process where they are already imported',
+                                     formatter_class=argparse.RawTextHelpFormatter, add_help=False)
+    parser.add_argument("--socket", help="Full path to the Unix socket to listen on, to set as STEP_SERVER_SOCKET "
+                                         "for the clients", required=True)
+    parser.add_argument("--script-path", help="Directory containing the steps package", default=DEFAULT_SCRIPT_PATH,
+                        required=False)
+    parser.add_argument("--max-workers", help="Maximum number of jobs running at the same time", type=int,
+                        default=DEFAULT_MAX_WORKERS, required=False)
+    args = parser.parse_args()
+    logging_config.add_stdout_handler()
+    serve(args.socket, args.script_path, args.max_workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -16,8 +16,9 @@ import argparse
 import os
 
 from .bgzip_and_index_vcf import bgzip_and_index
-from ebi_eva_common_pyutils.command_utils import run_command_with_output
-from ebi_eva_common_pyutils.logger import logging_config
+
+from covid19dp_submission.lazy_imports import logging_config, run_command_with_output
+from covid19dp_submission.vcf_summary import get_vcf_summary, summarise_vcf
 
 logger = logging_config.get_logger(__name__)
 
@@ -26,12 +27,11 @@ def is_input_same_as_output_vcfs(input_vcf_file: str, output_vcf_file: str) -> b
     """
     Ensure that the accessioned VCF file and the input VCF files have the same number of records
     """
-    num_entries_in_input = int(run_command_with_output(f"Count entries from input file: {input_vcf_file}...",
-                                                       f"zcat {input_vcf_file} | grep -v ^# | wc -l",
-                                                       return_process_output=True))
-    num_entries_in_output = int(run_command_with_output(f"Count entries from output file: {output_vcf_file}...",
-                                                        f"zcat {output_vcf_file} | grep -v ^# | wc -l",
-                                                        return_process_output=True))
+    num_entries_in_input = get_vcf_summary(input_vcf_file)['record_count']
+    # The output is not summarised in a sidecar file since everything in its directory is published to the public FTP
+    num_entries_in_output = summarise_vcf(output_vcf_file)['record_count']
+    logger.info(f"Found {num_entries_in_input} entries in {input_vcf_file} and {num_entries_in_output} entries "
+                f"in {output_vcf_file}")
     return num_entries_in_output == num_entries_in_input
 
 
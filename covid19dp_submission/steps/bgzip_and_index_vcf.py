@@ -14,9 +14,9 @@
 
 import argparse
 import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from ebi_eva_common_pyutils.command_utils import run_command_with_output
-from ebi_eva_common_pyutils.logger import logging_config
+from covid19dp_submission.lazy_imports import logging_config, run_command_with_output
 
 logger = logging_config.get_logger(__name__)
 
@@ -25,34 +25,52 @@ def _get_vcf_filename_without_extension(vcf_file_name: str) -> str:
     return vcf_file_name.replace(".vcf.gz", "").replace(".vcf", "")
 
 
+class BgzipAndIndexError(Exception):
+    pass
+
+
 def bgzip_and_index(vcf_file: str, output_file: str, bcftools_binary: str, with_sort: bool=False) -> str:
     vcf_file_name_no_ext = _get_vcf_filename_without_extension(vcf_file)
     vcf_file_name_no_ext_and_path = os.path.basename(vcf_file_name_no_ext)
-    decompression_required = False
-    # Uncompress VCF file if it is already compressed (usually gzip) or proceed
-    if vcf_file.endswith('.gz'):
-        decompression_required = True
+    # bcftools reads plain and compressed VCFs directly. The output is written to a temporary file first because it
+    # can replace the input file.
+    partial_output_file = f'{output_file}.part'
     commands = [
-        f'gunzip -c {vcf_file} > {vcf_file_name_no_ext}.vcf' if decompression_required else ':',
-            f'{bcftools_binary} sort -O z -o {output_file} {vcf_file_name_no_ext}.vcf'
-            if with_sort else
-            f'{bcftools_binary} convert {vcf_file_name_no_ext}.vcf -O z -o {output_file}',
-        f'{bcftools_binary} index -f --csi {output_file}',
-        f'rm -rf {vcf_file_name_no_ext}.vcf' if decompression_required else ':'
+        f'{bcftools_binary} sort -O z -o {partial_output_file} {vcf_file}'
+        if with_sort else
+        f'{bcftools_binary} convert {vcf_file} -O z -o {partial_output_file}',
+        f'mv {partial_output_file} {output_file}',
+        f'{bcftools_binary} index -f --csi {output_file}'
     ]
     bgzip_and_index_command = ' && '.join(commands)
-    run_command_with_output(f"BGZipping and indexing {vcf_file_name_no_ext_and_path}...", bgzip_and_index_command)
+    try:
+        run_command_with_output(f"BGZipping and indexing {vcf_file_name_no_ext_and_path}...", bgzip_and_index_command)
+    finally:
+        if os.path.exists(partial_output_file):
+            os.remove(partial_output_file)
     return f"{vcf_file_name_no_ext}.vcf.gz"
 
 
-def bgzip_and_index_all(vcf_files: list, output_dir: str, bcftools_binary: str) -> list:
-    output_vcf_files = []
+def bgzip_and_index_all(vcf_files: list, output_dir: str, bcftools_binary: str, num_workers: int = 1) -> list:
+    """
+    BGZip and index the files with up to num_workers bcftools commands running at the same time. All the files are
+    processed even if some fail, and the failures are reported together at the end.
+    """
     os.makedirs(name=output_dir, exist_ok=True)
-    for vcf_file in vcf_files:
-        vcf_file_name_no_ext = _get_vcf_filename_without_extension(vcf_file)
-        output_file = f"{output_dir}/{vcf_file_name_no_ext}.vcf.gz"
-        bgzip_and_index(vcf_file, output_file, bcftools_binary)
-        output_vcf_files.append(f"{vcf_file_name_no_ext}.vcf.gz")
+    output_vcf_files = [f"{output_dir}/{os.path.basename(_get_vcf_filename_without_extension(vcf_file))}.vcf.gz"
+                        for vcf_file in vcf_files]
+    failed_files = {}
+    with ThreadPoolExecutor(max_workers=max(1, num_workers)) as executor:
+        conversions = {executor.submit(bgzip_and_index, vcf_file, output_file, bcftools_binary): vcf_file
+                       for vcf_file, output_file in zip(vcf_files, output_vcf_files)}
+        for conversion in as_completed(conversions):
+            if conversion.exception():
+                failed_files[conversions[conversion]] = conversion.exception()
+    if failed_files:
+        for vcf_file, error in failed_files.items():
+            logger.error(f"Could not BGZip and index {vcf_file}: {error}")
+        raise BgzipAndIndexError(f"{len(failed_files)} out of {len(vcf_files)} files could not be BGZipped and "
+                                 f"indexed: {', '.join(sorted(failed_files))}")
     return output_vcf_files
 
 
@@ -65,10 +83,12 @@ def main():
                         required=True)
     parser.add_argument("--bcftools-binary", help="Full path to the bcftools binary (ex: /path/to/bcftools)",
                         default="bcftools", required=False)
+    parser.add_argument("--num-workers", help="Number of files processed at the same time", type=int, default=1,
+                        required=False)
     args = parser.parse_args()
     logging_config.add_stdout_handler()
 
-    bgzip_and_index_all(args.vcf_file, args.output_dir, args.bcftools_binary)
+    bgzip_and_index_all(args.vcf_file, args.output_dir, args.bcftools_binary, args.num_workers)
 
 
 if __name__ == "__main__":
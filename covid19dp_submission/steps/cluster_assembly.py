@@ -15,8 +15,7 @@
 import argparse
 import os
 
-from ebi_eva_common_pyutils.command_utils import run_command_with_output
-from ebi_eva_common_pyutils.logger import logging_config
+from covid19dp_submission.lazy_imports import logging_config, run_command_with_output
 
 logger = logging_config.get_logger(__name__)
 
@@ -14,37 +14,104 @@
 
 import argparse
 import os
+import re
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-from ebi_eva_common_pyutils.command_utils import run_command_with_output
-from ebi_eva_common_pyutils.logger import logging_config
+from covid19dp_submission.lazy_imports import logging_config, run_command_with_output
+from covid19dp_submission.reference_fasta import ensure_fasta_index
 from covid19dp_submission.steps.bgzip_and_index_vcf import _get_vcf_filename_without_extension
 
 logger = logging_config.get_logger(__name__)
 
 
+def get_normalisation_log_file(output_file: str) -> str:
+    return f"{output_file}.normalise.log"
+
+
 def normalise(input_dir: str, vcf_file: str, output_file: str, bcftools_binary: str, refseq_fasta_file: str) -> str:
     vcf_file_name_no_ext = _get_vcf_filename_without_extension(vcf_file)
     vcf_file_name_no_ext_and_path = os.path.basename(vcf_file_name_no_ext)
+    # Relative paths are relative to the input directory
+    vcf_file_path = os.path.join(input_dir, vcf_file)
+    # The output and the log are written to temporary files first so that they only appear once complete
+    partial_output_file = f'{output_file}.part'
+    log_file = get_normalisation_log_file(output_file)
     # See here: https://github.com/EBIvariation/eva-submission/blob/bb85922fffb4f29fdce501af036ea79ec8712121/eva_submission/nextflow/prepare_brokering.nf#L141
-    commands = [f'cd {input_dir}',
-                f'{bcftools_binary} norm --check-ref w --fasta-ref {refseq_fasta_file} --output-type z --output '
-                    f'{output_file} {vcf_file} ',
+    commands = [f'{bcftools_binary} norm --check-ref w --fasta-ref {refseq_fasta_file} --output-type z --output '
+                    f'{partial_output_file} {vcf_file_path} 2> {log_file}.part',
+                f'mv {partial_output_file} {output_file}',
                 f'{bcftools_binary} index --force --csi {output_file}'
                 ]
     normalise_command = ' && '.join(commands)
-    run_command_with_output(f"Normalising {vcf_file_name_no_ext_and_path}...", normalise_command)
+    try:
+        run_command_with_output(f"Normalising {vcf_file_name_no_ext_and_path}...", normalise_command)
+    except subprocess.CalledProcessError:
+        if os.path.exists(f'{log_file}.part'):
+            with open(f'{log_file}.part') as open_file:
+                logger.error(f"bcftools norm failed for {vcf_file}:\n{open_file.read()}")
+        raise
+    finally:
+        if os.path.exists(partial_output_file):
+            os.remove(partial_output_file)
+        if os.path.exists(f'{log_file}.part'):
+            os.replace(f'{log_file}.part', log_file)
     return f"{vcf_file_name_no_ext}.vcf.gz"
 
 
+def parse_normalisation_log(log_file: str) -> dict:
+    """
+    Get the number of records processed and realigned by bcftools norm, and the number of records whose REF does not
+    match the reference, from the messages it wrote.
+    """
+    stats = {'total': 0, 'realigned': 0, 'ref_mismatch': 0}
+    if not os.path.exists(log_file):
+        return stats
+    with open(log_file) as open_file:
+        for line in open_file:
+            # e.g. "Lines   total/split/realigned/skipped:	10/0/2/0", the columns depend on the bcftools version
+            lines_match = re.match(r'Lines\s+([\w/]+):\s+([\d/]+)', line)
+            if lines_match:
+                stats.update(zip(lines_match.group(1).split('/'), map(int, lines_match.group(2).split('/'))))
+            elif 'Reference allele mismatch' in line:
+                stats['ref_mismatch'] += 1
+    return stats
+
+
+def _timed_normalise(input_dir: str, vcf_file: str, output_file: str, bcftools_binary: str,
+                     refseq_fasta_file: str) -> dict:
+    start_time = time.time()
+    normalise(input_dir, vcf_file, output_file, bcftools_binary, refseq_fasta_file)
+    stats = parse_normalisation_log(get_normalisation_log_file(output_file))
+    stats['duration'] = time.time() - start_time
+    logger.info(f"Normalised {vcf_file} in {stats['duration']:.1f}s: {stats['total']} records, "
+                f"{stats['realigned']} realigned, {stats['ref_mismatch']} not matching the reference")
+    return stats
+
+
 def normalise_all(input_dir:str, vcf_files: list, output_dir: str, bcftools_binary: str,
-                  refseq_fasta_file: str) -> list:
-    output_vcf_files = []
+                  refseq_fasta_file: str, num_workers: int = 1) -> list:
+    """
+    Normalise the files with up to num_workers bcftools commands running at the same time, all using the same
+    indexed reference.
+    """
     os.makedirs(name=output_dir, exist_ok=True)
-    for vcf_file in vcf_files:
-        vcf_file_name_no_ext = _get_vcf_filename_without_extension(vcf_file)
-        output_file = f"{output_dir}/{os.path.basename(vcf_file_name_no_ext)}.vcf.gz"
-        normalise(input_dir, vcf_file, output_file, bcftools_binary, refseq_fasta_file)
-        output_vcf_files.append(output_file)
+    ensure_fasta_index(refseq_fasta_file)
+    output_vcf_files = [
+        f"{output_dir}/{os.path.basename(_get_vcf_filename_without_extension(vcf_file))}.vcf.gz"
+        for vcf_file in vcf_files
+    ]
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers=max(1, num_workers)) as executor:
+        all_stats = list(executor.map(
+            lambda files: _timed_normalise(input_dir, files[0], files[1], bcftools_binary, refseq_fasta_file),
+            zip(vcf_files, output_vcf_files)
+        ))
+    logger.info(f"Normalised {len(vcf_files)} files in {time.time() - start_time:.1f}s: "
+                f"{sum(stats['total'] for stats in all_stats)} records, "
+                f"{sum(stats['realigned'] for stats in all_stats)} realigned, "
+                f"{sum(stats['ref_mismatch'] for stats in all_stats)} not matching the reference")
     return output_vcf_files
 
 
@@ -61,10 +128,13 @@ def main():
                         default="bcftools", required=False)
     parser.add_argument("--refseq-fasta-file", help="Path to the RefSeq FASTA file (ex: /path/to/refseq_fasta.fa)",
                         required=True)
+    parser.add_argument("--num-workers", help="Number of files normalised at the same time", type=int, default=1,
+                        required=False)
     args = parser.parse_args()
     logging_config.add_stdout_handler()
 
-    normalise_all(args.input_dir, args.vcf_files, args.output_dir, args.bcftools_binary, args.refseq_fasta_file)
+    normalise_all(args.input_dir, args.vcf_files, args.output_dir, args.bcftools_binary, args.refseq_fasta_file,
+                  args.num_workers)
 
 
 if __name__ == "__main__":
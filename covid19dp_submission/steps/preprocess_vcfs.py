@@ -0,0 +1,315 @@
+# Copyright 2022 EMBL - European Bioinformatics Institute
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import json
+import os
+import re
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+
+from covid19dp_submission.bgzf import BgzfWriter
+from covid19dp_submission.csi_index import CsiIndexBuilder, CsiIndexError, add_vcf_record
+from covid19dp_submission.lazy_imports import logging_config
+from covid19dp_submission.ref_checker import RefCheckResult, ReferenceAlleleChecker, UndecidableFileError
+from covid19dp_submission.steps.bgzip_and_index_vcf import _get_vcf_filename_without_extension
+from covid19dp_submission.steps.run_asm_checker import check_assembly, get_asm_check_cache_key, \
+    write_asm_check_result
+from covid19dp_submission.steps.run_vcf_validator import get_batch_hash, get_validation_error, \
+    has_unacceptable_errors, validate_vcf_with_cache
+from covid19dp_submission.validation_cache import DEFAULT_MAX_SIZE_MB, ValidationCache
+from covid19dp_submission.vcf_reader import iter_decompressed_chunks, iter_lines_from_chunks
+from covid19dp_submission.vcf_summary import VcfSummariser, write_summary_file
+
+logger = logging_config.get_logger(__name__)
+
+HEADER_COLUMNS = [b'#CHROM', b'POS', b'ID', b'REF', b'ALT', b'QUAL', b'FILTER', b'INFO']
+VALID_REF = re.compile(rb'^[ACGTN]+$', re.IGNORECASE)
+# Bases, missing or deleted alleles, symbolic alleles and breakends
+VALID_ALT = re.compile(rb'^([ACGTN]+|\*|\.|<[^<>,]+>|[ACGTN]*[\[\]][^\[\],]+[\[\]][ACGTN]*|\.[ACGTN]+|[ACGTN]+\.)$',
+                       re.IGNORECASE)
+VALID_QUAL = re.compile(rb'^(\.|[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?)$')
+# Number of structure errors kept in the result of each file
+MAX_REPORTED_ERRORS = 20
+
+# REF allele checker and validation cache of the worker process, created once for all the files it preprocesses
+_worker_state = {}
+
+
+class PreprocessingError(Exception):
+    pass
+
+
+def check_data_line_structure(fields: list, num_columns: int) -> str or None:
+    """
+    Return the structure error of the data line split in fields, or None if it is well formed.
+    """
+    if len(fields) != num_columns:
+        return f'Expected {num_columns} columns, found {len(fields)}'
+    chrom, pos, _, ref, alt, qual, filter_column, info = fields[:8]
+    if not chrom:
+        return 'Empty CHROM'
+    if not pos.isdigit() or int(pos) == 0:
+        return f'Invalid POS {pos[:20].decode(errors="replace")}'
+    if not VALID_REF.match(ref):
+        return f'Invalid REF {ref[:20].decode(errors="replace")}'
+    if not all(VALID_ALT.match(allele) for allele in alt.split(b',')):
+        return f'Invalid ALT {alt[:20].decode(errors="replace")}'
+    if not VALID_QUAL.match(qual):
+        return f'Invalid QUAL {qual[:20].decode(errors="replace")}'
+    if not filter_column or not info:
+        return 'Empty FILTER or INFO'
+    return None
+
+
+def get_preprocessing_result_file(vcf_file: str, validation_dir: str) -> str:
+    return f"{validation_dir}/{os.path.basename(vcf_file)}.preprocessing.json"
+
+
+def get_preprocessing_summary_file(vcf_files: list, validation_dir: str) -> str:
+    return os.path.join(validation_dir, f"batch_{get_batch_hash(vcf_files)}.preprocessing_summary.json")
+
+
+def _read_and_write(vcf_file: str, partial_output_file: str, ref_checker: ReferenceAlleleChecker or None) -> dict:
+    """
+    Read vcf_file once, check the structure of its lines, parse the records for the REF check, summarise them and
+    write them to a BGZF file while recording their virtual offsets in the index.
+    """
+    summariser = VcfSummariser()
+    index_builder = CsiIndexBuilder()
+    structure_errors = []
+    num_structure_errors = 0
+    ref_records = []
+    undecidable_reason = None if ref_checker else 'The in-process REF check is not available'
+    index_error = None
+    num_columns = None
+    with BgzfWriter(partial_output_file) as writer:
+        for line_number, line in enumerate(iter_lines_from_chunks(iter_decompressed_chunks(vcf_file, 1)), start=1):
+            error = None
+            if line_number == 1 and not line.startswith(b'##fileformat='):
+                error = 'The first line is not the fileformat declaration'
+            elif line.startswith(b'##'):
+                if num_columns is not None:
+                    error = 'Meta-information line after the header line'
+            elif line.startswith(b'#'):
+                columns = line.split(b'\t')
+                if columns[:8] != HEADER_COLUMNS or num_columns is not None:
+                    error = 'Invalid header line'
+                num_columns = len(columns)
+            elif not line:
+                error = 'Empty line'
+            else:
+                fields = line.split(b'\t')
+                if num_columns is None:
+                    error = 'Data line before the header line'
+                    num_columns = len(HEADER_COLUMNS)
+                error = error or check_data_line_structure(fields, num_columns)
+                summariser.add_record(line)
+                if undecidable_reason is None:
+                    try:
+                        ref_records.append(ref_checker.parse_record(line))
+                    except UndecidableFileError as e:
+                        undecidable_reason = str(e)
+                        ref_records = []
+            if error:
+                num_structure_errors += 1
+                if len(structure_errors) < MAX_REPORTED_ERRORS:
+                    structure_errors.append(f'Line {line_number}: {error}')
+            start_offset = writer.tell()
+            writer.write(line + b'\n')
+            summariser.update_content(line + b'\n')
+            if line and not line.startswith(b'#') and index_error is None:
+                try:
+                    add_vcf_record(index_builder, line, start_offset, writer.tell())
+                except CsiIndexError as e:
+                    index_error = str(e)
+    return {'summariser': summariser, 'index_builder': index_builder, 'structure_errors': structure_errors,
+            'num_structure_errors': num_structure_errors, 'ref_records': ref_records,
+            'undecidable_reason': undecidable_reason, 'index_error': index_error}
+
+
+def preprocess_vcf(vcf_file: str, output_file: str, ref_checker: ReferenceAlleleChecker or None,
+                   validator_binary: str, assembly_checker_binary: str, assembly_report: str, assembly_fasta: str,
+                   validation_dir: str, cache: ValidationCache = None) -> dict:
+    """
+    Validate vcf_file with the VCF validator while it is REF checked, BGZipped, indexed and summarised in a single
+    read. The structure errors found in that read are only reported alongside those of the validator, which decides
+    whether the file is valid. The assembly checker only runs, for its detailed report, on files whose REF alleles
+    could not be confirmed in process. The output file, which can replace vcf_file, is only written if all the checks pass.
+    With cache, the outcomes of the validator and of the assembly check are looked up and stored under the same keys
+    as the separate steps, so that content already checked is not checked again.
+    """
+    result = {'vcf_file': vcf_file, 'output_file': output_file, 'status': 'passed', 'num_records': None,
+              'num_structure_errors': 0, 'structure_errors': [], 'validator': validator_binary,
+              'assembly_checker': None, 'error': None}
+    start_time = time.time()
+    partial_output_file = f'{output_file}.part'
+    try:
+        cached_asm_check_result = asm_check_cache_key = None
+        if cache:
+            asm_check_cache_key = get_asm_check_cache_key(cache, vcf_file, assembly_checker_binary, assembly_report,
+                                                          assembly_fasta)
+            cached_asm_check_result = cache.get(asm_check_cache_key)
+        # The validator runs in its own process while the file is read, the output is only written once it is done
+        with ThreadPoolExecutor(max_workers=1) as validator_executor:
+            validation = validator_executor.submit(validate_vcf_with_cache, vcf_file, validator_binary,
+                                                   validation_dir, cache)
+            # The REF alleles of a file already assembly checked are not parsed again
+            pass_result = _read_and_write(vcf_file, partial_output_file,
+                                          None if cached_asm_check_result else ref_checker)
+            validation_result = validation.result()
+        summariser = pass_result['summariser']
+        result.update({'num_records': summariser.num_records,
+                       'num_structure_errors': pass_result['num_structure_errors'],
+                       'structure_errors': pass_result['structure_errors']})
+        errors = []
+        if pass_result['num_structure_errors']:
+            logger.info(f"Found {pass_result['num_structure_errors']} structure errors in {vcf_file}")
+        if validation_result.get('cached'):
+            result['validator'] = 'cache'
+        if has_unacceptable_errors(validation_result):
+            errors.append(get_validation_error(validation_result))
+        if cached_asm_check_result:
+            logger.info(f"VCF file {vcf_file} was already assembly checked. Skipping assembly check...")
+            asm_check_result = {**cached_asm_check_result, 'vcf_file': vcf_file, 'checker': 'cache', 'duration': 0}
+            write_asm_check_result(asm_check_result, validation_dir)
+        else:
+            if pass_result['undecidable_reason']:
+                ref_check_result = RefCheckResult(vcf_file, undecidable_reason=pass_result['undecidable_reason'])
+            else:
+                ref_check_result, = ref_checker.check_records([
+                    (RefCheckResult(vcf_file, len(pass_result['ref_records'])), pass_result['ref_records'])
+                ])
+            asm_check_result = check_assembly(vcf_file, assembly_checker_binary, assembly_report, assembly_fasta,
+                                              validation_dir, ref_check_result, summariser.num_records)
+            # Only the files that did not fail are cached so that the reports of the failing files are always produced
+            if cache and asm_check_result['status'] != 'failed':
+                cache.put(asm_check_cache_key, {**asm_check_result, 'error': None})
+        result['assembly_checker'] = asm_check_result['checker']
+        if asm_check_result['status'] == 'failed':
+            errors.append(f"Assembly check failed. See file {asm_check_result['log']} for details.")
+        if pass_result['index_error']:
+            errors.append(f"Cannot be indexed: {pass_result['index_error']}")
+        if errors:
+            result.update({'status': 'failed', 'error': ' '.join(errors)})
+        else:
+            os.replace(partial_output_file, output_file)
+            pass_result['index_builder'].write(f'{output_file}.csi')
+            write_summary_file(output_file, summariser.get_summary(output_file))
+    except (OSError, EOFError, ValueError, zlib.error) as e:
+        result.update({'status': 'failed', 'error': f'{type(e).__name__}: {e}'})
+    finally:
+        if os.path.exists(partial_output_file):
+            os.remove(partial_output_file)
+    result['duration'] = time.time() - start_time
+    result_file = get_preprocessing_result_file(vcf_file, validation_dir)
+    with open(result_file + '.tmp', 'w') as open_file:
+        json.dump(result, open_file, indent=2)
+    os.replace(result_file + '.tmp', result_file)
+    return result
+
+
+def _init_worker(assembly_fasta: str, assembly_report: str, cache_dir: str, cache_max_size_bytes: int):
+    # The resources of the worker are released when its process exits
+    try:
+        _worker_state['ref_checker'] = ReferenceAlleleChecker(assembly_fasta, assembly_report)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Could not check the REF alleles in process, all files will use the assembly checker: {e}")
+        _worker_state['ref_checker'] = None
+    _worker_state['cache'] = ValidationCache(cache_dir, cache_max_size_bytes) if cache_dir else None
+
+
+def _preprocess_vcf_in_worker(vcf_file: str, output_file: str, validator_binary: str, assembly_checker_binary: str,
+                              assembly_report: str, assembly_fasta: str, validation_dir: str) -> dict:
+    return preprocess_vcf(vcf_file, output_file, _worker_state['ref_checker'], validator_binary,
+                          assembly_checker_binary, assembly_report, assembly_fasta, validation_dir,
+                          _worker_state['cache'])
+
+
+def preprocess_vcfs(vcf_files: list, output_dir: str, validation_dir: str, validator_binary: str,
+                    assembly_checker_binary: str, assembly_report: str, assembly_fasta: str,
+                    num_workers: int = 1, cache_dir: str = None, cache_max_size_mb: int = DEFAULT_MAX_SIZE_MB) -> list:
+    """
+    Preprocess the files with up to num_workers worker processes, each loading the assembly once, and write a summary
+    of the batch. All the files are processed even if some fail, and the failures are reported together at the end.
+    With cache_dir, the validation and assembly check results are shared with the separate steps and the previous
+    snapshots.
+    """
+    os.makedirs(name=output_dir, exist_ok=True)
+    os.makedirs(name=validation_dir, exist_ok=True)
+    output_vcf_files = [f"{output_dir}/{os.path.basename(_get_vcf_filename_without_extension(vcf_file))}.vcf.gz"
+                        for vcf_file in vcf_files]
+    cache_max_size_bytes = cache_max_size_mb * 1024 * 1024
+    # The files are read by Python code holding the GIL so they are preprocessed in separate processes
+    with ProcessPoolExecutor(max_workers=max(1, num_workers), initializer=_init_worker,
+                             initargs=(assembly_fasta, assembly_report, cache_dir, cache_max_size_bytes)) as executor:
+        results = list(executor.map(
+            partial(_preprocess_vcf_in_worker, validator_binary=validator_binary,
+                    assembly_checker_binary=assembly_checker_binary, assembly_report=assembly_report,
+                    assembly_fasta=assembly_fasta, validation_dir=validation_dir),
+            vcf_files, output_vcf_files
+        ))
+    if cache_dir:
+        ValidationCache(cache_dir, cache_max_size_bytes).evict()
+    summary_file = get_preprocessing_summary_file(vcf_files, validation_dir)
+    with open(summary_file + '.tmp', 'w') as open_file:
+        json.dump({'num_files': len(results),
+                   'num_failed_files': sum(result['status'] == 'failed' for result in results),
+                   'files': results}, open_file, indent=2)
+    os.replace(summary_file + '.tmp', summary_file)
+    failed_results = [result for result in results if result['status'] == 'failed']
+    logger.info(f"Preprocessed {len(results)} files: {len(results) - len(failed_results)} passed "
+                f"({sum(result['assembly_checker'] == 'in-process' for result in results)} REF checked in process, "
+                f"{sum(result['validator'] == 'cache' for result in results)} validated and "
+                f"{sum(result['assembly_checker'] == 'cache' for result in results)} assembly checked from the "
+                f"cache), {len(failed_results)} failed. Summary in {summary_file}")
+    if failed_results:
+        for result in failed_results:
+            logger.error(f"Could not preprocess {result['vcf_file']}: {result['error']}")
+        raise PreprocessingError(f"{len(failed_results)} out of {len(vcf_files)} files could not be preprocessed: "
+                                 f"{', '.join(sorted(result['vcf_file'] for result in failed_results))}")
+    return output_vcf_files
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Validate VCF files, then assembly check, BGZip, index and '
+                                                 'summarise them in a single read of each file',
+                                     formatter_class=argparse.RawTextHelpFormatter, add_help=False)
+    parser.add_argument("--vcf-file", help="Full path to the VCF file", nargs='+', required=True)
+    parser.add_argument("--output-dir", help="Path to the directory that will contain the BGZipped files",
+                        required=True)
+    parser.add_argument("--validation-dir", help="Full path to the validation output directory", required=True)
+    parser.add_argument("--validator-binary", help="Full path to the VCF validator binary",
+                        default="vcf_validator", required=False)
+    parser.add_argument("--assembly-checker-binary", help="Full path to the assembly checker binary",
+                        default="vcf_assembly_checker", required=False)
+    parser.add_argument("--assembly-report", help="Full path to the assembly report", required=True)
+    parser.add_argument("--assembly-fasta", help="Full path to the assembly FASTA", required=True)
+    parser.add_argument("--num-workers", help="Number of files processed at the same time", type=int, default=1,
+                        required=False)
+    parser.add_argument("--cache-dir", help="Full path to the cache of the validation and assembly check results "
+                                            "shared between snapshots", default=None, required=False)
+    parser.add_argument("--cache-max-size-mb", help="Maximum size of the cache in MB", type=int,
+                        default=DEFAULT_MAX_SIZE_MB, required=False)
+    args = parser.parse_args()
+    logging_config.add_stdout_handler()
+    preprocess_vcfs(args.vcf_file, args.output_dir, args.validation_dir, args.validator_binary,
+                    args.assembly_checker_binary, args.assembly_report, args.assembly_fasta, args.num_workers,
+                    args.cache_dir, args.cache_max_size_mb)
+
+
+if __name__ == "__main__":
+    main()
@@ -13,42 +13,169 @@
 # limitations under the License.
 
 import argparse
+import json
 import os
-import sys
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-from ebi_eva_common_pyutils.command_utils import run_command_with_output
-from ebi_eva_common_pyutils.logger import logging_config
+from covid19dp_submission.lazy_imports import logging_config, run_command_with_output
+from covid19dp_submission.ref_checker import RefCheckResult, ReferenceAlleleChecker
+from covid19dp_submission.validation_cache import DEFAULT_MAX_SIZE_MB, ValidationCache
+from covid19dp_submission.vcf_summary import get_vcf_summary
 
 logger = logging_config.get_logger(__name__)
 
 
 def should_skip_asm_check(vcf_file: str) -> bool:
-    cat_command = 'cat'
-    if vcf_file.endswith(".gz"):
-        cat_command = 'zcat'
-    return int(run_command_with_output(f"Determine if the VCF file is empty...",
-                                       f"{cat_command} {vcf_file} | grep -v ^# | wc -l",
-                                       return_process_output=True)) == 0
+    return get_vcf_summary(vcf_file)['record_count'] == 0
+
+
+def get_asm_check_result_file(vcf_file: str, output_dir: str) -> str:
+    return f"{output_dir}/{os.path.basename(vcf_file)}.assembly_check.json"
+
+
+def write_ref_check_log(ref_check_result: RefCheckResult, log_file: str):
+    with open(log_file + '.tmp', 'w') as open_file:
+        open_file.write(f"REF check of {ref_check_result.vcf_file} against the memory-mapped assembly: "
+                        f"{ref_check_result.num_matches} out of {ref_check_result.num_records} variants match the "
+                        f"reference ({ref_check_result.match_percentage:g}%)\n")
+    os.replace(log_file + '.tmp', log_file)
+
+
+def check_assembly(vcf_file: str, assembly_checker_binary: str, assembly_report: str, assembly_fasta: str,
+                   output_dir: str, ref_check_result: RefCheckResult = None, num_records: int = None) -> dict:
+    """
+    Assembly check a single file, skipping files without variants, and write the result to its manifest.
+    Files whose REF alleles all matched in the in-process check are not checked again by the assembly checker.
+    The number of records is read from the summary of the file unless it is provided.
+    """
+    assembly_check_output_prefix = os.path.basename(vcf_file)
+    # This log file captures the status of the overall validation process
+    process_log_file_name = f"{output_dir}/{assembly_check_output_prefix}.assembly_check.log"
+    result = {'vcf_file': vcf_file, 'status': 'passed', 'checker': assembly_checker_binary,
+              'log': process_log_file_name, 'error': None}
+    start_time = time.time()
+    if should_skip_asm_check(vcf_file) if num_records is None else num_records == 0:
+        logger.info(f"VCF file {vcf_file} does not have any variants. Skipping assembly check...")
+        result.update({'status': 'skipped', 'checker': None, 'log': None})
+    elif ref_check_result and ref_check_result.passed:
+        logger.info(f"All {ref_check_result.num_records} variants of {vcf_file} match the reference")
+        write_ref_check_log(ref_check_result, process_log_file_name)
+        result['checker'] = 'in-process'
+    else:
+        if ref_check_result and ref_check_result.undecidable_reason:
+            logger.info(f"Falling back to {assembly_checker_binary} for {vcf_file}: "
+                        f"{ref_check_result.undecidable_reason}")
+        try:
+            run_command_with_output(f"Assembly checking VCF file {vcf_file}...",
+                                    f'bash -c "{assembly_checker_binary} -i {vcf_file}  '
+                                    f'-f {assembly_fasta} '
+                                    f'-a {assembly_report} '
+                                    f'-r summary,text,valid '
+                                    f'-o {output_dir} '
+                                    f'--require-genbank > {process_log_file_name} 2>&1"')
+        except subprocess.CalledProcessError as e:
+            result.update({'status': 'failed', 'error': e})
+    result['duration'] = time.time() - start_time
+    write_asm_check_result(result, output_dir)
+    return result
+
+
+def write_asm_check_result(result: dict, output_dir: str):
+    result_file = get_asm_check_result_file(result['vcf_file'], output_dir)
+    with open(result_file + '.tmp', 'w') as open_file:
+        json.dump({**result, 'error': str(result['error']) if result['error'] else None}, open_file, indent=2)
+    os.replace(result_file + '.tmp', result_file)
+
+
+def check_ref_alleles(vcf_files: list, assembly_report: str, assembly_fasta: str) -> dict:
+    """
+    Check the REF alleles of the non-empty files in process, loading the assembly once for the whole batch.
+    Return the RefCheckResult of each file.
+    """
+    vcf_files = [vcf_file for vcf_file in vcf_files if not should_skip_asm_check(vcf_file)]
+    if not vcf_files:
+        return {}
+    try:
+        with ReferenceAlleleChecker(assembly_fasta, assembly_report) as checker:
+            return {result.vcf_file: result for result in checker.check_files(vcf_files)}
+    except (OSError, ValueError) as e:
+        logger.warning(f"Could not check the REF alleles in process, all files will use the assembly checker: {e}")
+        return {}
+
+
+def get_asm_check_cache_key(cache: ValidationCache, vcf_file: str, assembly_checker_binary: str,
+                            assembly_report: str, assembly_fasta: str) -> str:
+    return cache.get_key(vcf_file, 'assembly_check', assembly_checker_binary, (assembly_fasta, assembly_report))
+
+
+def get_cached_asm_check_results(vcf_files: list, assembly_checker_binary: str, assembly_report: str,
+                                 assembly_fasta: str, output_dir: str, cache: ValidationCache) -> (dict, dict):
+    """
+    Return the results of the files whose content was already checked against the same assembly, with their
+    manifests written as if they had just been checked, and the cache keys of the other files.
+    """
+    cached_results = {}
+    cache_keys = {}
+    for vcf_file in vcf_files:
+        cache_key = get_asm_check_cache_key(cache, vcf_file, assembly_checker_binary, assembly_report,
+                                            assembly_fasta)
+        cached_result = cache.get(cache_key)
+        if cached_result is None:
+            cache_keys[vcf_file] = cache_key
+            continue
+        logger.info(f"VCF file {vcf_file} was already assembly checked. Skipping assembly check...")
+        result = {**cached_result, 'vcf_file': vcf_file, 'checker': 'cache', 'duration': 0}
+        write_asm_check_result(result, output_dir)
+        cached_results[vcf_file] = result
+    return cached_results, cache_keys
 
 
 def run_asm_checker(vcf_files: list, assembly_checker_binary: str, assembly_report: str, assembly_fasta: str,
-                    output_dir: str) -> None:
+                    output_dir: str, num_workers: int = 1, in_process_ref_check: bool = True, cache_dir: str = None,
+                    cache_max_size_mb: int = DEFAULT_MAX_SIZE_MB) -> list:
+    """
+    Assembly check the files with up to num_workers checkers running at the same time. Each file is handled
+    independently and a failure is only raised once all the files have been checked.
+    With in_process_ref_check, the REF alleles are first checked in process and the assembly checker only runs for
+    the files with mismatches, which it reports in detail, or with records that could not be checked.
+    With cache_dir, files whose content was already checked against the same assembly are not checked again.
+    Only the files that did not fail are cached so that the reports of the failing files are always produced.
+    """
     os.makedirs(name=output_dir, exist_ok=True)
-    for vcf_file in vcf_files:
-        assembly_check_output_prefix = os.path.basename(vcf_file)
-        # This log file captures the status of the overall validation process
-        process_log_file_name = f"{output_dir}/{assembly_check_output_prefix}.assembly_check.log"
-
-        if should_skip_asm_check(vcf_file):
-            logger.info(f"VCF file {vcf_file} does not have any variants. Skipping assembly check...")
-            sys.exit(0)
-        run_command_with_output(f"Assembly checking VCF file {vcf_file}...",
-                                f'bash -c "{assembly_checker_binary} -i {vcf_file}  '
-                                f'-f {assembly_fasta} '
-                                f'-a {assembly_report} '
-                                f'-r summary,text,valid '
-                                f'-o {output_dir} '
-                                f'--require-genbank > {process_log_file_name} 2>&1"')
+    cached_results, cache_keys = {}, {}
+    cache = ValidationCache(cache_dir, cache_max_size_mb * 1024 * 1024) if cache_dir else None
+    if cache:
+        cached_results, cache_keys = get_cached_asm_check_results(vcf_files, assembly_checker_binary,
+                                                                  assembly_report, assembly_fasta, output_dir, cache)
+    files_to_check = [vcf_file for vcf_file in vcf_files if vcf_file not in cached_results]
+    ref_check_results = check_ref_alleles(files_to_check, assembly_report, assembly_fasta) \
+        if in_process_ref_check else {}
+    with ThreadPoolExecutor(max_workers=max(1, num_workers)) as executor:
+        checked_results = dict(zip(files_to_check, executor.map(
+            lambda vcf_file: check_assembly(vcf_file, assembly_checker_binary, assembly_report, assembly_fasta,
+                                            output_dir, ref_check_results.get(vcf_file)),
+            files_to_check
+        )))
+    if cache:
+        for vcf_file, result in checked_results.items():
+            if result['status'] != 'failed':
+                cache.put(cache_keys[vcf_file], {**result, 'error': None})
+        cache.log_stats(f'the assembly check of {len(vcf_files)} files')
+        cache.evict()
+    results = [cached_results.get(vcf_file) or checked_results[vcf_file] for vcf_file in vcf_files]
+    failed_results = [result for result in results if result['status'] == 'failed']
+    logger.info(f"Assembly checked {len(results)} files: "
+                f"{sum(result['status'] == 'passed' for result in results)} passed "
+                f"({sum(result['checker'] == 'in-process' for result in results)} in process, "
+                f"{sum(result['checker'] == 'cache' for result in results)} from the cache), "
+                f"{sum(result['status'] == 'skipped' for result in results)} skipped, {len(failed_results)} failed")
+    if failed_results:
+        for result in failed_results:
+            logger.error(f"Assembly check failed for {result['vcf_file']}. See file {result['log']} for details.")
+        raise failed_results[0]['error']
+    return results
 
 
 def main():
@@ -60,11 +187,21 @@ def main():
     parser.add_argument("--assembly-report", help="Full path to the assembly report", required=True)
     parser.add_argument("--assembly-fasta", help="Full path to the assembly FASTA", required=True)
     parser.add_argument("--output-dir", help="Full path to the assembly check output directory", required=True)
+    parser.add_argument("--num-workers", help="Number of files checked at the same time", type=int, default=1,
+                        required=False)
+    parser.add_argument("--no-in-process-ref-check", dest="in_process_ref_check",
+                        help="Check every file with the assembly checker binary", action='store_false',
+                        required=False)
+    parser.add_argument("--cache-dir", help="Full path to the cache of the assembly check results shared between "
+                                            "snapshots", default=None, required=False)
+    parser.add_argument("--cache-max-size-mb", help="Maximum size of the cache in MB", type=int,
+                        default=DEFAULT_MAX_SIZE_MB, required=False)
 
     args = parser.parse_args()
     logging_config.add_stdout_handler()
     run_asm_checker(args.vcf_file, args.assembly_checker_binary, args.assembly_report, args.assembly_fasta,
-                    args.output_dir)
+                    args.output_dir, args.num_workers, args.in_process_ref_check, args.cache_dir,
+                    args.cache_max_size_mb)
 
 
 if __name__ == "__main__":
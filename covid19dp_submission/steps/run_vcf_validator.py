@@ -13,49 +13,158 @@
 # limitations under the License.
 
 import argparse
+import fnmatch
+import hashlib
+import json
 import os
+import re
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-from ebi_eva_common_pyutils.command_utils import run_command_with_output
-from ebi_eva_common_pyutils.logger import logging_config
 from subprocess import CalledProcessError
 
+from covid19dp_submission.lazy_imports import logging_config, run_command_with_output
+from covid19dp_submission.validation_cache import DEFAULT_MAX_SIZE_MB, ValidationCache
+
 logger = logging_config.get_logger(__name__)
 
 
-def run_vcf_validation(vcf_files: list, validator_binary: str, output_dir: str) -> None:
+# TODO: Currently the Covid-19 DP submissions are in VCFv4.0 and therefore generate these errors
+#       even though they don't create any issues with the accessioning process.
+#       Therefore, we have decided to ignore these errors.
+#       Re-visit this code if Covid-19 DP VCF file formats are changed to v4.1.
+ACCEPTABLE_ERRORS = re.compile('fileformat declaration is not valid|input file is not valid', re.IGNORECASE)
+
+
+def count_validation_errors(validator_output_file: str) -> (int, int):
+    """
+    Return the number of acceptable and unacceptable errors listed in the text report of the validator.
+    """
+    acceptable_errors = unacceptable_errors = 0
+    with open(validator_output_file) as open_file:
+        for line in open_file:
+            if ACCEPTABLE_ERRORS.search(line):
+                acceptable_errors += 1
+            else:
+                unacceptable_errors += 1
+    return acceptable_errors, unacceptable_errors
+
+
+def validate_vcf(vcf_file: str, validator_binary: str, output_dir: str) -> dict:
+    """
+    Validate vcf_file in its own scratch directory so that its reports cannot be mistaken for the reports of another
+    file, then move the reports to output_dir.
+    """
+    validation_output_prefix = os.path.basename(vcf_file)
+    scratch_dir = os.path.join(output_dir, '.scratch', validation_output_prefix)
+    shutil.rmtree(scratch_dir, ignore_errors=True)
+    os.makedirs(scratch_dir)
+    # This log file captures the status of the overall validation process
+    process_log_file_name = f"{output_dir}/{validation_output_prefix}.vcf_format.log"
+    result = {'vcf_file': vcf_file, 'valid': True, 'acceptable_errors': 0, 'unacceptable_errors': 0,
+              'report': None, 'log': process_log_file_name}
+    start_time = time.time()
+    try:
+        run_command_with_output(f"Validating VCF file {vcf_file}...",
+                                f'bash -c "{validator_binary} -i {vcf_file}  '
+                                f'-r database,text '
+                                f'-o {scratch_dir} '
+                                f'--require-evidence > {process_log_file_name} 2>&1"')
+    except CalledProcessError:
+        result['valid'] = False
+    for validator_output_file in sorted(os.listdir(scratch_dir)):
+        shutil.move(os.path.join(scratch_dir, validator_output_file),
+                    os.path.join(output_dir, validator_output_file))
+        if fnmatch.fnmatch(validator_output_file, f'{validation_output_prefix}.errors.*.txt'):
+            result['report'] = os.path.join(output_dir, validator_output_file)
+    shutil.rmtree(scratch_dir)
+    if not result['valid']:
+        if result['report']:
+            result['acceptable_errors'], result['unacceptable_errors'] = count_validation_errors(result['report'])
+        else:
+            logger.error(f"Could not find validator output for file: {vcf_file}")
+    result['duration'] = time.time() - start_time
+    return result
+
+
+def has_unacceptable_errors(result: dict) -> bool:
+    # A failed validation without report cannot be checked
+    return result['unacceptable_errors'] > 0 or (not result['valid'] and not result['report'])
+
+
+def get_validation_error(result: dict) -> str:
+    if result['report']:
+        return f"Unacceptable VCF validation errors found. See file {result['report']} for details."
+    return f"The VCF validator produced no output. See file {result.get('log')} for details."
+
+
+def get_batch_hash(vcf_files: list) -> str:
+    # Batches processed at the same time write to the same directory so their summaries are named after their content
+    return hashlib.sha1('\n'.join(sorted(os.path.basename(f) for f in vcf_files)).encode()).hexdigest()[:12]
+
+
+def get_validation_summary_file(vcf_files: list, output_dir: str) -> str:
+    return os.path.join(output_dir, f"batch_{get_batch_hash(vcf_files)}.validation_summary.json")
+
+
+def validate_vcf_with_cache(vcf_file: str, validator_binary: str, output_dir: str,
+                            cache: ValidationCache = None) -> dict:
+    """
+    Return the cached validation result of vcf_file if its content was already validated by the same validator,
+    otherwise validate it. Only the results without unacceptable errors are cached so that the reports of the
+    failing files are always produced.
+    """
+    if cache is None:
+        return validate_vcf(vcf_file, validator_binary, output_dir)
+    cache_key = cache.get_key(vcf_file, 'vcf_validation', validator_binary)
+    cached_result = cache.get(cache_key)
+    if cached_result is not None:
+        logger.info(f"VCF file {vcf_file} was already validated. Skipping validation...")
+        return {**cached_result, 'vcf_file': vcf_file, 'duration': 0, 'cached': True}
+    result = validate_vcf(vcf_file, validator_binary, output_dir)
+    if not has_unacceptable_errors(result):
+        cache.put(cache_key, result)
+    return result
+
+
+def run_vcf_validation(vcf_files: list, validator_binary: str, output_dir: str, num_workers: int = 1,
+                       cache_dir: str = None, cache_max_size_mb: int = DEFAULT_MAX_SIZE_MB) -> dict:
+    """
+    Validate the files with up to num_workers validators running at the same time and write a summary of the
+    batch. Exit with an error if any file has unacceptable errors once all the files have been validated.
+    With cache_dir, files whose content was already validated are not validated again.
+    """
     os.makedirs(name=output_dir, exist_ok=True)
-    for vcf_file in vcf_files:
-        validation_output_prefix = os.path.basename(vcf_file)
-        # This log file captures the status of the overall validation process
-        process_log_file_name = f"{output_dir}/{validation_output_prefix}.vcf_format.log"
-        try:
-            run_command_with_output(f"Validating VCF file {vcf_file}...",
-                                    f'bash -c "{validator_binary} -i {vcf_file}  '
-                                    f'-r database,text '
-                                    f'-o {output_dir} '
-                                    f'--require-evidence > {process_log_file_name} 2>&1"')
-        except CalledProcessError:
-            last_generated_validator_output_file = run_command_with_output(
-                f"Finding last updated validation output for {vcf_file}...",
-                f'bash -c "ls -1rt {output_dir}/{validation_output_prefix}.errors.*.txt | tail -1"',
-                return_process_output=True).strip()
-            assert last_generated_validator_output_file, f"FAIL: Could not find validator output for file!!: {vcf_file}"
-            # Since the VCF validator output is timestamped,
-            # examine the last generated validator output file (race conditions galore!!)
-            # TODO: Currently the Covid-19 DP submissions are in VCFv4.0 and therefore generate these errors
-            #       even though they don't create any issues with the accessioning process.
-            #       Therefore, we have decided to ignore these errors.
-            #       Re-visit this code if Covid-19 DP VCF file formats are changed to v4.1.
-            number_of_unacceptable_errors = int(run_command_with_output(
-                f"Checking if VCF file {vcf_file} has acceptable errors...",
-                f'bash -c "grep -i -v -E '
-                f"'fileformat declaration is not valid|input file is not valid' {last_generated_validator_output_file} "
-                '| wc -l"',
-                return_process_output=True))
-            if number_of_unacceptable_errors > 0:
-                logger.error(f"Unacceptable VCF validation errors found. "
-                             f"See file {last_generated_validator_output_file} for details.")
-                raise SystemExit("FAIL: Unacceptable VCF validation errors found.")
+    cache = ValidationCache(cache_dir, cache_max_size_mb * 1024 * 1024) if cache_dir else None
+    with ThreadPoolExecutor(max_workers=max(1, num_workers)) as executor:
+        results = list(executor.map(
+            lambda vcf_file: validate_vcf_with_cache(vcf_file, validator_binary, output_dir, cache), vcf_files
+        ))
+    if cache:
+        cache.log_stats(f'the validation of {len(vcf_files)} files')
+        cache.evict()
+    summary = {
+        'num_files': len(results),
+        'num_valid_files': sum(result['valid'] for result in results),
+        'num_files_with_unacceptable_errors': sum(has_unacceptable_errors(result) for result in results),
+        'acceptable_errors': sum(result['acceptable_errors'] for result in results),
+        'unacceptable_errors': sum(result['unacceptable_errors'] for result in results),
+        'files': results
+    }
+    summary_file = get_validation_summary_file(vcf_files, output_dir)
+    with open(summary_file + '.tmp', 'w') as open_file:
+        json.dump(summary, open_file, indent=2)
+    os.replace(summary_file + '.tmp', summary_file)
+    logger.info(f"Validated {summary['num_files']} files: {summary['num_valid_files']} valid, "
+                f"{summary['acceptable_errors']} acceptable and {summary['unacceptable_errors']} unacceptable errors. "
+                f"Summary in {summary_file}")
+    failed_results = [result for result in results if has_unacceptable_errors(result)]
+    if failed_results:
+        for result in failed_results:
+            logger.error(f"Validation of {result['vcf_file']} failed: {get_validation_error(result)}")
+        raise SystemExit("FAIL: Unacceptable VCF validation errors found.")
+    return summary
 
 
 def main():
@@ -65,10 +174,17 @@ def main():
     parser.add_argument("--validator-binary", help="Full path to the VCF validator binary",
                         default="vcf_validator", required=False)
     parser.add_argument("--output-dir", help="Full path to the validation output directory", required=True)
+    parser.add_argument("--num-workers", help="Number of files validated at the same time", type=int, default=1,
+                        required=False)
+    parser.add_argument("--cache-dir", help="Full path to the cache of the validation results shared between "
+                                            "snapshots", default=None, required=False)
+    parser.add_argument("--cache-max-size-mb", help="Maximum size of the cache in MB", type=int,
+                        default=DEFAULT_MAX_SIZE_MB, required=False)
 
     args = parser.parse_args()
     logging_config.add_stdout_handler()
-    run_vcf_validation(args.vcf_file, args.validator_binary, args.output_dir)
+    run_vcf_validation(args.vcf_file, args.validator_binary, args.output_dir, args.num_workers, args.cache_dir,
+                       args.cache_max_size_mb)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,230 @@
+# Copyright 2022 EMBL - European Bioinformatics Institute
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import functools
+import glob
+import json
+import math
+import os
+import re
+
+from covid19dp_submission.lazy_imports import logging_config
+from covid19dp_submission.vcf_summary import read_vcf_summary
+
+logger = logging_config.get_logger(__name__)
+
+# Number of jobs Nextflow submits at the same time with the grid executors when queueSize is not set
+DEFAULT_GRID_QUEUE_SIZE = 100
+# Bytes per record of the compressed SARS-CoV-2 VCF files, used for the files without a summary
+DEFAULT_BYTES_PER_RECORD = 40
+
+
+class ConcatCostModel:
+    """
+    Estimated duration of a "bcftools concat" merge run as a Nextflow process: a fixed cost to start the process,
+    a cost per input file opened and the costs of reading the input records and writing the output records.
+    The defaults were measured on small SARS-CoV-2 VCF files, concat_cost_model in the app config overrides them
+    for the nodes the merges run on.
+    """
+
+    def __init__(self, process_startup_seconds=2.0, seconds_per_input=0.01, seconds_per_input_record=2e-6,
+                 seconds_per_output_record=3e-6, seconds_per_input_mb=0.05):
+        self.process_startup_seconds = process_startup_seconds
+        self.seconds_per_input = seconds_per_input
+        self.seconds_per_input_record = seconds_per_input_record
+        self.seconds_per_output_record = seconds_per_output_record
+        self.seconds_per_input_mb = seconds_per_input_mb
+
+    def merge_seconds(self, num_inputs, records_per_input, bytes_per_record, max_output_records):
+        input_records = num_inputs * records_per_input
+        return self.process_startup_seconds + num_inputs * self.seconds_per_input \
+            + input_records * self.seconds_per_input_record \
+            + input_records * bytes_per_record / 1e6 * self.seconds_per_input_mb \
+            + min(input_records, max_output_records) * self.seconds_per_output_record
+
+
+def get_executor_parallelism(nextflow_config_file=None) -> int:
+    """
+    Return the number of concat processes Nextflow runs at the same time: the queueSize of the executor if it is set
+    in nextflow_config_file, otherwise the number of CPUs for the local executor or the Nextflow default for the
+    grid executors.
+    """
+    config = ''
+    if nextflow_config_file and os.path.isfile(nextflow_config_file):
+        with open(nextflow_config_file) as open_file:
+            config = open_file.read()
+    queue_size = re.search(r'queueSize\s*=\s*(\d+)', config)
+    if queue_size:
+        return max(1, int(queue_size.group(1)))
+    executor = re.search(r'executor\s*=\s*[\'"](\w+)[\'"]', config)
+    if executor and executor.group(1) != 'local':
+        return DEFAULT_GRID_QUEUE_SIZE
+    return os.cpu_count() or 1
+
+
+def get_input_stats(vcf_files) -> dict:
+    """
+    Return the number of files, bytes and records of vcf_files and an upper bound of their distinct loci once
+    concatenated, from the summary sidecars. The records of the files without an up to date summary are estimated
+    from their size.
+    """
+    total_bytes = total_records = total_distinct_loci = 0
+    unsummarised_bytes = 0
+    contig_spans = {}
+    for vcf_file in vcf_files:
+        file_size = os.path.getsize(vcf_file)
+        total_bytes += file_size
+        summary = read_vcf_summary(vcf_file)
+        if summary is None:
+            unsummarised_bytes += file_size
+            continue
+        total_records += summary['record_count']
+        total_distinct_loci += summary['distinct_loci']
+        if summary['min_pos'] is not None:
+            for contig in summary['contigs']:
+                min_pos, max_pos = contig_spans.get(contig, (summary['min_pos'], summary['max_pos']))
+                contig_spans[contig] = (min(min_pos, summary['min_pos']), max(max_pos, summary['max_pos']))
+    summarised_bytes = total_bytes - unsummarised_bytes
+    bytes_per_record = summarised_bytes / total_records if total_records else DEFAULT_BYTES_PER_RECORD
+    estimated_records = int(unsummarised_bytes / bytes_per_record)
+    total_records += estimated_records
+    total_distinct_loci += estimated_records
+    # Most loci are SNVs so there are rarely more than 3 loci per position of the covered region
+    if contig_spans and not unsummarised_bytes:
+        max_distinct_loci = 3 * sum(max_pos - min_pos + 1 for min_pos, max_pos in contig_spans.values())
+        total_distinct_loci = min(total_distinct_loci, max_distinct_loci)
+    return {'num_files': len(vcf_files), 'total_bytes': total_bytes, 'total_records': total_records,
+            'distinct_loci': max(1, total_distinct_loci), 'bytes_per_record': bytes_per_record}
+
+
+def get_balanced_batch_sizes(num_files, num_batches):
+    return [num_files // num_batches + (1 if batch < num_files % num_batches else 0) for batch in range(num_batches)]
+
+
+def plan_vertical_concat(input_stats: dict, max_fan_in: int, parallelism: int,
+                         cost_model: ConcatCostModel = None) -> dict:
+    """
+    Choose the number of stages and the number of batches of each stage that minimise the estimated duration of
+    the concatenation. The files of a stage are spread evenly over its batches, so each stage can have its own
+    fan-in. A stage with n files holds all the records in n files, with at most the distinct loci of the input in
+    each file, and runs its batches in waves of parallelism processes.
+    """
+    cost_model = cost_model or ConcatCostModel()
+    total_records = input_stats['total_records']
+    distinct_loci = input_stats['distinct_loci']
+    bytes_per_record = input_stats['bytes_per_record']
+
+    def stage_seconds(num_files, num_batches):
+        largest_batch = math.ceil(num_files / num_batches)
+        records_per_file = min(total_records / num_files, distinct_loci)
+        waves = math.ceil(num_batches / parallelism)
+        return waves * cost_model.merge_seconds(largest_batch, records_per_file, bytes_per_record, distinct_loci)
+
+    @functools.lru_cache(maxsize=None)
+    def best_plan(num_files):
+        # Return the estimated duration, the number of stages and the number of batches of each stage
+        if num_files <= 1:
+            return 0, 0, ()
+        candidates = []
+        min_batches = math.ceil(num_files / max_fan_in)
+        for num_batches in sorted({math.ceil(num_files / fan_in) for fan_in in range(2, max_fan_in + 1)}):
+            if num_batches < min_batches or num_batches >= num_files:
+                continue
+            seconds, num_stages, next_stages = best_plan(num_batches)
+            candidates.append((stage_seconds(num_files, num_batches) + seconds, num_stages + 1,
+                               (num_batches,) + next_stages))
+        # Fewer stages are preferred when the estimated durations are the same
+        return min(candidates)
+
+    estimated_seconds, _, batches_per_stage = best_plan(input_stats['num_files'])
+    stages = []
+    num_files = input_stats['num_files']
+    for num_batches in batches_per_stage:
+        stages.append({'batch_sizes': get_balanced_batch_sizes(num_files, num_batches),
+                       'estimated_seconds': round(stage_seconds(num_files, num_batches), 1)})
+        num_files = num_batches
+    return {**input_stats, 'max_fan_in': max_fan_in, 'parallelism': parallelism, 'stages': stages,
+            'estimated_seconds': round(estimated_seconds, 1)}
+
+
+def get_plan_batch_sizes(concat_plan: dict, num_files: int) -> list:
+    """
+    Return the batch sizes of each stage of concat_plan, which must have been made for num_files files.
+    """
+    if concat_plan['num_files'] != num_files:
+        raise ValueError(f"The concatenation plan was made for {concat_plan['num_files']} files but there are "
+                         f"{num_files} files to concatenate")
+    return [stage['batch_sizes'] for stage in concat_plan['stages']]
+
+
+def describe_concat_plan(concat_plan: dict) -> str:
+    lines = [f"{concat_plan['num_files']} files, {concat_plan['total_bytes'] / 1e6:.1f}MB, "
+             f"{concat_plan['total_records']} records, at most {concat_plan['distinct_loci']} distinct loci, "
+             f"fan-in up to {concat_plan['max_fan_in']}, {concat_plan['parallelism']} processes at a time"]
+    for stage, stage_plan in enumerate(concat_plan['stages']):
+        batch_sizes = stage_plan['batch_sizes']
+        lines.append(f"Stage {stage}: {len(batch_sizes)} batches of {min(batch_sizes)} to {max(batch_sizes)} files, "
+                     f"~{stage_plan['estimated_seconds']}s")
+    lines.append(f"Estimated duration: ~{concat_plan['estimated_seconds']}s")
+    return '\n'.join(lines)
+
+
+def make_concat_plan(vcf_files, max_fan_in: int, nextflow_config_file=None, cost_model_params: dict = None) -> dict:
+    """
+    Plan the concatenation of vcf_files with at most max_fan_in files per batch. max_fan_in is taken from the config
+    rather than from the limits of this process because the merges run on other nodes.
+    """
+    if max_fan_in < 2:
+        raise ValueError(f'At least 2 files must be concatenated at a time, got {max_fan_in}')
+    concat_plan = plan_vertical_concat(get_input_stats(vcf_files), max_fan_in,
+                                       get_executor_parallelism(nextflow_config_file),
+                                       ConcatCostModel(**(cost_model_params or {})))
+    logger.info(f"Concatenation plan:\n{describe_concat_plan(concat_plan)}")
+    return concat_plan
+
+
+def write_concat_plan(concat_plan: dict, concat_plan_file):
+    with open(concat_plan_file + '.tmp', 'w') as open_file:
+        json.dump(concat_plan, open_file, indent=2)
+    os.replace(concat_plan_file + '.tmp', concat_plan_file)
+
+
+def read_concat_plan(concat_plan_file) -> dict:
+    with open(concat_plan_file) as open_file:
+        return json.load(open_file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Plan the stages of the vertical concatenation of VCF files',
+                                     formatter_class=argparse.RawTextHelpFormatter, add_help=False)
+    parser.add_argument("--toplevel-vcf-dir",
+                        help="Full path to the directory which contains all the VCF files", required=True)
+    parser.add_argument("--max-fan-in",
+                        help="Maximum number of files concatenated in a batch", type=int, required=True)
+    parser.add_argument("--nextflow-config-file",
+                        help="Full path to the Nextflow config file", default=None, required=False)
+    parser.add_argument("--concat-plan-file",
+                        help="Full path to the JSON file the plan is written to, otherwise it is only logged",
+                        default=None, required=False)
+    args = parser.parse_args()
+    logging_config.add_stdout_handler()
+    concat_plan = make_concat_plan(sorted(glob.glob(f"{args.toplevel_vcf_dir}/*.vcf.gz")), args.max_fan_in,
+                                   args.nextflow_config_file)
+    if args.concat_plan_file:
+        write_concat_plan(concat_plan, args.concat_plan_file)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+# Copyright 2022 EMBL - European Bioinformatics Institute
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import json
+import os
+import shutil
+import time
+
+from .native_concat import native_vcf_concat
+
+from covid19dp_submission.lazy_imports import logging_config
+
+logger = logging_config.get_logger(__name__)
+
+MANIFEST_NAME = 'manifest.json'
+CURRENT_GENERATION_LINK = 'current'
+GENERATION_PREFIX = 'generation_'
+RUNS_DIR_NAME = 'runs'
+RUN_PREFIX = 'run_'
+# A run is merged with the newer runs once it holds fewer than SIZE_RATIO times their records
+DEFAULT_SIZE_RATIO = 4
+
+
+# Layout of the cumulative directory of a project, "current" is swapped to the new generation once it is complete.
+# The cumulative VCF is the merge of the runs of the current manifest, oldest first. Each run is sorted, deduplicated
+# and indexed and is never modified: an update writes the snapshot as a new run, merged with the newest runs only
+# when they are of a similar size, so that each update reads and writes about as many records as the snapshot and
+# the number of runs grows with the logarithm of the number of records.
+#
+#   cumulative_dir/
+#       current -> generation_5
+#       generation_5/
+#           manifest.json
+#       runs/
+#           run_3.vcf.gz
+#           run_3.vcf.gz.csi
+#           run_5.vcf.gz
+#           run_5.vcf.gz.csi
+def get_cumulative_vcf_files(cumulative_dir: str) -> list:
+    """
+    Return the runs of the current cumulative VCF, oldest first. Merged in this order, e.g. with native_vcf_concat,
+    they make the cumulative VCF where the records of the older snapshots are kept over their duplicates.
+    """
+    return [os.path.join(cumulative_dir, RUNS_DIR_NAME, run['file'])
+            for run in read_cumulative_manifest(cumulative_dir)['runs']]
+
+
+def read_cumulative_manifest(cumulative_dir: str) -> dict:
+    """
+    Return the manifest of the current cumulative VCF: its generation, the snapshots merged into it and its runs
+    with their snapshots and number of records. An empty manifest is returned when no snapshot was merged yet.
+    """
+    manifest_file = os.path.join(cumulative_dir, CURRENT_GENERATION_LINK, MANIFEST_NAME)
+    if not os.path.exists(manifest_file):
+        return {'generation': 0, 'snapshots': [], 'runs': []}
+    with open(manifest_file) as open_file:
+        return json.load(open_file)
+
+
+def _swap_current_generation(cumulative_dir, generation_dir):
+    # Renaming a symbolic link over another is atomic, readers see either the previous or the new manifest
+    temporary_link = os.path.join(cumulative_dir, CURRENT_GENERATION_LINK + '.tmp')
+    if os.path.lexists(temporary_link):
+        os.remove(temporary_link)
+    os.symlink(os.path.basename(generation_dir), temporary_link)
+    os.replace(temporary_link, os.path.join(cumulative_dir, CURRENT_GENERATION_LINK))
+
+
+def _remove_unused_files(cumulative_dir, manifest):
+    # Removes the previous generations and the runs they alone used, as well as those left over by an update
+    # interrupted before or after the swap of the current generation
+    current_generation = f'{GENERATION_PREFIX}{manifest["generation"]}'
+    for name in os.listdir(cumulative_dir):
+        if name.startswith(GENERATION_PREFIX) and name != current_generation:
+            shutil.rmtree(os.path.join(cumulative_dir, name), ignore_errors=True)
+    runs_dir = os.path.join(cumulative_dir, RUNS_DIR_NAME)
+    used_files = set()
+    for run in manifest['runs']:
+        used_files.update({run['file'], run['file'] + '.csi'})
+    for name in os.listdir(runs_dir):
+        if name not in used_files:
+            path = os.path.join(runs_dir, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.remove(path)
+
+
+def get_runs_to_merge(runs: list, size_ratio: int) -> int:
+    """
+    Return the number of newest runs to merge together: the newest run and each older run holding fewer than
+    size_ratio times the records of the runs newer than itself.
+    """
+    num_runs = 1
+    num_records = runs[-1]['record_count']
+    while num_runs < len(runs) and runs[-num_runs - 1]['record_count'] < size_ratio * num_records:
+        num_records += runs[-num_runs - 1]['record_count']
+        num_runs += 1
+    return num_runs
+
+
+def update_cumulative_vcf(cumulative_dir: str, snapshot_vcf_file: str, snapshot_name: str,
+                          size_ratio: int = DEFAULT_SIZE_RATIO) -> list:
+    """
+    Add the concatenated VCF of a snapshot to the cumulative VCF of the project as a new sorted, deduplicated and
+    indexed run, merged in a single pass with the newest runs that are less than size_ratio times larger.
+    The records of the older runs are kept over the duplicates of the newer ones. The runs are listed in the manifest
+    of a new generation that replaces the current one once the runs are complete, so that an interrupted update
+    leaves the previous cumulative VCF in place. A snapshot that was already added is skipped.
+    Return the runs of the cumulative VCF.
+    """
+    start_time = time.time()
+    os.makedirs(os.path.join(cumulative_dir, RUNS_DIR_NAME), exist_ok=True)
+    manifest = read_cumulative_manifest(cumulative_dir)
+    _remove_unused_files(cumulative_dir, manifest)
+    if snapshot_name in manifest['snapshots']:
+        logger.info(f'Snapshot {snapshot_name} is already in the cumulative VCF {cumulative_dir}')
+        return get_cumulative_vcf_files(cumulative_dir)
+    generation = manifest['generation'] + 1
+    generation_dir = os.path.join(cumulative_dir, f'{GENERATION_PREFIX}{generation}')
+    os.makedirs(generation_dir)
+
+    snapshot_run_file = f'{RUN_PREFIX}{generation}.vcf.gz'
+    snapshot_run = {'file': snapshot_run_file, 'snapshots': [snapshot_name], 'record_count': native_vcf_concat(
+        [snapshot_vcf_file], os.path.join(cumulative_dir, RUNS_DIR_NAME, snapshot_run_file))}
+    runs = manifest['runs'] + [snapshot_run]
+    num_runs_to_merge = get_runs_to_merge(runs, size_ratio)
+    if num_runs_to_merge > 1:
+        runs_to_merge = runs[-num_runs_to_merge:]
+        merged_run_file = f'{RUN_PREFIX}{generation}_merged.vcf.gz'
+        merged_run = {'file': merged_run_file, 'snapshots': [snapshot for run in runs_to_merge
+                                                             for snapshot in run['snapshots']],
+                      'record_count': native_vcf_concat(
+                          [os.path.join(cumulative_dir, RUNS_DIR_NAME, run['file']) for run in runs_to_merge],
+                          os.path.join(cumulative_dir, RUNS_DIR_NAME, merged_run_file))}
+        runs = runs[:-num_runs_to_merge] + [merged_run]
+    new_manifest = {'generation': generation, 'snapshots': manifest['snapshots'] + [snapshot_name], 'runs': runs}
+    with open(os.path.join(generation_dir, MANIFEST_NAME), 'w') as open_file:
+        json.dump(new_manifest, open_file, indent=2)
+
+    _swap_current_generation(cumulative_dir, generation_dir)
+    _remove_unused_files(cumulative_dir, new_manifest)
+    logger.info(f'Added snapshot {snapshot_name} to {cumulative_dir}: {snapshot_run["record_count"]} records, '
+                f'{num_runs_to_merge} runs merged, runs of {[run["record_count"] for run in runs]} records, '
+                f'in {time.time() - start_time:.1f}s')
+    return get_cumulative_vcf_files(cumulative_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Merge the concatenated VCF of a snapshot into the cumulative VCF '
+                                                 'of the project',
+                                     formatter_class=argparse.RawTextHelpFormatter, add_help=False)
+    parser.add_argument("--cumulative-dir",
+                        help="Full path to the directory of the cumulative VCF of the project", required=True)
+    parser.add_argument("--vcf-file", help="Full path to the concatenated VCF of the snapshot", required=True)
+    parser.add_argument("--snapshot-name", help="Name of the snapshot", required=True)
+    parser.add_argument("--size-ratio", help="Merge a run with the newer runs once it holds fewer than this many "
+                                             "times their records", type=int, default=DEFAULT_SIZE_RATIO,
+                        required=False)
+    args = parser.parse_args()
+    logging_config.add_stdout_handler()
+    update_cumulative_vcf(args.cumulative_dir, args.vcf_file, args.snapshot_name, args.size_ratio)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+# Copyright 2022 EMBL - European Bioinformatics Institute
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from .vcf_vertical_concat import vcf_vertical_concat
+
+from covid19dp_submission.lazy_imports import logging_config
+
+logger = logging_config.get_logger(__name__)
+
+
+def get_dynamic_concat_dir(concat_processing_dir: str):
+    return os.path.join(concat_processing_dir, "vertical_concat", "dynamic")
+
+
+# Example with 5 files, 2 files at a time and a slow merge of vcf1 and vcf2
+#
+#   vcf1  vcf2      vcf3  vcf4      vcf5
+#     \   /           \   /          |
+#    merge0 (slow)    merge1         |
+#       |                 \         /
+#       |                   merge2
+#        \                  /
+#          result_file
+class DynamicConcatScheduler:
+    """
+    Concatenate VCF files in a tree whose shape is decided while it runs: a merge starts as soon as
+    concat_chunk_size files are ready, whether they are input files or outputs of any previous merge, so that a
+    slow merge only delays the merges that need its output. The last merge, which takes all the remaining files,
+    writes to result_file.
+    """
+
+    def __init__(self, concat_processing_dir: str, concat_chunk_size: int, bcftools_binary: str,
+                 num_workers: int = 1, merge_function=vcf_vertical_concat):
+        if concat_chunk_size < 2:
+            raise ValueError(f'At least 2 files must be concatenated at a time, got {concat_chunk_size}')
+        self.concat_processing_dir = concat_processing_dir
+        self.concat_chunk_size = concat_chunk_size
+        self.bcftools_binary = bcftools_binary
+        self.num_workers = max(1, num_workers)
+        self.merge_function = merge_function
+
+    def _write_files_to_concat_list(self, files_to_concat, output_vcf_file):
+        files_to_concat_list = output_vcf_file.replace('.vcf.gz', '') + '_files_to_be_concatenated.txt'
+        os.makedirs(os.path.dirname(files_to_concat_list), exist_ok=True)
+        with open(files_to_concat_list, 'w') as handle:
+            for filename in files_to_concat:
+                handle.write(filename + "\n")
+        return files_to_concat_list
+
+    def _merge(self, merge_name, files_to_concat, output_vcf_file):
+        start_time = time.time()
+        files_to_concat_list = self._write_files_to_concat_list(files_to_concat, output_vcf_file)
+        self.merge_function(files_to_concat_list, self.concat_processing_dir, output_vcf_file, self.bcftools_binary)
+        logger.info(f"{merge_name} concatenated {len(files_to_concat)} files in {time.time() - start_time:.1f}s")
+        return output_vcf_file
+
+    def run(self, vcf_files: list, result_file: str) -> str:
+        ready_files = deque(vcf_files)
+        running_merges = {}
+        num_merges = 0
+        final_merge_started = False
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            while True:
+                while len(running_merges) < self.num_workers and not final_merge_started:
+                    if not running_merges and len(ready_files) <= self.concat_chunk_size:
+                        # Nothing else can become ready: the remaining files make the result
+                        files_to_concat = list(ready_files)
+                        ready_files.clear()
+                        output_vcf_file = result_file
+                        final_merge_started = True
+                    elif len(ready_files) >= self.concat_chunk_size:
+                        files_to_concat = [ready_files.popleft() for _ in range(self.concat_chunk_size)]
+                        output_vcf_file = os.path.join(get_dynamic_concat_dir(self.concat_processing_dir),
+                                                       f"concat_output_merge{num_merges}.vcf.gz")
+                    else:
+                        break
+                    merge_name = f"concat_merge{num_merges}"
+                    logger.info(f"Starting {merge_name} of {len(files_to_concat)} files "
+                                f"({len(running_merges)} merges running, {len(ready_files)} files waiting)")
+                    running_merges[executor.submit(self._merge, merge_name, files_to_concat, output_vcf_file)] = \
+                        merge_name
+                    num_merges += 1
+                if not running_merges:
+                    break
+                finished_merges, _ = wait(running_merges, return_when=FIRST_COMPLETED)
+                for finished_merge in finished_merges:
+                    del running_merges[finished_merge]
+                    # A failed merge stops the scheduling, the running merges are left to finish
+                    ready_files.append(finished_merge.result())
+        logger.info(f"Concatenated {len(vcf_files)} files in {num_merges} merges into {result_file}")
+        return result_file
@@ -0,0 +1,117 @@
+# Copyright 2022 EMBL - European Bioinformatics Institute
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from .vcf_vertical_concat import vcf_vertical_concat
+
+from covid19dp_submission.lazy_imports import logging_config
+
+logger = logging_config.get_logger(__name__)
+
+
+class LocalConcatExecutor:
+    """
+    Run the stages and batches of a multi-stage concatenation in this process, with up to num_workers bcftools
+    merges running at the same time, instead of generating a Nextflow pipeline that starts an interpreter for each
+    batch. A batch starts as soon as the batches of the previous stage it depends on are done.
+    Each stage is a list of batches, each batch a dict with its name, the files to concatenate, the file listing
+    them, the output file and the indexes of the batches of the previous stage it depends on.
+    With resume, the batches whose output was indexed by a previous run with the same files are not run again,
+    unless one of the batches they depend on had to run again.
+    """
+
+    def __init__(self, concat_processing_dir: str, bcftools_binary: str, num_workers: int = 1,
+                 merge_function=vcf_vertical_concat):
+        self.concat_processing_dir = concat_processing_dir
+        self.bcftools_binary = bcftools_binary
+        self.num_workers = max(1, num_workers)
+        self.merge_function = merge_function
+
+    @staticmethod
+    def _is_complete(batch) -> bool:
+        # The index is written after the output so an interrupted merge never looks complete
+        if not os.path.exists(batch['output_vcf_file'] + '.csi') or not os.path.exists(batch['files_to_concat_list']):
+            return False
+        with open(batch['files_to_concat_list']) as open_file:
+            return open_file.read().split() == batch['files']
+
+    def _merge(self, batch):
+        start_time = time.time()
+        # The output of a previous run is removed first so that a merge interrupted while rewriting it, with the
+        # same list of files, is not taken for complete
+        for previous_file in (batch['output_vcf_file'] + '.csi', batch['output_vcf_file']):
+            if os.path.exists(previous_file):
+                os.remove(previous_file)
+        os.makedirs(os.path.dirname(batch['files_to_concat_list']), exist_ok=True)
+        with open(batch['files_to_concat_list'], 'w') as handle:
+            for filename in batch['files']:
+                handle.write(filename + "\n")
+        self.merge_function(batch['files_to_concat_list'], self.concat_processing_dir, batch['output_vcf_file'],
+                            self.bcftools_binary)
+        logger.info(f"{batch['name']} concatenated {len(batch['files'])} files in {time.time() - start_time:.1f}s")
+
+    def run(self, stages: list, resume: bool = False):
+        # Batches waiting for the previous stage, by stage and batch index, with the number of batches they wait for
+        pending = {(stage, batch): len(stage_batches[batch]['dependencies'])
+                   for stage, stage_batches in enumerate(stages) for batch in range(len(stage_batches))}
+        dependents = {}
+        for stage, stage_batches in enumerate(stages[1:], start=1):
+            for batch, batch_info in enumerate(stage_batches):
+                for dependency in batch_info['dependencies']:
+                    dependents.setdefault((stage - 1, dependency), []).append((stage, batch))
+        ready = sorted(key for key, num_dependencies in pending.items() if num_dependencies == 0)
+        running = {}
+        merged = set()
+        num_skipped = 0
+        failure = None
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            while ready or running:
+                while ready and failure is None and len(running) < self.num_workers:
+                    key = ready.pop(0)
+                    batch = stages[key[0]][key[1]]
+                    dependencies_merged = any((key[0] - 1, dependency) in merged
+                                              for dependency in batch['dependencies'])
+                    if resume and not dependencies_merged and self._is_complete(batch):
+                        logger.info(f"{batch['name']} was completed by a previous run")
+                        num_skipped += 1
+                        ready.extend(self._release_dependents(key, pending, dependents))
+                        continue
+                    running[executor.submit(self._merge, batch)] = key
+                if not running:
+                    break
+                finished_merges, _ = wait(running, return_when=FIRST_COMPLETED)
+                for finished_merge in finished_merges:
+                    key = running.pop(finished_merge)
+                    if finished_merge.exception() is not None:
+                        # The running merges are left to finish but no other merge is started
+                        failure = failure or finished_merge.exception()
+                        continue
+                    merged.add(key)
+                    ready.extend(self._release_dependents(key, pending, dependents))
+        if failure is not None:
+            raise failure
+        logger.info(f"Ran {len(pending) - num_skipped} concatenation batches in {len(stages)} stages "
+                    f"({num_skipped} completed by a previous run)")
+
+    @staticmethod
+    def _release_dependents(key, pending, dependents):
+        released = []
+        for dependent in dependents.get(key, []):
+            pending[dependent] -= 1
+            if pending[dependent] == 0:
+                released.append(dependent)
+        return released
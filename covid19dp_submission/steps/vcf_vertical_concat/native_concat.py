@@ -0,0 +1,271 @@
+# Copyright 2022 EMBL - European Bioinformatics Institute
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import heapq
+import os
+import re
+import struct
+import tempfile
+import time
+from operator import itemgetter
+
+from covid19dp_submission.bgzf import BgzfWriter
+from covid19dp_submission.csi_index import CsiIndexBuilder, add_vcf_record
+from covid19dp_submission.lazy_imports import logging_config
+from covid19dp_submission.vcf_reader import iter_decompressed_chunks, iter_lines_from_chunks
+
+logger = logging_config.get_logger(__name__)
+
+# Inputs opened at the same time, more inputs are merged in several passes through temporary files
+DEFAULT_MAX_OPEN_FILES = 512
+STRUCTURED_HEADER_LINE = re.compile(rb'^##([A-Za-z_]+)=<ID=([^,>]+)')
+FLOAT_INFO_HEADER_LINE = re.compile(rb'^##INFO=<ID=([^,>]+),.*Type=Float')
+
+
+class VcfConcatError(Exception):
+    pass
+
+
+class VcfStream:
+    """
+    Sequential reader of a VCF file that reads its header when it is opened and then yields its data lines.
+    Each stream decompresses its file in the calling thread so that thousands of streams can be open at once.
+    """
+
+    def __init__(self, vcf_file):
+        self.vcf_file = vcf_file
+        self._lines = iter_lines_from_chunks(iter_decompressed_chunks(vcf_file, num_threads=1))
+        self.header_lines = []
+        self.column_header = None
+        for line in self._lines:
+            if line.startswith(b'##'):
+                self.header_lines.append(line)
+            elif line.startswith(b'#'):
+                self.column_header = line
+                break
+            elif line:
+                break
+        if self.column_header is None:
+            self.close()
+            raise VcfConcatError(f'No header line found in {vcf_file}')
+
+    def iter_records(self):
+        for line in self._lines:
+            if line:
+                yield line
+
+    def close(self):
+        self._lines.close()
+
+
+def _get_header_key(line: bytes):
+    # Structured lines are identified by their type and ID, other lines by their whole content
+    match = STRUCTURED_HEADER_LINE.match(line)
+    return (match.group(1), match.group(2)) if match else line
+
+
+def merge_headers(streams: list) -> list:
+    """
+    Return the header lines of the first stream followed by the lines of the other streams that define something
+    new, like bcftools merges the headers of the files it concatenates.
+    """
+    merged_lines = list(streams[0].header_lines)
+    header_keys = {_get_header_key(line) for line in merged_lines}
+    for stream in streams[1:]:
+        if stream.column_header != streams[0].column_header:
+            raise VcfConcatError(f'The columns of {stream.vcf_file} differ from the columns of '
+                                 f'{streams[0].vcf_file}')
+        for line in stream.header_lines:
+            header_key = _get_header_key(line)
+            if header_key not in header_keys and not line.startswith(b'##fileformat='):
+                merged_lines.append(line)
+                header_keys.add(header_key)
+    return merged_lines + [streams[0].column_header]
+
+
+def _format_float(value: bytes) -> bytes:
+    # bcftools stores the values as single precision floats and prints them like printf's %g
+    if value == b'.':
+        return value
+    try:
+        return b'%g' % struct.unpack('<f', struct.pack('<f', float(value)))[0]
+    except (ValueError, OverflowError):
+        return value
+
+
+class RecordFormatter:
+    """
+    Write the QUAL and the Float INFO values of the records like bcftools does, so that the output matches the
+    output of bcftools concat.
+    """
+
+    def __init__(self, header_lines: list):
+        self.float_info_ids = {match.group(1) for match in map(FLOAT_INFO_HEADER_LINE.match, header_lines) if match}
+
+    def format(self, line: bytes) -> bytes:
+        fields = line.split(b'\t', 8)
+        if len(fields) < 8:
+            return line
+        fields[5] = _format_float(fields[5])
+        if self.float_info_ids and fields[7] != b'.':
+            info_fields = fields[7].split(b';')
+            for index, info_field in enumerate(info_fields):
+                key, separator, value = info_field.partition(b'=')
+                if separator and key in self.float_info_ids:
+                    info_fields[index] = key + b'=' + b','.join(_format_float(v) for v in value.split(b','))
+            fields[7] = b';'.join(info_fields)
+        return b'\t'.join(fields)
+
+
+def get_contig_ranks(header_lines: list) -> dict:
+    """
+    Return the rank of each contig in the order of the ##contig lines of the header.
+    """
+    contig_ranks = {}
+    for match in map(STRUCTURED_HEADER_LINE.match, header_lines):
+        if match and match.group(1) == b'contig':
+            contig_ranks.setdefault(match.group(2), len(contig_ranks))
+    return contig_ranks
+
+
+def _iter_keyed_records(stream: VcfStream, stream_index: int, contig_ranks: dict):
+    previous_key = None
+    for line in stream.iter_records():
+        chrom, pos, _, ref, alt = line.split(b'\t', 5)[:5]
+        # Contigs missing from the header are sorted after the others, in the order they are first seen
+        key = (contig_ranks.setdefault(chrom, len(contig_ranks)), int(pos))
+        if previous_key is not None and key < previous_key:
+            raise VcfConcatError(f'{stream.vcf_file} is not sorted at {chrom.decode()}:{pos.decode()}')
+        previous_key = key
+        yield key, stream_index, ref, alt, line
+
+
+def merge_sorted_streams(streams: list, header_lines: list = None):
+    """
+    Yield the records of the sorted streams in position order with a heap based k-way merge. The contigs are in the
+    order of the merged header, header_lines, like bcftools sorts them.
+    Like bcftools concat --allow-overlaps --remove-duplicates, a record with the same position, REF and ALT as a
+    record of a previous stream is left out, the records at the same position are in the order of the streams and
+    the duplicates within a stream are kept.
+    """
+    contig_ranks = get_contig_ranks(merge_headers(streams) if header_lines is None else header_lines)
+    merged_records = heapq.merge(*(_iter_keyed_records(stream, index, contig_ranks)
+                                   for index, stream in enumerate(streams)), key=itemgetter(0))
+    current_key = None
+    first_stream_of_locus = {}
+    for key, stream_index, ref, alt, line in merged_records:
+        if key != current_key:
+            current_key = key
+            first_stream_of_locus = {}
+        if first_stream_of_locus.setdefault((ref, alt), stream_index) != stream_index:
+            continue
+        yield line
+
+
+def _concat_batch(vcf_files: list, output_vcf_file: str, compressed: bool) -> int:
+    """
+    Merge vcf_files into output_vcf_file, BGZF compressed and indexed or as plain text for the intermediate files.
+    Return the number of records written.
+    """
+    streams = []
+    num_records = 0
+    partial_output_file = f'{output_vcf_file}.part'
+    try:
+        for vcf_file in vcf_files:
+            streams.append(VcfStream(vcf_file))
+        header_lines = merge_headers(streams)
+        formatter = RecordFormatter(header_lines)
+        index_builder = CsiIndexBuilder()
+        last_record = None
+        with (BgzfWriter(partial_output_file) if compressed else open(partial_output_file, 'wb')) as writer:
+            writer.write(b'\n'.join(header_lines) + b'\n')
+            for line in merge_sorted_streams(streams, header_lines):
+                line = formatter.format(line)
+                if compressed:
+                    if last_record:
+                        add_vcf_record(index_builder, *last_record)
+                    start_offset = writer.tell()
+                    writer.write(line + b'\n')
+                    last_record = [line, start_offset, writer.tell()]
+                else:
+                    writer.write(line + b'\n')
+                num_records += 1
+            if last_record:
+                # Like htslib, the end of the last block is indexed as the start of the next block
+                writer.flush()
+                last_record[2] = writer.tell()
+                add_vcf_record(index_builder, *last_record)
+        os.replace(partial_output_file, output_vcf_file)
+        if compressed:
+            index_builder.write(f'{output_vcf_file}.csi')
+    finally:
+        for stream in streams:
+            stream.close()
+        if os.path.exists(partial_output_file):
+            os.remove(partial_output_file)
+    return num_records
+
+
+def native_vcf_concat(vcf_files: list, output_vcf_file: str, max_open_files: int = DEFAULT_MAX_OPEN_FILES) -> int:
+    """
+    Concatenate sorted VCF files into a BGZF compressed output with its CSI index in a single process, like
+    "bcftools concat --allow-overlaps --remove-duplicates" followed by "bcftools index --csi".
+    At most max_open_files inputs are open at the same time: larger sets of files are first merged in batches into
+    temporary files, in the order of the files so that the duplicates kept are the same.
+    Return the number of records written.
+    """
+    if not vcf_files:
+        raise VcfConcatError('No VCF file to concatenate')
+    if max_open_files < 2:
+        raise ValueError(f'At least 2 files must be open at the same time, got {max_open_files}')
+    start_time = time.time()
+    from more_itertools import chunked
+    os.makedirs(os.path.dirname(os.path.abspath(output_vcf_file)), exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(output_vcf_file))) as temp_dir:
+        files_to_concat = list(vcf_files)
+        merge_pass = 0
+        while len(files_to_concat) > max_open_files:
+            intermediate_files = []
+            for batch_index, batch in enumerate(chunked(files_to_concat, max_open_files)):
+                intermediate_file = os.path.join(temp_dir, f'pass{merge_pass}_batch{batch_index}.vcf')
+                _concat_batch(batch, intermediate_file, compressed=False)
+                intermediate_files.append(intermediate_file)
+            logger.info(f'Merged {len(files_to_concat)} files into {len(intermediate_files)} intermediate files')
+            files_to_concat = intermediate_files
+            merge_pass += 1
+        num_records = _concat_batch(files_to_concat, output_vcf_file, compressed=True)
+    logger.info(f'Concatenated {len(vcf_files)} files into {output_vcf_file}: {num_records} records in '
+                f'{time.time() - start_time:.1f}s')
+    return num_records
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Vertically concatenate sorted VCF files in a single process',
+                                     formatter_class=argparse.RawTextHelpFormatter, add_help=False)
+    parser.add_argument("--files-to-concat-list",
+                        help="Text file containing the list of VCF files to concatenate", required=True)
+    parser.add_argument("--output-vcf-file",
+                        help="Full path to the concatenation output file", required=True)
+    parser.add_argument("--max-open-files", help="Maximum number of input files open at the same time", type=int,
+                        default=DEFAULT_MAX_OPEN_FILES, required=False)
+    args = parser.parse_args()
+    logging_config.add_stdout_handler()
+    with open(args.files_to_concat_list) as open_file:
+        vcf_files = [line.strip() for line in open_file if line.strip()]
+    native_vcf_concat(vcf_files, args.output_vcf_file, args.max_open_files)
+
+
+if __name__ == "__main__":
+    main()
@@ -20,10 +20,16 @@ import os
 import shutil
 import sys
 
+from .concat_planner import describe_concat_plan, get_plan_batch_sizes, make_concat_plan, read_concat_plan, \
+    write_concat_plan
+from .dynamic_scheduler import DynamicConcatScheduler
+from .local_executor import LocalConcatExecutor
+from .native_concat import native_vcf_concat
 from .vcf_vertical_concat import vcf_vertical_concat
-from ebi_eva_common_pyutils.command_utils import run_command_with_output
-from ebi_eva_common_pyutils.logger import logging_config
-from ebi_eva_common_pyutils.nextflow import NextFlowPipeline, NextFlowProcess
+
+from covid19dp_submission.lazy_imports import logging_config
+from covid19dp_submission.vcf_reader import DistinctLoci
+from covid19dp_submission.vcf_summary import write_vcf_summary
 
 logger = logging_config.get_logger(__name__)
 
@@ -41,7 +47,8 @@ def get_python_process_command_string(python_program, args: dict, log_file: str)
 
 def get_multistage_vertical_concat_pipeline(vcf_files, concat_processing_dir, concat_chunk_size, bcftools_binary,
                                             stage=0, prev_stage_processes=[],
-                                            pipeline=NextFlowPipeline()) -> (NextFlowPipeline, str):
+                                            pipeline=None,
+                                            batch_sizes_per_stage=None) -> ('NextFlowPipeline', str):
     """
     # Generate Nextflow pipeline for multi-stage VCF concatenation of 5 VCF files with 2-VCFs concatenated at a time (CONCAT_CHUNK_SIZE=2)
     # For illustration purposes only. Usually the CONCAT_CHUNK_SIZE is much higher (ex: 500).
@@ -59,15 +66,26 @@ def get_multistage_vertical_concat_pipeline(vcf_files, concat_processing_dir, co
     # Stage2:	  		 		   \		 	                      /
     # -------	   		  			\	                            /
     #						      vcf1_2_3_4_5=concat(vcf1_2_3_4,vcf5)          <----- Final result
+    #
+    # batch_sizes_per_stage, e.g. from a concatenation plan, gives the number of files of each batch of each stage
+    # instead of concat_chunk_size
     """
+    # Imported here as it imports networkx, which the other executors do not need
+    from ebi_eva_common_pyutils.nextflow import NextFlowPipeline, NextFlowProcess
+    if pipeline is None:
+        pipeline = NextFlowPipeline()
     if len(vcf_files) == 1: # If we are left with only one file, this means we have reached the last concat stage
         return pipeline, vcf_files[0]
-    num_batches_in_stage = math.ceil(len(vcf_files) / concat_chunk_size)
+    if batch_sizes_per_stage:
+        batch_sizes = batch_sizes_per_stage[stage]
+    else:
+        batch_sizes = get_fixed_batch_sizes(len(vcf_files), concat_chunk_size)
+    batch_starts = [sum(batch_sizes[:batch]) for batch in range(len(batch_sizes) + 1)]
     curr_stage_processes = []
     output_vcf_files_from_stage = []
-    for batch in range(0, num_batches_in_stage):
-        # split files in the current stage into chunks based on concat_chunk_size
-        files_in_batch = vcf_files[(concat_chunk_size * batch):(concat_chunk_size * (batch + 1))]
+    for batch in range(0, len(batch_sizes)):
+        # split files in the current stage into chunks based on concat_chunk_size or the plan
+        files_in_batch = vcf_files[batch_starts[batch]:batch_starts[batch + 1]]
         files_to_concat_list = write_files_to_concat_list(files_in_batch, stage, batch, concat_processing_dir)
         concat_stage_batch_name = f"concat_stage{stage}_batch{batch}"
         log_file_name = os.path.join(concat_processing_dir, f"{concat_stage_batch_name}.log")
@@ -90,22 +108,61 @@ def get_multistage_vertical_concat_pipeline(vcf_files, concat_processing_dir, co
         # Ex: In the illustration above stage 1/batch 0 depends on completion of stage 0/batch 0 and stage 0/batch 1
         # While output of any n batches from the previous stage can be worked on as they become available,
         # having a predictable formula simplifies pipeline generation and troubleshooting
-        prev_stage_dependencies = prev_stage_processes[(concat_chunk_size * batch):(concat_chunk_size * (batch + 1))]
+        prev_stage_dependencies = prev_stage_processes[batch_starts[batch]:batch_starts[batch + 1]]
         pipeline.add_dependencies({process: prev_stage_dependencies})
     prev_stage_processes = curr_stage_processes
     return get_multistage_vertical_concat_pipeline(output_vcf_files_from_stage,
                                                    concat_processing_dir, concat_chunk_size,
                                                    bcftools_binary,
                                                    stage=stage+1, prev_stage_processes=prev_stage_processes,
-                                                   pipeline=pipeline)
+                                                   pipeline=pipeline, batch_sizes_per_stage=batch_sizes_per_stage)
+
+
+def get_fixed_batch_sizes(num_files, concat_chunk_size):
+    num_batches = math.ceil(num_files / concat_chunk_size)
+    return [min(concat_chunk_size, num_files - concat_chunk_size * batch) for batch in range(num_batches)]
+
+
+def get_vertical_concat_stages(vcf_files, concat_processing_dir, concat_chunk_size,
+                               batch_sizes_per_stage=None) -> list:
+    """
+    Return the batches of each stage of the multi-stage concatenation, with the same files, file lists, outputs and
+    dependencies as the Nextflow pipeline of get_multistage_vertical_concat_pipeline.
+    """
+    stages = []
+    stage = 0
+    while len(vcf_files) > 1:
+        if batch_sizes_per_stage:
+            batch_sizes = batch_sizes_per_stage[stage]
+        else:
+            batch_sizes = get_fixed_batch_sizes(len(vcf_files), concat_chunk_size)
+        batch_starts = [sum(batch_sizes[:batch]) for batch in range(len(batch_sizes) + 1)]
+        stage_batches = []
+        for batch in range(len(batch_sizes)):
+            stage_batches.append({
+                'name': f"concat_stage{stage}_batch{batch}",
+                'files': vcf_files[batch_starts[batch]:batch_starts[batch + 1]],
+                'files_to_concat_list': get_files_to_concat_list_name(stage, batch, concat_processing_dir),
+                'output_vcf_file': get_output_vcf_file_name(stage, batch, concat_processing_dir),
+                # The first stage has no dependency
+                'dependencies': list(range(batch_starts[batch], batch_starts[batch + 1])) if stage else []
+            })
+        stages.append(stage_batches)
+        vcf_files = [batch['output_vcf_file'] for batch in stage_batches]
+        stage += 1
+    return stages
+
+
+def get_files_to_concat_list_name(concat_stage, concat_batch, concat_processing_dir):
+    return os.path.join(get_concat_output_dir(concat_stage, concat_processing_dir),
+                        f"batch{concat_batch}_files_to_be_concatenated.txt")
 
 
 def write_files_to_concat_list(files_to_concat, concat_stage, concat_batch, concat_processing_dir):
     """
     Write the list of files to be concatenated for a given stage and batch
     """
-    files_to_concat_list = os.path.join(get_concat_output_dir(concat_stage, concat_processing_dir),
-                                        f"batch{concat_batch}_files_to_be_concatenated.txt")
+    files_to_concat_list = get_files_to_concat_list_name(concat_stage, concat_batch, concat_processing_dir)
     os.makedirs(os.path.dirname(files_to_concat_list), exist_ok=True)
     with open(files_to_concat_list, "w") as handle:
         for filename in files_to_concat:
@@ -136,36 +193,110 @@ def get_concat_result_file_name(concat_processing_dir: str, total_number_of_vcf_
                                     concat_processing_dir=concat_processing_dir)
 
 
-def validate_vertical_concat(input_vcf_dir: str, concat_vcf_file: str) -> bool:
+def get_planned_concat_result_file_name(concat_processing_dir: str, concat_plan: dict) -> str:
+    return get_output_vcf_file_name(concat_stage_index=len(concat_plan['stages']) - 1, concat_batch_index=0,
+                                    concat_processing_dir=concat_processing_dir)
+
+
+def get_or_make_concat_plan(concat_plan_file, vcf_files, concat_chunk_size, nextflow_config_file) -> dict:
+    """
+    Return the plan of concat_plan_file, making and writing it if it does not exist yet.
+    """
+    if os.path.exists(concat_plan_file):
+        return read_concat_plan(concat_plan_file)
+    concat_plan = make_concat_plan(vcf_files, concat_chunk_size, nextflow_config_file)
+    write_concat_plan(concat_plan, concat_plan_file)
+    return concat_plan
+
+
+def validate_vertical_concat(input_vcf_dir: str, concat_vcf_file: str, max_reported_loci: int = 20) -> bool:
     """
     Ensure that the vertical concatenated VCF file reproduced all the unique coordinates in the input VCF files
     """
-    num_loci_in_input = int(run_command_with_output(f"Count distinct loci from input files in {input_vcf_dir}...",
-                                                    f"find {input_vcf_dir} -maxdepth 1 -iname '*.vcf.gz'  "
-                                                    f"| xargs -i zcat {{}} | grep -v ^# | cut -f1,2,4,5 | sort | uniq "
-                                                    f"| wc -l", return_process_output=True))
-    num_loci_in_output = int(run_command_with_output(f"Count distinct loci from output file: {concat_vcf_file}...",
-                                                     f"zcat {concat_vcf_file} | grep -v ^# | wc -l",
-                                                     return_process_output=True))
-    return num_loci_in_output == num_loci_in_input
+    logger.info(f"Count distinct loci from input files in {input_vcf_dir}...")
+    input_loci = DistinctLoci()
+    for input_vcf_file in sorted(glob.glob(os.path.join(input_vcf_dir, '*.vcf.gz'))):
+        input_loci.add_vcf(input_vcf_file)
+    logger.info(f"Count distinct loci from output file: {concat_vcf_file}...")
+    output_loci = DistinctLoci()
+    # Summarise the output while reading it so that the following steps do not need to read it again
+    write_vcf_summary(concat_vcf_file, loci=output_loci)
+    num_loci_in_input = len(input_loci)
+    num_loci_in_output = output_loci.num_records
+    logger.info(f"Found {num_loci_in_input} distinct loci in {input_loci.num_records} input records and "
+                f"{num_loci_in_output} records in the output file")
+    missing_loci = list(input_loci.difference(output_loci))
+    if missing_loci:
+        logger.error(f"{len(missing_loci)} loci from the input files are missing from {concat_vcf_file}. "
+                     f"First missing loci (CHROM, POS, REF, ALT): {missing_loci[:max_reported_loci]}")
+    return num_loci_in_output == num_loci_in_input and not missing_loci
 
 
 def run_vcf_vertical_concat_pipeline(toplevel_vcf_dir, concat_processing_dir, concat_chunk_size,
-                                     bcftools_binary, nextflow_binary, nextflow_config_file, resume):
+                                     bcftools_binary, nextflow_binary, nextflow_config_file, resume,
+                                     scheduler='static', num_workers=1, engine='bcftools', concat_plan_file=None,
+                                     dry_run=False, executor='nextflow'):
+    """
+    Concatenate the VCF files of toplevel_vcf_dir in several stages. The static scheduler runs a Nextflow pipeline
+    where each batch depends on a fixed set of batches of the previous stage. The dynamic scheduler starts a merge
+    as soon as concat_chunk_size files are ready, with up to num_workers merges running at the same time.
+    The native engine instead merges all the files in this process without intermediate stages.
+    With concat_plan_file, the batches of each stage are those of the plan, which is made by the cost model planner
+    if the file does not exist, and concat_chunk_size is only the maximum number of files of a batch. The result is
+    written to the file named by get_planned_concat_result_file_name, otherwise by get_concat_result_file_name.
+    With dry_run, the stages are only logged.
+    The static tree runs as a Nextflow pipeline or, with the local executor, in this process with up to num_workers
+    merges at the same time. The local executor keeps the outputs of a previous run when resuming.
+    """
     vcf_files = sorted(glob.glob(f"{toplevel_vcf_dir}/*.vcf.gz"))
-    expected_result_file = get_concat_result_file_name(concat_processing_dir, len(vcf_files), concat_chunk_size)
-    if os.path.exists(concat_processing_dir):
+    batch_sizes_per_stage = None
+    if concat_plan_file:
+        concat_plan = get_or_make_concat_plan(concat_plan_file, vcf_files, concat_chunk_size, nextflow_config_file)
+        batch_sizes_per_stage = get_plan_batch_sizes(concat_plan, len(vcf_files))
+        expected_result_file = get_planned_concat_result_file_name(concat_processing_dir, concat_plan)
+        if dry_run:
+            logger.info(f"Concatenation plan {concat_plan_file}:\n{describe_concat_plan(concat_plan)}")
+    else:
+        expected_result_file = get_concat_result_file_name(concat_processing_dir, len(vcf_files), concat_chunk_size)
+        if dry_run:
+            num_files = len(vcf_files)
+            while num_files > 1:
+                batch_sizes = get_fixed_batch_sizes(num_files, concat_chunk_size)
+                logger.info(f"{len(batch_sizes)} batches of up to {concat_chunk_size} files")
+                num_files = len(batch_sizes)
+    if dry_run:
+        logger.info(f"Dry run: the result would be written to {expected_result_file}")
+        return
+    resume_locally = resume and executor == 'local' and engine == 'bcftools' and scheduler == 'static'
+    if os.path.exists(concat_processing_dir) and not resume_locally:
         logger.warning(f'Previous concatenation process output will be deleted: {concat_processing_dir}')
         shutil.rmtree(concat_processing_dir)
-    os.makedirs(concat_processing_dir)
-
-    pipeline, concat_result_file = get_multistage_vertical_concat_pipeline(vcf_files, concat_processing_dir,
-                                                                           concat_chunk_size, bcftools_binary)
-    assert expected_result_file == concat_result_file, \
-        f"FAIL: Expected result file in: {expected_result_file} but got {concat_result_file} instead."
-    pipeline.run_pipeline(workflow_file_path=os.path.join(concat_processing_dir, "vertical_concat.nf"),
-                          nextflow_binary_path=nextflow_binary, nextflow_config_path=nextflow_config_file,
-                          resume=resume)
+    os.makedirs(concat_processing_dir, exist_ok=True)
+
+    if engine == 'native':
+        native_vcf_concat(vcf_files, expected_result_file)
+        concat_result_file = expected_result_file
+    elif scheduler == 'dynamic':
+        # The dynamic scheduler merges as many files at a time as the largest batches of the plan
+        dynamic_chunk_size = max(batch_sizes_per_stage[0]) if batch_sizes_per_stage else concat_chunk_size
+        concat_result_file = DynamicConcatScheduler(concat_processing_dir, dynamic_chunk_size, bcftools_binary,
+                                                    num_workers).run(vcf_files, expected_result_file)
+    elif executor == 'local':
+        stages = get_vertical_concat_stages(vcf_files, concat_processing_dir, concat_chunk_size,
+                                            batch_sizes_per_stage)
+        concat_result_file = stages[-1][0]['output_vcf_file'] if stages else vcf_files[0]
+        assert expected_result_file == concat_result_file, \
+            f"FAIL: Expected result file in: {expected_result_file} but got {concat_result_file} instead."
+        LocalConcatExecutor(concat_processing_dir, bcftools_binary, num_workers).run(stages, resume)
+    else:
+        pipeline, concat_result_file = get_multistage_vertical_concat_pipeline(
+            vcf_files, concat_processing_dir, concat_chunk_size, bcftools_binary,
+            batch_sizes_per_stage=batch_sizes_per_stage)
+        assert expected_result_file == concat_result_file, \
+            f"FAIL: Expected result file in: {expected_result_file} but got {concat_result_file} instead."
+        pipeline.run_pipeline(workflow_file_path=os.path.join(concat_processing_dir, "vertical_concat.nf"),
+                              nextflow_binary_path=nextflow_binary, nextflow_config_path=nextflow_config_file,
+                              resume=resume)
     assert validate_vertical_concat(toplevel_vcf_dir, concat_result_file), \
         f"FAIL: Number of distinct loci in the output file: {concat_result_file} did not match " \
         f"those from the input files in: {toplevel_vcf_dir}."
@@ -192,10 +323,29 @@ def main():
     parser.add_argument("--resume",
                         help="Indicate if a previous concatenation job is to be resumed", action='store_true',
                         required=False)
+    parser.add_argument("--scheduler", help="static: Nextflow pipeline with a fixed tree of batches\n"
+                                            "dynamic: merge any concat-chunk-size files as soon as they are ready",
+                        choices=['static', 'dynamic'], default='static', required=False)
+    parser.add_argument("--num-workers", help="Number of merges running at the same time with the dynamic scheduler "
+                                              "or the local executor",
+                        type=int, default=1, required=False)
+    parser.add_argument("--engine", help="bcftools: concatenate the files with bcftools concat in several stages\n"
+                                         "native: merge all the files in a single process",
+                        choices=['bcftools', 'native'], default='bcftools', required=False)
+    parser.add_argument("--concat-plan-file",
+                        help="JSON file with the batches of each stage, made by the cost model planner if it does "
+                             "not exist", default=None, required=False)
+    parser.add_argument("--executor", help="nextflow: run the static tree as a Nextflow pipeline\n"
+                                           "local: run the static tree in this process",
+                        choices=['nextflow', 'local'], default='nextflow', required=False)
+    parser.add_argument("--dry-run", help="Only log the stages of the concatenation", action='store_true',
+                        required=False)
     args = parser.parse_args()
     logging_config.add_stdout_handler()
     run_vcf_vertical_concat_pipeline(args.toplevel_vcf_dir, args.concat_processing_dir, args.concat_chunk_size,
-                                     args.bcftools_binary, args.nextflow_binary, args.nextflow_config_file, args.resume)
+                                     args.bcftools_binary, args.nextflow_binary, args.nextflow_config_file, args.resume,
+                                     args.scheduler, args.num_workers, args.engine, args.concat_plan_file,
+                                     args.dry_run, args.executor)
 
 
 if __name__ == "__main__":
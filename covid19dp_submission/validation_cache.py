@@ -0,0 +1,161 @@
+# Copyright 2022 EMBL - European Bioinformatics Institute
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import functools
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import threading
+import time
+
+from covid19dp_submission.lazy_imports import logging_config
+from covid19dp_submission.vcf_summary import get_vcf_summary
+
+logger = logging_config.get_logger(__name__)
+
+DEFAULT_MAX_SIZE_MB = 100
+CACHE_ENTRY_SUFFIX = '.json'
+
+
+def _get_file_identity(file_path) -> str:
+    file_stat = os.stat(file_path)
+    return f'{os.path.basename(file_path)}:{file_stat.st_size}:{file_stat.st_mtime_ns}'
+
+
+@functools.lru_cache(maxsize=None)
+def get_tool_version(binary: str) -> str:
+    """
+    Return the version reported by "binary --version" along with the identity of the binary file, so that the
+    results of a reinstalled tool are not mistaken for the results of the previous installation.
+    """
+    binary_path = shutil.which(binary) or binary
+    try:
+        process = subprocess.run([binary_path, '--version'], stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                 timeout=60)
+        version_lines = process.stdout.decode(errors='replace').strip().splitlines()
+        version = version_lines[0] if version_lines else ''
+    except (OSError, subprocess.SubprocessError):
+        version = ''
+    try:
+        return f'{version}|{_get_file_identity(binary_path)}'
+    except OSError:
+        return f'{version}|{binary}'
+
+
+class ValidationCache:
+    """
+    Outcomes of the checks of VCF files stored on disk, one file per entry, under a key derived from the MD5 of the
+    decompressed content of the VCF file, the check, the version of the tool and the reference assembly. The same
+    content is therefore only checked once across snapshots, whatever the name of the file.
+    Entries are evicted, least recently used first, when the cache grows above max_size_bytes.
+    """
+
+    def __init__(self, cache_dir, max_size_bytes=DEFAULT_MAX_SIZE_MB * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_size_bytes = max_size_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def get_key(self, vcf_file, check: str, tool_binary: str, assembly_files: tuple = ()) -> str:
+        key_fields = {
+            'check': check,
+            'content_md5': get_vcf_summary(vcf_file)['content_md5'],
+            'tool_version': get_tool_version(tool_binary),
+            'assembly': [_get_file_identity(assembly_file) for assembly_file in assembly_files]
+        }
+        return hashlib.sha256(json.dumps(key_fields, sort_keys=True).encode()).hexdigest()
+
+    def _get_entry_file(self, key):
+        # Entries are spread in sub-directories to keep the directories small
+        return os.path.join(self.cache_dir, key[:2], key + CACHE_ENTRY_SUFFIX)
+
+    def get(self, key) -> dict or None:
+        entry_file = self._get_entry_file(key)
+        try:
+            with open(entry_file) as open_file:
+                result = json.load(open_file)['result']
+            # Refresh the modification time used to evict the least recently used entries
+            os.utime(entry_file)
+        except (OSError, ValueError, KeyError):
+            result = None
+        with self._lock:
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return result
+
+    def put(self, key, result: dict):
+        entry_file = self._get_entry_file(key)
+        os.makedirs(os.path.dirname(entry_file), exist_ok=True)
+        # Write to a temporary file first so that concurrent readers never see a partial entry
+        temporary_file = f'{entry_file}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temporary_file, 'w') as open_file:
+            json.dump({'created': time.time(), 'result': result}, open_file)
+        os.replace(temporary_file, entry_file)
+
+    def _list_entries(self):
+        entries = []
+        for sub_dir in os.scandir(self.cache_dir):
+            if not sub_dir.is_dir():
+                continue
+            for entry in os.scandir(sub_dir.path):
+                if entry.name.endswith(CACHE_ENTRY_SUFFIX):
+                    entry_stat = entry.stat()
+                    entries.append((entry_stat.st_mtime_ns, entry_stat.st_size, entry.path))
+        return entries
+
+    def evict(self) -> int:
+        """
+        Remove the least recently used entries until the cache is below its maximum size. Return the number of
+        entries removed.
+        """
+        entries = self._list_entries()
+        total_size = sum(size for _, size, _ in entries)
+        num_evicted = 0
+        for _, size, entry_file in sorted(entries):
+            if total_size <= self.max_size_bytes:
+                break
+            try:
+                os.remove(entry_file)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+            num_evicted += 1
+        if num_evicted:
+            logger.info(f'Evicted {num_evicted} entries from the validation cache {self.cache_dir}')
+        return num_evicted
+
+    def log_stats(self, description):
+        logger.info(f'Validation cache for {description}: {self.hits} hits, {self.misses} misses')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Evict the least recently used entries of a validation cache',
+                                     formatter_class=argparse.RawTextHelpFormatter, add_help=False)
+    parser.add_argument("--cache-dir", help="Full path to the validation cache directory", required=True)
+    parser.add_argument("--max-size-mb", help="Maximum size of the cache in MB", type=int,
+                        default=DEFAULT_MAX_SIZE_MB, required=False)
+    args = parser.parse_args()
+    logging_config.add_stdout_handler()
+    ValidationCache(args.cache_dir, args.max_size_mb * 1024 * 1024).evict()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+# Copyright 2022 EMBL - European Bioinformatics Institute
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import gzip
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from covid19dp_submission.bgzf import decompress_block, is_bgzf, is_gzip, iter_bgzf_blocks
+from covid19dp_submission.lazy_imports import logging_config
+
+logger = logging_config.get_logger(__name__)
+
+READ_CHUNK_SIZE = 1024 * 1024
+
+
+def get_default_num_threads():
+    return min(4, os.cpu_count() or 1)
+
+
+def iter_decompressed_chunks(vcf_file, num_threads=None):
+    """
+    Yield the content of a plain, gzip or BGZF file as chunks of bytes, in order.
+    BGZF blocks are decompressed by a pool of num_threads threads, or by the calling thread if num_threads is 1.
+    """
+    if is_bgzf(vcf_file) and num_threads == 1:
+        with open(vcf_file, 'rb') as open_file:
+            yield from map(decompress_block, iter_bgzf_blocks(open_file))
+    elif is_bgzf(vcf_file):
+        yield from _iter_bgzf_chunks(vcf_file, num_threads or get_default_num_threads())
+    elif is_gzip(vcf_file):
+        with gzip.open(vcf_file, 'rb') as open_file:
+            yield from iter(lambda: open_file.read(READ_CHUNK_SIZE), b'')
+    else:
+        with open(vcf_file, 'rb') as open_file:
+            yield from iter(lambda: open_file.read(READ_CHUNK_SIZE), b'')
+
+
+def _iter_bgzf_chunks(vcf_file, num_threads):
+    # Only keep a few blocks per thread in flight so memory stays bounded for large files
+    max_pending_blocks = num_threads * 8
+    with open(vcf_file, 'rb') as open_file, ThreadPoolExecutor(max_workers=num_threads) as executor:
+        pending_blocks = deque()
+        for deflate_data in iter_bgzf_blocks(open_file):
+            pending_blocks.append(executor.submit(decompress_block, deflate_data))
+            if len(pending_blocks) >= max_pending_blocks:
+                yield pending_blocks.popleft().result()
+        while pending_blocks:
+            yield pending_blocks.popleft().result()
+
+
+def count_records(vcf_file, num_threads=None) -> int:
+    """
+    Count the lines of vcf_file that do not start with # like "zcat vcf_file | grep -v ^# | wc -l" would, without
+    decoding the lines. The line starts are counted in each chunk and the state of the last byte is carried over
+    to the next chunk.
+    """
+    num_records = 0
+    at_line_start = True
+    for chunk in iter_decompressed_chunks(vcf_file, num_threads):
+        if not chunk:
+            continue
+        if at_line_start and chunk[0] != ord('#'):
+            num_records += 1
+        # Lines starting inside the chunk follow a newline that is not the last byte of the chunk
+        num_records += chunk.count(b'\n', 0, len(chunk) - 1) - chunk.count(b'\n#')
+        at_line_start = chunk[-1] == ord('\n')
+    return num_records
+
+
+def iter_data_lines(vcf_file, num_threads=None):
+    """
+    Yield the lines of vcf_file that do not start with #, as bytes without the line terminator.
+    """
+    yield from iter_data_lines_from_chunks(iter_decompressed_chunks(vcf_file, num_threads))
+
+
+def iter_lines_from_chunks(chunks):
+    """
+    Yield all the lines, header lines included, as bytes without the line terminator.
+    """
+    remainder = b''
+    for chunk in chunks:
+        lines = (remainder + chunk).split(b'\n')
+        remainder = lines.pop()
+        yield from lines
+    if remainder:
+        yield remainder
+
+
+def iter_data_lines_from_chunks(chunks):
+    remainder = b''
+    for chunk in chunks:
+        lines = (remainder + chunk).split(b'\n')
+        # The last line is only complete once the next chunk has been read
+        remainder = lines.pop()
+        for line in lines:
+            if line and not line.startswith(b'#'):
+                yield line
+    if remainder and not remainder.startswith(b'#'):
+        yield remainder
+
+
+class DistinctLoci:
+    """
+    Set of the distinct (CHROM, POS, REF, ALT) loci found in VCF files. Loci are stored per contig as packed bytes
+    keys, so the memory used only depends on the number of distinct loci and not on the number of records read.
+    """
+
+    def __init__(self):
+        self._loci_per_contig = {}
+        self.num_records = 0
+
+    def add_vcf(self, vcf_file, num_threads=None):
+        for line in iter_data_lines(vcf_file, num_threads):
+            chrom, pos, _, ref, alt = line.split(b'\t', 5)[:5]
+            self.add(chrom, int(pos), ref, alt)
+
+    def add(self, chrom: bytes, pos: int, ref: bytes, alt: bytes):
+        self.num_records += 1
+        contig_loci = self._loci_per_contig.get(chrom)
+        if contig_loci is None:
+            contig_loci = self._loci_per_contig[chrom] = set()
+        contig_loci.add(pos.to_bytes(4, 'big') + ref + b'\t' + alt)
+
+    def __len__(self):
+        return sum(len(contig_loci) for contig_loci in self._loci_per_contig.values())
+
+    def __iter__(self):
+        """
+        Yield the loci as (chrom, pos, ref, alt) tuples of strings and integer, sorted within each contig.
+        """
+        for chrom, contig_loci in self._loci_per_contig.items():
+            for key in sorted(contig_loci):
+                yield _unpack_locus(chrom, key)
+
+    def difference(self, other: 'DistinctLoci'):
+        """
+        Yield the loci present in this set but not in other, sorted within each contig.
+        """
+        for chrom, contig_loci in self._loci_per_contig.items():
+            for key in sorted(contig_loci.difference(other._loci_per_contig.get(chrom, ()))):
+                yield _unpack_locus(chrom, key)
+
+
+def _unpack_locus(chrom, key):
+    ref, alt = key[4:].split(b'\t')
+    return chrom.decode(), int.from_bytes(key[:4], 'big'), ref.decode(), alt.decode()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Count the data records in VCF files',
+                                     formatter_class=argparse.RawTextHelpFormatter, add_help=False)
+    parser.add_argument("--vcf-file", help="Full path to the VCF file (plain, gzip or BGZF)", nargs='+',
+                        required=True)
+    parser.add_argument("--num-threads", help="Number of threads decompressing BGZF blocks", type=int,
+                        default=None, required=False)
+    args = parser.parse_args()
+    for vcf_file in args.vcf_file:
+        print(f'{vcf_file}\t{count_records(vcf_file, args.num_threads)}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+# Copyright 2022 EMBL - European Bioinformatics Institute
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from covid19dp_submission.lazy_imports import logging_config
+from covid19dp_submission.vcf_reader import DistinctLoci, iter_data_lines_from_chunks, iter_decompressed_chunks
+
+logger = logging_config.get_logger(__name__)
+
+SUMMARY_SUFFIX = '.summary.json'
+
+
+def get_summary_file(vcf_file):
+    # Steps run by Nextflow see symbolic links to the files so the summary is stored next to the actual file
+    return os.path.realpath(vcf_file) + SUMMARY_SUFFIX
+
+
+def _get_file_stat(vcf_file):
+    file_stat = os.stat(vcf_file)
+    return {'file_size': file_stat.st_size, 'file_mtime_ns': file_stat.st_mtime_ns}
+
+
+class VcfSummariser:
+    """
+    Accumulate the summary of a VCF file while its content is read: number of records, distinct loci, minimum and
+    maximum positions, contigs in order of appearance, whether the records are sorted and the MD5 of the
+    decompressed content.
+    """
+
+    def __init__(self, loci: DistinctLoci = None):
+        self.loci = DistinctLoci() if loci is None else loci
+        self.content_md5 = hashlib.md5()
+        self.contigs = []
+        self.num_records = 0
+        self.num_malformed_records = 0
+        self.min_pos = self.max_pos = None
+        self.is_sorted = True
+        self._previous_chrom = self._previous_pos = None
+
+    def update_content(self, chunk: bytes):
+        self.content_md5.update(chunk)
+
+    def add_record(self, line: bytes):
+        self.num_records += 1
+        fields = line.split(b'\t', 5)
+        try:
+            chrom, pos, _, ref, alt = fields[:5]
+            pos = int(pos)
+        except ValueError:
+            self.num_malformed_records += 1
+            return
+        self.loci.add(chrom, pos, ref, alt)
+        if chrom != self._previous_chrom:
+            if chrom in self.contigs:
+                # Records of a contig are not contiguous
+                self.is_sorted = False
+            else:
+                self.contigs.append(chrom)
+        elif pos < self._previous_pos:
+            self.is_sorted = False
+        self._previous_chrom, self._previous_pos = chrom, pos
+        self.min_pos = pos if self.min_pos is None else min(self.min_pos, pos)
+        self.max_pos = pos if self.max_pos is None else max(self.max_pos, pos)
+
+    def get_summary(self, vcf_file) -> dict:
+        return {
+            **_get_file_stat(vcf_file),
+            'record_count': self.num_records,
+            'malformed_record_count': self.num_malformed_records,
+            'distinct_loci': len(self.loci),
+            'min_pos': self.min_pos,
+            'max_pos': self.max_pos,
+            'contigs': [contig.decode() for contig in self.contigs],
+            'is_sorted': self.is_sorted,
+            'content_md5': self.content_md5.hexdigest()
+        }
+
+
+def summarise_vcf(vcf_file, num_threads=None, loci: DistinctLoci = None) -> dict:
+    """
+    Read vcf_file once and return its summary. The distinct loci are added to loci if it is provided.
+    """
+    file_stat = _get_file_stat(vcf_file)
+    summariser = VcfSummariser(loci)
+
+    def hashed_chunks():
+        for chunk in iter_decompressed_chunks(vcf_file, num_threads):
+            summariser.update_content(chunk)
+            yield chunk
+
+    for line in iter_data_lines_from_chunks(hashed_chunks()):
+        summariser.add_record(line)
+    # The size and modification time are those of the file that was read
+    return {**summariser.get_summary(vcf_file), **file_stat}
+
+
+def write_summary_file(vcf_file, summary: dict):
+    summary_file = get_summary_file(vcf_file)
+    # Write to a temporary file first so that concurrent readers never see a partial summary
+    with open(summary_file + '.tmp', 'w') as open_file:
+        json.dump(summary, open_file)
+    os.replace(summary_file + '.tmp', summary_file)
+
+
+def write_vcf_summary(vcf_file, num_threads=None, loci: DistinctLoci = None) -> dict:
+    summary = summarise_vcf(vcf_file, num_threads, loci)
+    write_summary_file(vcf_file, summary)
+    return summary
+
+
+def read_vcf_summary(vcf_file) -> dict or None:
+    """
+    Return the cached summary of vcf_file or None if there is none or the file changed since it was summarised.
+    """
+    summary_file = get_summary_file(vcf_file)
+    if not os.path.isfile(summary_file):
+        return None
+    try:
+        with open(summary_file) as open_file:
+            summary = json.load(open_file)
+    except ValueError:
+        logger.warning(f'Ignoring unreadable summary {summary_file}')
+        return None
+    file_stat = _get_file_stat(vcf_file)
+    if any(summary.get(key) != value for key, value in file_stat.items()):
+        return None
+    return summary
+
+
+def get_vcf_summary(vcf_file, num_threads=None) -> dict:
+    """
+    Return the summary of vcf_file from its sidecar file, or compute it without writing it if the sidecar is missing or
+    outdated. Sidecars are only written next to the files the submission downloads or creates.
+    """
+    summary = read_vcf_summary(vcf_file)
+    if summary is None:
+        summary = summarise_vcf(vcf_file, num_threads)
+    return summary
+
+
+def summarise_vcf_files(vcf_files, max_workers=4):
+    """
+    Make sure every file has an up to date summary sidecar. Files are summarised concurrently.
+    """
+    def get_or_write_summary(vcf_file):
+        # Each file is read by a single thread to leave the other threads to the other files
+        return read_vcf_summary(vcf_file) or write_vcf_summary(vcf_file, num_threads=1)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for vcf_file, summary in zip(vcf_files, executor.map(get_or_write_summary, vcf_files)):
+            logger.info(f"{vcf_file}: {summary['record_count']} records, {summary['distinct_loci']} distinct loci")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write the summary sidecar file of VCF files',
+                                     formatter_class=argparse.RawTextHelpFormatter, add_help=False)
+    parser.add_argument("--vcf-file", help="Full path to the VCF file (plain, gzip or BGZF)", nargs='+',
+                        required=True)
+    parser.add_argument("--max-workers", help="Number of files summarised concurrently", type=int, default=4,
+                        required=False)
+    args = parser.parse_args()
+    logging_config.add_stdout_handler()
+    summarise_vcf_files(args.vcf_file, args.max_workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+import os
+import shutil
+from unittest import TestCase
+from unittest.mock import patch
+
+from covid19dp_submission.steps.accession_vcf import accession_vcf
+from covid19dp_submission import ROOT_DIR
+
+
+class TestAccessionVcf(TestCase):
+    resources_folder = os.path.join(ROOT_DIR, 'tests', 'resources')
+    vcf_files_folder = os.path.join(resources_folder, 'vcf_files')
+    accession_output_dir = os.path.join(resources_folder, 'accession_vcf_run', '60_eva_public', 'test_snapshot')
+
+    def setUp(self) -> None:
+        shutil.rmtree(os.path.dirname(os.path.dirname(self.accession_output_dir)), ignore_errors=True)
+        os.makedirs(self.accession_output_dir)
+
+    def tearDown(self) -> None:
+        shutil.rmtree(os.path.dirname(os.path.dirname(self.accession_output_dir)), ignore_errors=True)
+
+    def test_accession_output_dir_only_has_the_published_files(self):
+        input_vcf_file = os.path.join(self.vcf_files_folder, 'file1.vcf')
+        output_vcf_file = os.path.join(self.accession_output_dir, 'test_snapshot.accessioned.vcf')
+
+        def accession(_, command):
+            # Stands in for the accessioning pipeline, which writes a VCF with the same records
+            shutil.copy(input_vcf_file, output_vcf_file)
+
+        with patch('covid19dp_submission.steps.accession_vcf.run_command_with_output', side_effect=accession):
+            compressed_output_vcf_file = accession_vcf(
+                input_vcf_file=input_vcf_file, accessioning_jar_file='eva-accession-pipeline.jar',
+                accessioning_properties_file='accessioning.properties', accessioning_instance='instance-10',
+                output_vcf_file=output_vcf_file, bcftools_binary='bcftools', memory=8)
+        self.assertEqual(output_vcf_file + '.gz', compressed_output_vcf_file)
+        # Everything in the directory is synced to the public FTP
+        self.assertEqual(['test_snapshot.accessioned.vcf', 'test_snapshot.accessioned.vcf.gz',
+                          'test_snapshot.accessioned.vcf.gz.csi'], sorted(os.listdir(self.accession_output_dir)))
@@ -0,0 +1,102 @@
+import os
+import shutil
+from unittest import TestCase
+from unittest.mock import patch
+
+from covid19dp_submission import ROOT_DIR
+from covid19dp_submission.analysis_registry import AnalysisRegistry, CsvAnalysisRegistry, SqliteAnalysisRegistry, \
+    get_analysis_registry, PROCESSED, IGNORED
+
+
+def analyses(*accessions):
+    return [{'analysis_accession': acc, 'submitted_ftp': f'ftp.ebi.ac.uk/{acc}/{acc}.vcf.gz'} for acc in accessions]
+
+
+class TestAnalysisRegistry(TestCase):
+    resources_folder = os.path.join(ROOT_DIR, 'tests', 'resources')
+    registry_folder = os.path.join(resources_folder, 'analysis_registry')
+    processed_analyses_file = os.path.join(registry_folder, 'processed_analyses.csv')
+    ignored_analyses_file = os.path.join(registry_folder, 'ignored_analyses.csv')
+    registry_db = os.path.join(registry_folder, 'registry.db')
+
+    def setUp(self) -> None:
+        shutil.rmtree(self.registry_folder, ignore_errors=True)
+        os.makedirs(self.registry_folder)
+        with open(self.processed_analyses_file, 'w') as open_file:
+            open_file.write('acc1,ftp.ebi.ac.uk/acc1/acc1.vcf.gz\nacc2,ftp.ebi.ac.uk/acc2/acc2.vcf.gz\n')
+        with open(self.ignored_analyses_file, 'w') as open_file:
+            open_file.write('acc3,\n')
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.registry_folder, ignore_errors=True)
+
+    def test_csv_registry(self):
+        registry = CsvAnalysisRegistry(self.processed_analyses_file, self.ignored_analyses_file)
+        assert registry.get_known_analyses(['acc1', 'acc3', 'acc4']) == {'acc1', 'acc3'}
+        registry.add_processed_analyses(analyses('acc4'))
+        registry.add_ignored_analyses(analyses('acc3', 'acc5'))
+        assert registry.get_known_analyses(['acc4', 'acc5', 'acc6']) == {'acc4', 'acc5'}
+        with open(self.processed_analyses_file) as open_file:
+            assert len(open_file.readlines()) == 3
+        with open(self.ignored_analyses_file) as open_file:
+            assert [line.split(',')[0] for line in open_file] == ['acc3', 'acc5']
+
+    def test_sqlite_registry(self):
+        with SqliteAnalysisRegistry(self.registry_db, snapshot_name='snapshot1') as registry:
+            registry.add_processed_analyses(analyses(*[f'acc{i}' for i in range(1000)]))
+            registry.add_ignored_analyses(analyses('acc1000', 'acc1'))
+            assert registry.count_analyses(PROCESSED) == 1000
+            assert registry.count_analyses(IGNORED) == 1
+            assert registry.get_known_analyses([f'acc{i}' for i in range(990, 1010)]) == \
+                {f'acc{i}' for i in range(990, 1001)}
+        with SqliteAnalysisRegistry(self.registry_db, snapshot_name='snapshot2') as registry:
+            registry.add_processed_analyses(analyses('acc2000'))
+            assert registry.count_analyses(snapshot_name='snapshot1') == 1001
+            assert registry.count_analyses(snapshot_name='snapshot2') == 1
+            assert registry.connection.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+
+    def test_get_analysis_registry_imports_csv_files(self):
+        with get_analysis_registry(self.processed_analyses_file, self.ignored_analyses_file, self.registry_db) \
+                as registry:
+            assert isinstance(registry, SqliteAnalysisRegistry)
+            assert registry.count_analyses(PROCESSED) == 2
+            assert registry.count_analyses(IGNORED) == 1
+            registry.add_processed_analyses(analyses('acc4'))
+        # The CSV files are only imported when the registry is created
+        with open(self.processed_analyses_file, 'a') as open_file:
+            open_file.write('acc5,ftp.ebi.ac.uk/acc5/acc5.vcf.gz\n')
+        with get_analysis_registry(self.processed_analyses_file, self.ignored_analyses_file, self.registry_db) \
+                as registry:
+            assert registry.get_known_analyses(['acc1', 'acc3', 'acc4', 'acc5']) == {'acc1', 'acc3', 'acc4'}
+
+    def test_processed_replaces_ignored(self):
+        with SqliteAnalysisRegistry(self.registry_db, snapshot_name='snapshot1') as registry:
+            registry.add_ignored_analyses(analyses('acc1', 'acc2'))
+            registry.add_processed_analyses(analyses('acc1'))
+            registry.add_ignored_analyses(analyses('acc1'))
+            assert registry.count_analyses(PROCESSED) == 1
+            assert registry.count_analyses(IGNORED) == 1
+            assert registry.connection.execute(
+                'SELECT status FROM analysis WHERE analysis_accession = ?', ('acc1',)).fetchone()[0] == PROCESSED
+
+    def test_interrupted_csv_import_is_run_again(self):
+        with patch.object(SqliteAnalysisRegistry, 'count_analyses', side_effect=[0, 0, RuntimeError('Interrupted')]):
+            with self.assertRaises(RuntimeError):
+                get_analysis_registry(self.processed_analyses_file, self.ignored_analyses_file, self.registry_db)
+        # The registry file exists but the import was rolled back and not recorded as done
+        assert os.path.exists(self.registry_db)
+        with SqliteAnalysisRegistry(self.registry_db) as registry:
+            assert not registry.is_csv_imported()
+            assert registry.count_analyses() == 0
+        with get_analysis_registry(self.processed_analyses_file, self.ignored_analyses_file, self.registry_db) \
+                as registry:
+            assert registry.is_csv_imported()
+            assert registry.get_known_analyses(['acc1', 'acc2', 'acc3']) == {'acc1', 'acc2', 'acc3'}
+
+    def test_incomplete_registry_cannot_be_created(self):
+        class IncompleteRegistry(AnalysisRegistry):
+            def get_known_analyses(self, analysis_accessions):
+                return set()
+
+        with self.assertRaises(TypeError):
+            IncompleteRegistry()
@@ -4,7 +4,8 @@ import shutil
 from unittest import TestCase
 
 from covid19dp_submission import ROOT_DIR
-from covid19dp_submission.steps.bgzip_and_index_vcf import bgzip_and_index
+from covid19dp_submission.steps.bgzip_and_index_vcf import bgzip_and_index, bgzip_and_index_all, \
+    BgzipAndIndexError
 
 
 class TestBGZipAndIndex(TestCase):
@@ -30,3 +31,28 @@ class TestBGZipAndIndex(TestCase):
         bgzip_and_index(vcf_file=vcf_files[0], output_file=output_file, bcftools_binary="bcftools")
         self.assertTrue(os.path.exists(output_file))
         self.assertEqual(1, len(glob.glob(f"{output_file}.csi")))
+
+    def test_bgzip_and_index_all(self):
+        os.makedirs(self.download_target_dir)
+        vcf_files = []
+        for i in range(1, 6):
+            shutil.copy(os.path.join(self.resources_folder, 'vcf_files', f'file{i}.vcf'), self.download_target_dir)
+            vcf_files.append(os.path.join(self.download_target_dir, f'file{i}.vcf'))
+        # Compressed files are replaced by their BGZipped version
+        shutil.copy(os.path.join(self.resources_folder, 'vcf_files', 'file_with_errors.vcf.gz'),
+                    self.download_target_dir)
+        vcf_files.append(os.path.join(self.download_target_dir, 'file_with_errors.vcf.gz'))
+        broken_file = os.path.join(self.download_target_dir, 'broken.vcf')
+        with open(broken_file, 'w') as open_file:
+            open_file.write('not a VCF\n')
+        vcf_files.insert(0, broken_file)
+
+        with self.assertRaises(BgzipAndIndexError) as error:
+            bgzip_and_index_all(vcf_files, self.download_target_dir, 'bcftools', num_workers=3)
+        # The broken file does not prevent the other files from being processed
+        self.assertIn('broken.vcf', str(error.exception))
+        for vcf_file in vcf_files[1:]:
+            output_file = vcf_file if vcf_file.endswith('.gz') else vcf_file + '.gz'
+            self.assertTrue(os.path.exists(output_file))
+            self.assertTrue(os.path.exists(f"{output_file}.csi"))
+        self.assertEqual([], glob.glob(f"{self.download_target_dir}/*.part"))
@@ -0,0 +1,120 @@
+import os
+import shutil
+from unittest import TestCase
+
+from covid19dp_submission import ROOT_DIR
+from covid19dp_submission.steps.vcf_vertical_concat.concat_planner import get_executor_parallelism, \
+    get_input_stats, make_concat_plan, plan_vertical_concat, write_concat_plan, read_concat_plan
+from covid19dp_submission.steps.vcf_vertical_concat.run_vcf_vertical_concat_pipeline import \
+    get_multistage_vertical_concat_pipeline, get_planned_concat_result_file_name, run_vcf_vertical_concat_pipeline
+from covid19dp_submission.vcf_summary import write_vcf_summary
+
+
+class TestConcatPlanner(TestCase):
+    resources_folder = os.path.join(ROOT_DIR, 'tests', 'resources')
+    processing_dir = os.path.join(resources_folder, 'concat_planner_run')
+
+    def setUp(self) -> None:
+        shutil.rmtree(self.processing_dir, ignore_errors=True)
+        os.makedirs(self.processing_dir)
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.processing_dir, ignore_errors=True)
+
+    def get_input_stats(self, num_files):
+        return {'num_files': num_files, 'total_bytes': num_files * 1500, 'total_records': num_files * 30,
+                'distinct_loci': 60000, 'bytes_per_record': 50}
+
+    def test_plan_covers_all_files(self):
+        for num_files in (2, 5, 1000, 50000):
+            concat_plan = plan_vertical_concat(self.get_input_stats(num_files), max_fan_in=100, parallelism=8)
+            num_stage_files = num_files
+            for stage in concat_plan['stages']:
+                self.assertEqual(num_stage_files, sum(stage['batch_sizes']))
+                self.assertLessEqual(max(stage['batch_sizes']), 100)
+                # The files are spread evenly over the batches
+                self.assertLessEqual(max(stage['batch_sizes']) - min(stage['batch_sizes']), 1)
+                num_stage_files = len(stage['batch_sizes'])
+            self.assertEqual(1, num_stage_files)
+
+    def test_plan_follows_limits(self):
+        # A few files are concatenated at once
+        self.assertEqual([[5]], [stage['batch_sizes'] for stage in
+                                 plan_vertical_concat(self.get_input_stats(5), 100, 8)['stages']])
+        # The limit of open files forces several stages
+        self.assertEqual(3, len(plan_vertical_concat(self.get_input_stats(5), 2, 8)['stages']))
+        # More processes at a time favour more batches in the first stage
+        sequential_plan = plan_vertical_concat(self.get_input_stats(20000), 1000, 1)
+        parallel_plan = plan_vertical_concat(self.get_input_stats(20000), 1000, 64)
+        self.assertGreater(len(parallel_plan['stages'][0]['batch_sizes']),
+                           len(sequential_plan['stages'][0]['batch_sizes']))
+        self.assertLess(parallel_plan['estimated_seconds'], sequential_plan['estimated_seconds'])
+
+    def test_get_input_stats(self):
+        vcf_files = []
+        for i in range(1, 6):
+            shutil.copy(os.path.join(self.resources_folder, 'vcf_files', f'file{i}.vcf'), self.processing_dir)
+            vcf_files.append(os.path.join(self.processing_dir, f'file{i}.vcf'))
+        summaries = [write_vcf_summary(vcf_file) for vcf_file in vcf_files]
+        input_stats = get_input_stats(vcf_files)
+        self.assertEqual(5, input_stats['num_files'])
+        self.assertEqual(sum(summary['record_count'] for summary in summaries), input_stats['total_records'])
+        self.assertEqual(sum(summary['file_size'] for summary in summaries), input_stats['total_bytes'])
+        self.assertLessEqual(input_stats['distinct_loci'], input_stats['total_records'])
+
+    def test_make_concat_plan(self):
+        vcf_files = []
+        for i in range(1, 6):
+            shutil.copy(os.path.join(self.resources_folder, 'vcf_files', f'file{i}.vcf'), self.processing_dir)
+            vcf_files.append(os.path.join(self.processing_dir, f'file{i}.vcf'))
+        # The fan-in comes from the config, whatever the limit of open files of this process
+        concat_plan = make_concat_plan(vcf_files, 2)
+        self.assertEqual(2, concat_plan['max_fan_in'])
+        self.assertTrue(all(max(stage['batch_sizes']) <= 2 for stage in concat_plan['stages']))
+        # A slow process startup favours fewer stages
+        self.assertEqual(1, len(make_concat_plan(vcf_files, 5, cost_model_params={
+            'process_startup_seconds': 1000})['stages']))
+        with self.assertRaises(ValueError):
+            make_concat_plan(vcf_files, 1)
+
+    def test_get_executor_parallelism(self):
+        nextflow_config_file = os.path.join(self.processing_dir, 'nextflow.config')
+        with open(nextflow_config_file, 'w') as open_file:
+            open_file.write("process {\n executor = 'lsf'\n}\nexecutor {\n queueSize = 40\n}\n")
+        self.assertEqual(40, get_executor_parallelism(nextflow_config_file))
+        with open(nextflow_config_file, 'w') as open_file:
+            open_file.write("process {\n executor = 'slurm'\n}\n")
+        self.assertEqual(100, get_executor_parallelism(nextflow_config_file))
+        self.assertEqual(os.cpu_count(), get_executor_parallelism(os.path.join(self.resources_folder, 'nf.config')))
+
+    def test_planned_pipeline(self):
+        vcf_files = [f'vcf{i}.vcf.gz' for i in range(7)]
+        pipeline, result_file = get_multistage_vertical_concat_pipeline(
+            vcf_files, self.processing_dir, 100, 'bcftools', batch_sizes_per_stage=[[3, 2, 2], [3]])
+        self.assertEqual(get_planned_concat_result_file_name(self.processing_dir, {'stages': [{}, {}]}), result_file)
+        with open(os.path.join(self.processing_dir, 'vertical_concat', 'stage_0',
+                               'batch1_files_to_be_concatenated.txt')) as open_file:
+            self.assertEqual(['vcf3.vcf.gz', 'vcf4.vcf.gz'], open_file.read().split())
+
+    def test_dry_run(self):
+        toplevel_vcf_dir = os.path.join(self.processing_dir, 'vcf_files')
+        os.makedirs(toplevel_vcf_dir)
+        for i in range(5):
+            shutil.copy(os.path.join(self.resources_folder, 'vcf_files', 'file_with_unnormalised_variants.vcf.gz'),
+                        os.path.join(toplevel_vcf_dir, f'file{i}.vcf.gz'))
+        concat_plan_file = os.path.join(self.processing_dir, 'concat_plan.json')
+        concat_processing_dir = os.path.join(self.processing_dir, 'processed')
+        run_vcf_vertical_concat_pipeline(toplevel_vcf_dir, concat_processing_dir, 2, 'bcftools', 'nextflow', None,
+                                         resume=False, concat_plan_file=concat_plan_file, dry_run=True)
+        concat_plan = read_concat_plan(concat_plan_file)
+        self.assertEqual(5, concat_plan['num_files'])
+        self.assertEqual(2, concat_plan['max_fan_in'])
+        # Nothing is concatenated
+        self.assertFalse(os.path.exists(concat_processing_dir))
+
+        # An existing plan is used as it is
+        concat_plan['num_files'] = 6
+        write_concat_plan(concat_plan, concat_plan_file)
+        with self.assertRaises(ValueError):
+            run_vcf_vertical_concat_pipeline(toplevel_vcf_dir, concat_processing_dir, 2, 'bcftools', 'nextflow',
+                                             None, resume=False, concat_plan_file=concat_plan_file, dry_run=True)
@@ -0,0 +1,43 @@
+import gzip
+import os
+import shutil
+from unittest import TestCase
+
+from covid19dp_submission import ROOT_DIR
+from covid19dp_submission.csi_index import CsiIndexBuilder, CsiIndexError, index_bgzf_vcf, region_to_bin
+
+
+class TestCsiIndex(TestCase):
+    resources_folder = os.path.join(ROOT_DIR, 'tests', 'resources')
+    vcf_files_folder = os.path.join(resources_folder, 'vcf_files')
+    csi_test_run_folder = os.path.join(resources_folder, 'csi_index_run')
+
+    def setUp(self) -> None:
+        shutil.rmtree(self.csi_test_run_folder, ignore_errors=True)
+        os.makedirs(self.csi_test_run_folder)
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.csi_test_run_folder, ignore_errors=True)
+
+    def test_region_to_bin(self):
+        # Bins of the lowest level cover 16kb with the default binning
+        self.assertEqual(37449, region_to_bin(0, 1, 14, 6))
+        self.assertEqual(37450, region_to_bin(27188, 27228, 14, 6))
+        # A region across two lowest level bins is in their parent
+        self.assertEqual(4681, region_to_bin(16383, 16385, 14, 6))
+
+    def test_index_bgzf_vcf_like_bcftools(self):
+        vcf_file = os.path.join(self.vcf_files_folder, 'file_with_unnormalised_variants.vcf.gz')
+        csi_file = index_bgzf_vcf(vcf_file, os.path.join(self.csi_test_run_folder, 'index.csi'))
+        # Same content as the index created by "bcftools index --csi"
+        with gzip.open(csi_file) as csi, gzip.open(vcf_file + '.csi') as bcftools_csi:
+            self.assertEqual(bcftools_csi.read(), csi.read())
+
+    def test_unsorted_records(self):
+        index_builder = CsiIndexBuilder()
+        index_builder.add('chr1', 100, 101, 0, 10)
+        with self.assertRaises(CsiIndexError):
+            index_builder.add('chr1', 50, 51, 10, 20)
+        index_builder.add('chr2', 50, 51, 10, 20)
+        with self.assertRaises(CsiIndexError):
+            index_builder.add('chr1', 200, 201, 20, 30)
@@ -0,0 +1,106 @@
+import os
+import shutil
+from unittest import TestCase
+from unittest.mock import patch
+
+from covid19dp_submission import ROOT_DIR
+from covid19dp_submission.bgzf import BgzfWriter
+from covid19dp_submission.steps.vcf_vertical_concat import cumulative_concat
+from covid19dp_submission.steps.vcf_vertical_concat.cumulative_concat import get_cumulative_vcf_files, \
+    read_cumulative_manifest, update_cumulative_vcf
+from covid19dp_submission.steps.vcf_vertical_concat.native_concat import native_vcf_concat
+from covid19dp_submission.vcf_reader import iter_data_lines
+
+
+class TestCumulativeConcat(TestCase):
+    resources_folder = os.path.join(ROOT_DIR, 'tests', 'resources')
+    processing_dir = os.path.join(resources_folder, 'cumulative_concat_run')
+    cumulative_dir = os.path.join(processing_dir, 'cumulative')
+    header = '##fileformat=VCFv4.1\n##contig=<ID=MN908947.3>\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n'
+
+    def setUp(self) -> None:
+        shutil.rmtree(self.processing_dir, ignore_errors=True)
+        os.makedirs(self.processing_dir)
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.processing_dir, ignore_errors=True)
+
+    def write_snapshot_vcf(self, snapshot_name, positions):
+        vcf_file = os.path.join(self.processing_dir, f'{snapshot_name}.vcf.gz')
+        with BgzfWriter(vcf_file) as writer:
+            writer.write(self.header.encode())
+            for pos in positions:
+                writer.write(f'MN908947.3\t{pos}\t{snapshot_name}\tA\tG\t.\tPASS\t.\n'.encode())
+        return vcf_file
+
+    def read_records(self):
+        cumulative_vcf_file = os.path.join(self.processing_dir, 'cumulative.vcf.gz')
+        native_vcf_concat(get_cumulative_vcf_files(self.cumulative_dir), cumulative_vcf_file)
+        return [tuple(line.decode().split('\t')[1:3]) for line in iter_data_lines(cumulative_vcf_file)]
+
+    def get_run_record_counts(self):
+        return [run['record_count'] for run in read_cumulative_manifest(self.cumulative_dir)['runs']]
+
+    def test_update_cumulative_vcf(self):
+        update_cumulative_vcf(self.cumulative_dir, self.write_snapshot_vcf('snapshot1', [10, 30]), 'snapshot1')
+        self.assertEqual([('10', 'snapshot1'), ('30', 'snapshot1')], self.read_records())
+        update_cumulative_vcf(self.cumulative_dir, self.write_snapshot_vcf('snapshot2', [5, 10, 20]), 'snapshot2')
+        # The records of the older snapshots are kept over the duplicates of the new snapshot
+        self.assertEqual([('5', 'snapshot2'), ('10', 'snapshot1'), ('20', 'snapshot2'), ('30', 'snapshot1')],
+                         self.read_records())
+        self.assertTrue(all(os.path.exists(vcf_file + '.csi')
+                            for vcf_file in get_cumulative_vcf_files(self.cumulative_dir)))
+        manifest = read_cumulative_manifest(self.cumulative_dir)
+        self.assertEqual(2, manifest['generation'])
+        self.assertEqual(['snapshot1', 'snapshot2'], manifest['snapshots'])
+        # Only the current generation and its runs are kept
+        self.assertEqual(['current', 'generation_2', 'runs'], sorted(os.listdir(self.cumulative_dir)))
+        self.assertEqual(sorted(os.path.basename(vcf_file) + suffix
+                                for vcf_file in get_cumulative_vcf_files(self.cumulative_dir)
+                                for suffix in ('', '.csi')),
+                         sorted(os.listdir(os.path.join(self.cumulative_dir, 'runs'))))
+
+        # A snapshot is only merged once
+        update_cumulative_vcf(self.cumulative_dir, self.write_snapshot_vcf('snapshot2', [1]), 'snapshot2')
+        self.assertEqual(manifest, read_cumulative_manifest(self.cumulative_dir))
+
+    def test_runs_are_merged_by_size(self):
+        update_cumulative_vcf(self.cumulative_dir, self.write_snapshot_vcf('snapshot1', range(1, 101)), 'snapshot1',
+                              size_ratio=4)
+        # Small snapshots are kept in their own runs without reading the large run again
+        update_cumulative_vcf(self.cumulative_dir, self.write_snapshot_vcf('snapshot2', [200]), 'snapshot2',
+                              size_ratio=4)
+        self.assertEqual([100, 1], self.get_run_record_counts())
+        update_cumulative_vcf(self.cumulative_dir, self.write_snapshot_vcf('snapshot3', [201]), 'snapshot3',
+                              size_ratio=4)
+        self.assertEqual([100, 2], self.get_run_record_counts())
+        # Runs of similar sizes are merged together, the large run once the newer runs hold over a quarter of it
+        update_cumulative_vcf(self.cumulative_dir, self.write_snapshot_vcf('snapshot4', range(202, 226)), 'snapshot4',
+                              size_ratio=4)
+        self.assertEqual([126], self.get_run_record_counts())
+        self.assertEqual(126, len(self.read_records()))
+
+    def test_interrupted_update(self):
+        update_cumulative_vcf(self.cumulative_dir, self.write_snapshot_vcf('snapshot1', [10, 30]), 'snapshot1')
+        snapshot2_vcf = self.write_snapshot_vcf('snapshot2', [20])
+        with patch.object(cumulative_concat, '_swap_current_generation', side_effect=OSError('Interrupted')):
+            with self.assertRaises(OSError):
+                update_cumulative_vcf(self.cumulative_dir, snapshot2_vcf, 'snapshot2')
+        # The previous cumulative VCF is still the current one
+        self.assertEqual([('10', 'snapshot1'), ('30', 'snapshot1')], self.read_records())
+        self.assertEqual(['snapshot1'], read_cumulative_manifest(self.cumulative_dir)['snapshots'])
+
+        update_cumulative_vcf(self.cumulative_dir, snapshot2_vcf, 'snapshot2')
+        self.assertEqual([('10', 'snapshot1'), ('20', 'snapshot2'), ('30', 'snapshot1')], self.read_records())
+
+    def test_interrupted_cleanup(self):
+        update_cumulative_vcf(self.cumulative_dir, self.write_snapshot_vcf('snapshot1', [10, 30]), 'snapshot1')
+        with patch.object(cumulative_concat, '_remove_unused_files', side_effect=[None, OSError('Interrupted')]):
+            with self.assertRaises(OSError):
+                update_cumulative_vcf(self.cumulative_dir, self.write_snapshot_vcf('snapshot2', [20]), 'snapshot2')
+        self.assertIn('generation_1', os.listdir(self.cumulative_dir))
+        # The generation left behind after the swap is removed by the next update
+        update_cumulative_vcf(self.cumulative_dir, self.write_snapshot_vcf('snapshot3', [40]), 'snapshot3')
+        self.assertEqual(['current', 'generation_3', 'runs'], sorted(os.listdir(self.cumulative_dir)))
+        self.assertEqual(['snapshot1', 'snapshot2', 'snapshot3'],
+                         read_cumulative_manifest(self.cumulative_dir)['snapshots'])
@@ -1,12 +1,60 @@
 import glob
+import hashlib
+import io
 import os
 import shutil
+from datetime import datetime, timedelta
 from unittest import TestCase
 from unittest.mock import patch
 
+import requests
+from requests import Response
+from urllib3.exceptions import ProtocolError
+
 from covid19dp_submission import ROOT_DIR
+from covid19dp_submission.analysis_registry import CsvAnalysisRegistry
 from covid19dp_submission.download_analyses import download_analyses, download_files_via_aspera, UnfinishedBatchError, \
-    add_to_ignored_file, get_analyses_to_process
+    add_to_ignored_file, get_analyses_to_process, stream_analyses_from_ena, pack_batches_by_size
+
+
+def tsv_response(lines):
+    response = Response()
+    response.status_code = 200
+    response.raw = io.BytesIO(('\n'.join(lines) + '\n').encode())
+    return response
+
+
+class InterruptedStream:
+    """
+    Raw content of a response whose connection is reset after the first size bytes.
+    """
+
+    def __init__(self, content, size):
+        self.content = content
+        self.size = size
+
+    def stream(self, chunk_size, decode_content=True):
+        yield self.content[:self.size]
+        raise ProtocolError('Connection reset by peer')
+
+    def close(self):
+        pass
+
+
+def interrupted_tsv_response(lines, size):
+    response = tsv_response(lines)
+    response.raw = InterruptedStream(response.raw.read(), size)
+    return response
+
+
+def analyses_report(num_analyses, rejected_taxonomy_every=3, start=1):
+    lines = ['run_accession\tanalysis_accession\tsubmitted_ftp\tsubmitted_aspera\ttax_id\tfirst_public']
+    for i in range(start, start + num_analyses):
+        tax_id = '9606' if i % rejected_taxonomy_every == 0 else '2697049'
+        first_public = f'2022-01-{i // 10 + 1:02}'
+        lines.append(f'rr{i}\tacc{i}\tftp.ebi.ac.uk/acc{i}/rr{i}.vcf.gz\tasperap.ebi.ac.uk/acc{i}/rr{i}.vcf.gz\t'
+                     f'{tax_id}\t{first_public}')
+    return lines
 
 
 def touch(f):
@@ -56,6 +104,130 @@ class TestDownloadAnalysis(TestCase):
             'ERZ10000025', 'ERZ10000026', 'ERZ10000028', 'ERZ10000030', 'ERZ10000031'
         ]
 
+    def test_stream_analyses_from_ena(self):
+        with patch('covid19dp_submission.download_analyses.requests.get',
+                   return_value=tsv_response(analyses_report(5))) as mock_get:
+            analyses = stream_analyses_from_ena('PRJEB45554')
+            # Nothing is requested until the generator is consumed
+            assert mock_get.call_count == 0
+            analyses = list(analyses)
+        assert 'format=tsv' in mock_get.call_args[0][0]
+        assert mock_get.call_args[1] == {'stream': True}
+        assert len(analyses) == 5
+        assert analyses[0] == {'run_accession': 'rr1', 'analysis_accession': 'acc1',
+                               'submitted_ftp': 'ftp.ebi.ac.uk/acc1/rr1.vcf.gz',
+                               'submitted_aspera': 'asperap.ebi.ac.uk/acc1/rr1.vcf.gz', 'tax_id': '2697049',
+                               'first_public': '2022-01-01'}
+
+    def test_stream_analyses_from_ena_resumed(self):
+        report = analyses_report(5)
+        # The connection is reset in the middle of the third analysis
+        interrupted_size = len('\n'.join(report[:3])) + 10
+        with patch('covid19dp_submission.download_analyses.requests.get',
+                   side_effect=[interrupted_tsv_response(report, interrupted_size), tsv_response(report)]) as mock_get, \
+                patch('covid19dp_submission.download_analyses.time.sleep') as mock_sleep:
+            analyses = list(stream_analyses_from_ena('PRJEB45554'))
+        assert mock_get.call_count == 2
+        assert mock_sleep.call_count == 1
+        # The analyses read before the reset are not yielded twice
+        assert [a['analysis_accession'] for a in analyses] == ['acc1', 'acc2', 'acc3', 'acc4', 'acc5']
+        # The connection keeps being reset
+        with patch('covid19dp_submission.download_analyses.requests.get',
+                   side_effect=lambda *args, **kwargs: interrupted_tsv_response(report, interrupted_size)), \
+                patch('covid19dp_submission.download_analyses.time.sleep'):
+            with self.assertRaises(requests.exceptions.ChunkedEncodingError):
+                list(stream_analyses_from_ena('PRJEB45554', tries=2))
+
+    def test_get_analyses_to_process_streamed(self):
+        processed_analyses_file = os.path.join(self.toplevel_download_folder, 'processed_analyses.csv')
+        ignored_analysis_file = os.path.join(self.toplevel_download_folder, 'ignored_analysis.csv')
+        with open(processed_analyses_file, 'w') as open_file:
+            open_file.write('acc1,ftp.ebi.ac.uk/acc1/rr1.vcf.gz\n')
+        with patch('covid19dp_submission.download_analyses.requests.get',
+                   return_value=tsv_response(analyses_report(1000))):
+            analyses = get_analyses_to_process(
+                project='PRJEB45554', num_analyses=4, processed_analyses_file=processed_analyses_file,
+                ignored_analysis_file=ignored_analysis_file, accepted_taxonomies=[2697049]
+            )
+        assert [a.get('analysis_accession') for a in analyses] == ['acc2', 'acc4', 'acc5', 'acc7']
+        # Only the analyses read before enough were found have been inspected
+        with open(ignored_analysis_file) as open_file:
+            assert sorted(line.split(',')[0] for line in open_file) == ['acc3', 'acc6']
+
+    def test_get_analyses_to_process_delta_fetch(self):
+        processed_analyses_file = os.path.join(self.toplevel_download_folder, 'processed_analyses.csv')
+        ignored_analysis_file = os.path.join(self.toplevel_download_folder, 'ignored_analysis.csv')
+        registry = CsvAnalysisRegistry(processed_analyses_file, ignored_analysis_file)
+
+        def get_analyses(num_analyses, report):
+            with patch('covid19dp_submission.download_analyses.requests.get',
+                       return_value=tsv_response(report)) as mock_get:
+                analyses = get_analyses_to_process(
+                    project='PRJEB45554', num_analyses=num_analyses, processed_analyses_file=processed_analyses_file,
+                    ignored_analysis_file=ignored_analysis_file, accepted_taxonomies=[2697049],
+                    analysis_registry=registry, delta_fetch=True
+                )
+            registry.add_processed_analyses(analyses)
+            return analyses, mock_get.call_args[0][0]
+
+        # A full sweep that fills its batch still reads the whole report and is recorded from the time it started
+        sweep_started = datetime.now().isoformat(timespec='seconds')
+        analyses, url = get_analyses(5, analyses_report(50))
+        assert '/filereport?' in url
+        assert [a['analysis_accession'] for a in analyses] == ['acc1', 'acc2', 'acc4', 'acc5', 'acc7']
+        watermark = registry.get_watermark('PRJEB45554')
+        # The watermark stays at the earliest analysis left for later
+        assert watermark['watermark'] == '2022-01-01'
+        assert sweep_started <= watermark['last_full_sweep'] <= datetime.now().isoformat(timespec='seconds')
+        # The next fetches are delta fetches, which get the analyses left by the full sweep
+        analyses, url = get_analyses(100, analyses_report(50))
+        assert '/search?' in url and 'first_public%3E%3D2022-01-01' in url
+        assert len(analyses) == 34 - 5
+        assert registry.get_watermark('PRJEB45554') == {'watermark': '2022-01-06',
+                                                        'last_full_sweep': watermark['last_full_sweep']}
+        # Only the new analyses are requested
+        analyses, url = get_analyses(100, analyses_report(20, start=40))
+        assert '/search?' in url and 'first_public%3E%3D2022-01-06' in url
+        assert [a['analysis_accession'] for a in analyses] == ['acc52', 'acc53', 'acc55', 'acc56', 'acc58', 'acc59']
+        assert registry.get_watermark('PRJEB45554') == {'watermark': '2022-01-06',
+                                                        'last_full_sweep': watermark['last_full_sweep']}
+        # A delta fetch that fills its batch from a report not ordered by first_public keeps the watermark at the
+        # earliest analysis left unread
+        report = analyses_report(30, start=60)
+        analyses, url = get_analyses(3, report[:1] + report[:0:-1])
+        assert [a['analysis_accession'] for a in analyses] == ['acc89', 'acc88', 'acc86']
+        assert registry.get_watermark('PRJEB45554') == {'watermark': '2022-01-07',
+                                                        'last_full_sweep': watermark['last_full_sweep']}
+        analyses, url = get_analyses(100, report)
+        assert 'first_public%3E%3D2022-01-07' in url
+        assert [a['analysis_accession'] for a in analyses][:3] == ['acc61', 'acc62', 'acc64']
+        assert registry.get_watermark('PRJEB45554') == {'watermark': '2022-01-09',
+                                                        'last_full_sweep': watermark['last_full_sweep']}
+        # A full sweep is required once the last one is too old
+        registry.set_watermark('PRJEB45554', '2022-01-06')
+        with patch('covid19dp_submission.download_analyses.datetime') as mock_datetime:
+            mock_datetime.now.return_value = datetime.now() + timedelta(days=8)
+            mock_datetime.fromisoformat = datetime.fromisoformat
+            analyses, url = get_analyses(100, analyses_report(60))
+        assert '/filereport?' in url
+
+    def test_pack_batches_by_size(self):
+        sizes = [10, 500, 20, 30, 400, 5, 5, 300, 40, 50]
+        analyses = [{'analysis_accession': f'acc{i}', 'submitted_bytes': str(size)} for i, size in enumerate(sizes)]
+        analyses.append({'analysis_accession': 'acc10', 'submitted_bytes': '60;70'})
+        batches = pack_batches_by_size(analyses, batch_size=4)
+        assert sorted(len(batch) for batch in batches) == [3, 4, 4]
+        # Batches have similar sizes and the largest comes first
+        batch_bytes = [sum(int(s) for a in batch for s in a['submitted_bytes'].split(';')) for batch in batches]
+        assert batch_bytes == [510, 490, 490]
+        assert sorted(a['analysis_accession'] for batch in batches for a in batch) == \
+            sorted(a['analysis_accession'] for a in analyses)
+        # The largest files are spread between the batches
+        assert sorted(batch[0]['submitted_bytes'] for batch in batches) == ['300', '400', '500']
+        # Without sizes, the analyses are kept in order
+        analyses = [{'analysis_accession': f'acc{i}', 'submitted_bytes': ''} for i in range(5)]
+        assert pack_batches_by_size(analyses, batch_size=2) == [analyses[0:2], analyses[2:4], analyses[4:]]
+
     def test_add_to_ignored_file(self):
         analysis_to_ignore = [
             {'analysis_accession': 'accession1', 'submitted_ftp': 'ftp.example.com/accession1/vcf_file1.vcf.gz'},
@@ -160,6 +332,61 @@ class TestDownloadAnalysisENA(TestCase):
             assert len(lines) == 8
         assert len(downloaded_files) == 8
 
+    def test_concurrent_download_files_via_aspera(self):
+        analyses_array = [
+            {'run_ref': f'rr{i}', 'analysis_accession': f'acc{i}', 'submitted_ftp': f'ftp.ebi.ac.uk/acc{i}/rr{i}.vcf.gz',
+             'submitted_aspera': f'asperap.ebi.ac.uk/acc{i}/rr{i}.vcf.gz'} for i in range(1, 12)
+        ]
+        downloaded_files = []
+        with patch('covid19dp_submission.download_analyses.run_command_with_output') as mock_run:
+            for analysis in analyses_array:
+                expected_file = os.path.join(self.download_target_dir, os.path.basename(analysis['submitted_aspera']))
+                touch(expected_file)
+            download_files_via_aspera(analyses_array, self.download_target_dir, self.processed_analyses_file,
+                                      'ascp', 'aspera_id_dsa', downloaded_files, batch_size=2,
+                                      max_concurrent_transfers=4, total_bandwidth_mbps=400)
+        # 6 batches sharing the bandwidth between 4 concurrent transfers
+        assert mock_run.call_count == 6
+        assert all(' -l 100m ' in call_args[0][1] for call_args in mock_run.call_args_list)
+        assert analyses_array == []
+        with open(self.processed_analyses_file) as open_file:
+            assert len(open_file.readlines()) == 11
+        assert len(downloaded_files) == 11
+
+    def test_download_files_via_aspera_requeues_corrupted_files(self):
+        contents = {f'rr{i}.vcf.gz': f'content of rr{i}'.encode() for i in range(1, 5)}
+        analyses_array = [
+            {'run_ref': f'rr{i}', 'analysis_accession': f'acc{i}', 'submitted_ftp': f'ftp.ebi.ac.uk/acc{i}/rr{i}.vcf.gz',
+             'submitted_aspera': f'asperap.ebi.ac.uk/acc{i}/rr{i}.vcf.gz',
+             'submitted_md5': hashlib.md5(contents[f'rr{i}.vcf.gz']).hexdigest()} for i in range(1, 5)
+        ]
+        corrupted_transfers = ['rr2.vcf.gz']
+
+        def transfer(_, command):
+            for file_name in contents:
+                if file_name in command:
+                    content = contents[file_name]
+                    if file_name in corrupted_transfers:
+                        corrupted_transfers.remove(file_name)
+                        content = content[:-1]
+                    with open(os.path.join(self.download_target_dir, file_name), 'wb') as open_file:
+                        open_file.write(content)
+
+        downloaded_files = []
+        with patch('covid19dp_submission.download_analyses.run_command_with_output', side_effect=transfer) as mock_run:
+            download_files_via_aspera(analyses_array, self.download_target_dir, self.processed_analyses_file,
+                                      'ascp', 'aspera_id_dsa', downloaded_files, batch_size=2,
+                                      max_concurrent_transfers=2)
+        # 2 batches then the corrupted file transferred on its own
+        assert mock_run.call_count == 3
+        assert 'rr2.vcf.gz' in mock_run.call_args_list[2][0][1]
+        assert analyses_array == []
+        assert sorted(os.path.basename(f) for f in downloaded_files) == sorted(contents)
+        with open(os.path.join(self.download_target_dir, 'rr2.vcf.gz'), 'rb') as open_file:
+            assert open_file.read() == contents['rr2.vcf.gz']
+        with open(self.processed_analyses_file) as open_file:
+            assert len(open_file.readlines()) == 4
+
     def test_retry_download_files_via_aspera(self):
         analyses_array = [
             {'run_ref': f'rr{i}', 'analysis_accession': f'acc{i}', 'submitted_ftp': f'ftp.ebi.ac.uk/acc{i}/rr{i}.vcf.gz',
@@ -0,0 +1,76 @@
+import os
+import shutil
+import threading
+import time
+from unittest import TestCase
+
+from covid19dp_submission import ROOT_DIR
+from covid19dp_submission.steps.vcf_vertical_concat.dynamic_scheduler import DynamicConcatScheduler
+from covid19dp_submission.steps.vcf_vertical_concat.run_vcf_vertical_concat_pipeline import \
+    get_concat_result_file_name
+
+
+class TestDynamicConcatScheduler(TestCase):
+    resources_folder = os.path.join(ROOT_DIR, 'tests', 'resources')
+    processing_dir = os.path.join(resources_folder, 'dynamic_concat_run')
+
+    def setUp(self) -> None:
+        shutil.rmtree(self.processing_dir, ignore_errors=True)
+        os.makedirs(self.processing_dir)
+        self.merges = []
+        self.lock = threading.Lock()
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.processing_dir, ignore_errors=True)
+
+    def create_input_files(self, num_files):
+        input_files = []
+        for i in range(num_files):
+            input_file = os.path.join(self.processing_dir, f'input{i}.vcf.gz')
+            with open(input_file, 'w') as open_file:
+                open_file.write(f'record{i}\n')
+            input_files.append(input_file)
+        return input_files
+
+    def fake_merge(self, files_to_concat_list, concat_processing_dir, output_vcf_file, bcftools_binary):
+        # Stand-in for bcftools concat that concatenates text files, slowly for the files including the first input
+        with open(files_to_concat_list) as open_file:
+            files_to_concat = open_file.read().split()
+        content = ''
+        for file_to_concat in files_to_concat:
+            with open(file_to_concat) as open_file:
+                content += open_file.read()
+        if 'record0\n' in content and output_vcf_file.endswith('merge0.vcf.gz'):
+            time.sleep(0.5)
+        os.makedirs(os.path.dirname(output_vcf_file), exist_ok=True)
+        with open(output_vcf_file, 'w') as open_file:
+            open_file.write(content)
+        with self.lock:
+            self.merges.append((files_to_concat, output_vcf_file))
+
+    def test_all_files_concatenated_once(self):
+        for num_files, concat_chunk_size, num_workers in [(1, 2, 1), (5, 2, 1), (17, 3, 4), (100, 10, 3)]:
+            self.setUp()
+            input_files = self.create_input_files(num_files)
+            result_file = get_concat_result_file_name(self.processing_dir, max(num_files, 2), concat_chunk_size)
+            scheduler = DynamicConcatScheduler(self.processing_dir, concat_chunk_size, 'bcftools', num_workers,
+                                               merge_function=self.fake_merge)
+            self.assertEqual(result_file, scheduler.run(input_files, result_file))
+            with open(result_file) as open_file:
+                self.assertEqual(sorted(f'record{i}' for i in range(num_files)), sorted(open_file.read().split()))
+            self.assertTrue(all(len(files) <= concat_chunk_size for files, _ in self.merges))
+
+    def test_slow_merge_does_not_hold_other_merges(self):
+        input_files = self.create_input_files(8)
+        result_file = get_concat_result_file_name(self.processing_dir, 8, 2)
+        DynamicConcatScheduler(self.processing_dir, 2, 'bcftools', num_workers=2,
+                               merge_function=self.fake_merge).run(input_files, result_file)
+        # All the other files were merged together while the first merge was running
+        slow_merge_output = self.merges[-2][1]
+        self.assertTrue(slow_merge_output.endswith('merge0.vcf.gz'))
+        self.assertEqual(result_file, self.merges[-1][1])
+        self.assertEqual(2, len(self.merges[-1][0]))
+
+    def test_chunk_size_too_small(self):
+        with self.assertRaises(ValueError):
+            DynamicConcatScheduler(self.processing_dir, 1, 'bcftools')
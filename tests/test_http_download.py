@@ -0,0 +1,146 @@
+import hashlib
+import os
+import re
+import shutil
+import threading
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import TestCase
+from unittest.mock import patch
+
+import requests
+
+from covid19dp_submission import ROOT_DIR
+from covid19dp_submission.download_analyses import download_files
+from covid19dp_submission.file_checksum import ChecksumMismatchError
+from covid19dp_submission.http_download import HttpDownloader
+
+
+class StandInFileHandler(BaseHTTPRequestHandler):
+    """
+    Serve the content of the server's files dict with support for Range requests.
+    The first request for the paths in the server's interrupted set only sends half of the content.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.requests.append((self.path, self.headers.get('Range')))
+        content = self.server.files.get(self.path)
+        if content is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        start = 0
+        range_match = re.match(r'bytes=(\d+)-', self.headers.get('Range') or '')
+        if range_match:
+            start = int(range_match.group(1))
+            if start >= len(content):
+                self.send_response(416)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{len(content) - 1}/{len(content)}')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(content) - start))
+        self.end_headers()
+        if self.path in self.server.interrupted:
+            self.server.interrupted.remove(self.path)
+            self.wfile.write(content[start:start + (len(content) - start) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(content[start:])
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestHttpDownloader(TestCase):
+    resources_folder = os.path.join(ROOT_DIR, 'tests', 'resources')
+    download_dir = os.path.join(resources_folder, 'http_download')
+
+    def setUp(self) -> None:
+        shutil.rmtree(self.download_dir, ignore_errors=True)
+        os.makedirs(self.download_dir)
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StandInFileHandler)
+        self.server.files = {f'/vol1/acc{i}/file{i}.vcf': (f'##fileformat=VCFv4.1\n{i}\n' * 1000 * i).encode()
+                             for i in range(1, 6)}
+        self.server.interrupted = set()
+        self.server.requests = []
+        self.host = f'127.0.0.1:{self.server.server_address[1]}'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.download_dir, ignore_errors=True)
+
+    def test_download_file(self):
+        target_file = os.path.join(self.download_dir, 'file1.vcf')
+        HttpDownloader(backoff=0).download_file(f'http://{self.host}/vol1/acc1/file1.vcf', target_file)
+        with open(target_file, 'rb') as open_file:
+            assert open_file.read() == self.server.files['/vol1/acc1/file1.vcf']
+        assert not os.path.exists(target_file + '.part')
+
+    def test_resume_interrupted_download(self):
+        self.server.interrupted.add('/vol1/acc2/file2.vcf')
+        target_file = os.path.join(self.download_dir, 'file2.vcf')
+        HttpDownloader(backoff=0, chunk_size=1024).download_file(f'http://{self.host}/vol1/acc2/file2.vcf',
+                                                                  target_file)
+        with open(target_file, 'rb') as open_file:
+            assert open_file.read() == self.server.files['/vol1/acc2/file2.vcf']
+        # The second request only asks for the missing part of the file
+        assert len(self.server.requests) == 2
+        assert self.server.requests[0] == ('/vol1/acc2/file2.vcf', None)
+        resume_offset = int(re.match(r'bytes=(\d+)-', self.server.requests[1][1]).group(1))
+        assert 0 < resume_offset <= len(self.server.files['/vol1/acc2/file2.vcf']) // 2
+
+    def test_download_file_with_md5(self):
+        self.server.interrupted.add('/vol1/acc3/file3.vcf')
+        content = self.server.files['/vol1/acc3/file3.vcf']
+        target_file = os.path.join(self.download_dir, 'file3.vcf')
+        # The MD5 covers the content downloaded before the interruption
+        HttpDownloader(backoff=0, chunk_size=1024).download_file(f'http://{self.host}/vol1/acc3/file3.vcf',
+                                                                  target_file, hashlib.md5(content).hexdigest())
+        with open(target_file, 'rb') as open_file:
+            assert open_file.read() == content
+
+    def test_download_file_with_wrong_md5(self):
+        target_file = os.path.join(self.download_dir, 'file1.vcf')
+        with self.assertRaises(ChecksumMismatchError):
+            HttpDownloader(backoff=0, max_attempts=2).download_file(f'http://{self.host}/vol1/acc1/file1.vcf',
+                                                                    target_file, hashlib.md5(b'other').hexdigest())
+        # The corrupted file is downloaded again from the start
+        assert self.server.requests == [('/vol1/acc1/file1.vcf', None)] * 2
+        assert not os.path.exists(target_file)
+        assert not os.path.exists(target_file + '.part')
+
+    def test_download_missing_file(self):
+        target_file = os.path.join(self.download_dir, 'missing.vcf')
+        with self.assertRaises(requests.HTTPError):
+            HttpDownloader(backoff=0).download_file(f'http://{self.host}/missing.vcf', target_file)
+        # Missing files are not retried
+        assert len(self.server.requests) == 1
+        assert not os.path.exists(target_file)
+
+    def test_download_files(self):
+        analyses_array = [
+            {'analysis_accession': f'acc{i}', 'submitted_ftp': f'{self.host}/vol1/acc{i}/file{i}.vcf'}
+            for i in range(0, 6)
+        ]
+        self.server.interrupted.update(['/vol1/acc3/file3.vcf', '/vol1/acc5/file5.vcf'])
+        processed_analyses_file = os.path.join(self.download_dir, 'processed_analyses.csv')
+        with patch('covid19dp_submission.download_analyses.HttpDownloader', partial(HttpDownloader, backoff=0)):
+            downloaded_files = download_files(analyses_array, self.download_dir, processed_analyses_file,
+                                              max_workers=3)
+        # acc0 does not exist on the server
+        assert [a['analysis_accession'] for a in analyses_array] == ['acc0']
+        assert sorted(os.path.basename(f) for f in downloaded_files) == [f'file{i}.vcf' for i in range(1, 6)]
+        for i in range(1, 6):
+            with open(os.path.join(self.download_dir, f'file{i}.vcf'), 'rb') as open_file:
+                assert open_file.read() == self.server.files[f'/vol1/acc{i}/file{i}.vcf']
+        with open(processed_analyses_file) as open_file:
+            assert len(open_file.readlines()) == 5
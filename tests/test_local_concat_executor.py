@@ -0,0 +1,105 @@
+import os
+import shutil
+import threading
+from unittest import TestCase
+
+from covid19dp_submission import ROOT_DIR
+from covid19dp_submission.steps.vcf_vertical_concat.local_executor import LocalConcatExecutor
+from covid19dp_submission.steps.vcf_vertical_concat.run_vcf_vertical_concat_pipeline import \
+    get_concat_result_file_name, get_vertical_concat_stages
+
+
+class TestLocalConcatExecutor(TestCase):
+    resources_folder = os.path.join(ROOT_DIR, 'tests', 'resources')
+    processing_dir = os.path.join(resources_folder, 'local_concat_run')
+
+    def setUp(self) -> None:
+        shutil.rmtree(self.processing_dir, ignore_errors=True)
+        os.makedirs(self.processing_dir)
+        self.merges = []
+        self.lock = threading.Lock()
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.processing_dir, ignore_errors=True)
+
+    def create_input_files(self, num_files):
+        input_files = []
+        for i in range(num_files):
+            input_file = os.path.join(self.processing_dir, f'input{i}.vcf.gz')
+            with open(input_file, 'w') as open_file:
+                open_file.write(f'record{i}\n')
+            input_files.append(input_file)
+        return input_files
+
+    def fake_merge(self, files_to_concat_list, concat_processing_dir, output_vcf_file, bcftools_binary):
+        # Stand-in for bcftools concat and index that concatenates text files
+        with open(files_to_concat_list) as open_file:
+            files_to_concat = open_file.read().split()
+        content = ''
+        for file_to_concat in files_to_concat:
+            with open(file_to_concat) as open_file:
+                content += open_file.read()
+        if 'record13\n' in content and getattr(self, 'fail_merges', False):
+            # Interrupted while writing the output
+            with open(output_vcf_file, 'w') as open_file:
+                open_file.write(content[:len(content) // 2])
+            raise RuntimeError('bcftools failed')
+        with open(output_vcf_file, 'w') as open_file:
+            open_file.write(content)
+        open(output_vcf_file + '.csi', 'w').close()
+        with self.lock:
+            self.merges.append(output_vcf_file)
+
+    def run_executor(self, input_files, concat_chunk_size, num_workers=3, resume=False):
+        stages = get_vertical_concat_stages(input_files, self.processing_dir, concat_chunk_size)
+        LocalConcatExecutor(self.processing_dir, 'bcftools', num_workers, merge_function=self.fake_merge).run(
+            stages, resume)
+        return stages
+
+    def test_same_layout_as_nextflow_pipeline(self):
+        input_files = self.create_input_files(17)
+        stages = self.run_executor(input_files, 3)
+        self.assertEqual([6, 2, 1], [len(stage_batches) for stage_batches in stages])
+        result_file = get_concat_result_file_name(self.processing_dir, 17, 3)
+        self.assertEqual(result_file, stages[-1][0]['output_vcf_file'])
+        with open(result_file) as open_file:
+            self.assertEqual([f'record{i}' for i in range(17)], open_file.read().split())
+        self.assertEqual(9, len(self.merges))
+        with open(os.path.join(self.processing_dir, 'vertical_concat', 'stage_1',
+                               'batch1_files_to_be_concatenated.txt')) as open_file:
+            self.assertEqual([batch['output_vcf_file'] for batch in stages[0][3:]], open_file.read().split())
+
+    def test_resume(self):
+        input_files = self.create_input_files(17)
+        self.fail_merges = True
+        with self.assertRaises(RuntimeError):
+            self.run_executor(input_files, 3, num_workers=1)
+        # The batches are run in order and none is started after the batch with record13 failed
+        stage_outputs = [[batch['output_vcf_file'] for batch in stage_batches] for stage_batches in
+                         get_vertical_concat_stages(input_files, self.processing_dir, 3)]
+        self.assertEqual(stage_outputs[0][:4], self.merges)
+
+        self.fail_merges = False
+        self.merges = []
+        self.run_executor(input_files, 3, resume=True)
+        # Only the batches completed by the first run are not run again
+        self.assertEqual(sorted(stage_outputs[0][4:] + stage_outputs[1] + stage_outputs[2]), sorted(self.merges))
+        with open(get_concat_result_file_name(self.processing_dir, 17, 3)) as open_file:
+            self.assertEqual([f'record{i}' for i in range(17)], open_file.read().split())
+
+    def test_resume_after_interrupted_rerun(self):
+        input_files = self.create_input_files(17)
+        self.run_executor(input_files, 3)
+        # A run that merges the batches again is interrupted while rewriting the output of the batch with record13
+        self.fail_merges = True
+        with self.assertRaises(RuntimeError):
+            self.run_executor(input_files, 3, num_workers=1)
+
+        self.fail_merges = False
+        self.merges = []
+        self.run_executor(input_files, 3, resume=True)
+        # The truncated output is not taken for the output of the first run
+        self.assertIn(get_vertical_concat_stages(input_files, self.processing_dir, 3)[0][4]['output_vcf_file'],
+                      self.merges)
+        with open(get_concat_result_file_name(self.processing_dir, 17, 3)) as open_file:
+            self.assertEqual([f'record{i}' for i in range(17)], open_file.read().split())
@@ -0,0 +1,141 @@
+import os
+import shutil
+import stat
+import sys
+from unittest import TestCase
+
+from covid19dp_submission import ROOT_DIR
+from covid19dp_submission.local_workflow import LocalSubmissionWorkflow, WorkflowStepError, run_local_workflow
+
+# Stand-in for all the steps, which records how it was run
+FAKE_STEP = '''import os
+import sys
+
+with open(os.environ['STEP_RECORD_FILE'], 'a') as open_file:
+    open_file.write(__spec__.name + ' ' + ' '.join(sys.argv[1:]) + '\\n')
+if os.path.exists(os.environ['STEP_RECORD_FILE'] + '.' + __spec__.name.split('.')[-1] + '.fail'):
+    sys.exit(1)
+'''
+FAKE_BINARY = '''#!/bin/sh
+echo "$(basename $0) $@" >> $STEP_RECORD_FILE
+'''
+STEP_MODULES = ['run_vcf_validator', 'run_asm_checker', 'bgzip_and_index_vcf', 'preprocess_vcfs', 'normalise_vcfs',
+                'accession_vcf', 'cluster_assembly', 'vcf_vertical_concat/run_vcf_vertical_concat_pipeline',
+                'vcf_vertical_concat/cumulative_concat']
+
+
+class TestLocalWorkflow(TestCase):
+    resources_folder = os.path.join(ROOT_DIR, 'tests', 'resources')
+    processing_dir = os.path.join(resources_folder, 'local_workflow_run')
+    script_path = os.path.join(processing_dir, 'scripts')
+    bin_dir = os.path.join(processing_dir, 'bin')
+    download_target_dir = os.path.join(processing_dir, 'snapshot')
+    record_file = os.path.join(processing_dir, 'steps.txt')
+
+    def setUp(self) -> None:
+        shutil.rmtree(self.processing_dir, ignore_errors=True)
+        os.makedirs(os.path.join(self.script_path, 'steps', 'vcf_vertical_concat'))
+        os.symlink(os.path.join(ROOT_DIR, 'covid19dp_submission', 'step_client.py'),
+                   os.path.join(self.script_path, 'step_client.py'))
+        for package in ('steps', 'steps/vcf_vertical_concat'):
+            open(os.path.join(self.script_path, package, '__init__.py'), 'w').close()
+        for module in STEP_MODULES:
+            with open(os.path.join(self.script_path, 'steps', module + '.py'), 'w') as open_file:
+                open_file.write(FAKE_STEP)
+        os.makedirs(self.bin_dir)
+        for binary in ('java', 'rsync'):
+            with open(os.path.join(self.bin_dir, binary), 'w') as open_file:
+                open_file.write(FAKE_BINARY)
+            os.chmod(os.path.join(self.bin_dir, binary), stat.S_IRWXU)
+        os.makedirs(self.download_target_dir)
+        with open(os.path.join(self.processing_dir, 'assembly.fa'), 'w') as open_file:
+            open_file.write('>MN908947.3\nACGT\n')
+        self.vcf_files = [os.path.join(self.download_target_dir, f'file{i}.vcf') for i in range(5)]
+        with open(os.path.join(self.download_target_dir, 'file_list.csv'), 'w') as open_file:
+            open_file.write('\n'.join(self.vcf_files))
+        self.environ = dict(os.environ)
+        os.environ['STEP_RECORD_FILE'] = self.record_file
+        os.environ['PATH'] = self.bin_dir + os.pathsep + os.environ['PATH']
+        os.environ.pop('STEP_SERVER_SOCKET', None)
+
+    def tearDown(self) -> None:
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.processing_dir, ignore_errors=True)
+
+    def get_params(self, preprocessing_mode='fused'):
+        log_dir = os.path.join(self.processing_dir, 'logs')
+        os.makedirs(log_dir, exist_ok=True)
+        return {
+            'executable': {'python': {'interpreter': sys.executable, 'script_path': self.script_path},
+                           'bcftools': 'bcftools', 'nextflow': 'nextflow', 'nextflow_config_file': 'nf.config',
+                           'vcf_validator': 'vcf_validator', 'vcf_assembly_checker': 'vcf_assembly_checker'},
+            'jar': {'accession_pipeline': 'accession.jar', 'clustering_pipeline': 'clustering.jar',
+                    'release_pipeline': 'release.jar'},
+            'submission': {
+                'download_target_dir': self.download_target_dir,
+                'download_file_list': os.path.join(self.download_target_dir, 'file_list.csv'),
+                'batch_size': 2, 'batch_cpus': 1, 'preprocessing_mode': preprocessing_mode,
+                'assembly_fasta': os.path.join(self.processing_dir, 'assembly.fa'), 'assembly_report': 'report.txt',
+                'validation_dir': log_dir, 'validation_cache_dir': log_dir, 'log_dir': log_dir,
+                'concat_processing_dir': os.path.join(self.download_target_dir, 'processed'),
+                'concat_chunk_size': 2, 'concat_scheduler': 'static', 'concat_engine': 'bcftools',
+                'concat_executor': 'nextflow', 'concat_workers': 1,
+                'concat_result_file': os.path.join(self.download_target_dir, 'processed', 'result.vcf.gz'),
+                'accessioning_properties_file': 'accessioning.properties', 'accessioning_instance': 'instance-1',
+                'clustering_properties_file': 'clustering.properties', 'clustering_instance': 'instance-1',
+                'accession_output_dir': os.path.join(self.processing_dir, 'public'),
+                'accession_output_file': os.path.join(self.processing_dir, 'public', 'snapshot.accessioned.vcf'),
+                'public_ftp_dir': os.path.join(self.processing_dir, 'ftp'),
+                'memory_for_incremental_release_in_gb': 1, 'release_properties_file': 'release.properties',
+                'cumulative_concat': True, 'cumulative_dir': os.path.join(self.processing_dir, 'cumulative'),
+                'snapshot_name': 'snapshot', 'local_workflow_concurrency': {'validate_vcfs': 2}
+            }
+        }
+
+    def get_steps_run(self):
+        with open(self.record_file) as open_file:
+            return [line.split()[0] for line in open_file]
+
+    def test_same_dag_as_nextflow_workflow(self):
+        params = self.get_params(preprocessing_mode='separate')
+        self.assertEqual(2, LocalSubmissionWorkflow(params).concurrency['validate_vcfs'])
+        run_local_workflow(params)
+        with open(self.record_file) as open_file:
+            lines = open_file.read().splitlines()
+        steps_run = [line.split()[0] for line in lines]
+        # Each batch is validated and assembly checked before it is compressed
+        for i, line in enumerate(lines):
+            if line.startswith('steps.bgzip_and_index_vcf'):
+                batch = line.split('--vcf-file ')[1].split(' --')[0]
+                self.assertEqual({'steps.run_vcf_validator', 'steps.run_asm_checker'},
+                                 {step.split()[0] for step in lines[:i] if batch + ' --' in step})
+        self.assertEqual(3, steps_run.count('steps.run_vcf_validator'))
+        self.assertEqual(3, steps_run.count('steps.bgzip_and_index_vcf'))
+        final_steps = steps_run[9:]
+        self.assertEqual(['steps.vcf_vertical_concat.run_vcf_vertical_concat_pipeline', 'steps.normalise_vcfs'],
+                         final_steps[:2])
+        accessioning_steps = [step for step in final_steps[2:] if step != 'steps.vcf_vertical_concat.cumulative_concat']
+        self.assertEqual(['steps.accession_vcf', 'rsync', 'steps.cluster_assembly', 'java'], accessioning_steps)
+        self.assertIn('steps.vcf_vertical_concat.cumulative_concat', final_steps)
+        with open(os.path.join(self.download_target_dir, 'refseq_fasta.fa')) as open_file:
+            self.assertEqual('>NC_045512.2\nACGT\n', open_file.read())
+
+    def test_resume(self):
+        params = self.get_params()
+        open(self.record_file + '.cluster_assembly.fail', 'w').close()
+        with self.assertRaises(WorkflowStepError):
+            run_local_workflow(params)
+        self.assertEqual(3, self.get_steps_run().count('steps.preprocess_vcfs'))
+        self.assertNotIn('java', self.get_steps_run())
+
+        os.remove(self.record_file + '.cluster_assembly.fail')
+        os.remove(self.record_file)
+        run_local_workflow(params, resume=True)
+        # Only the failed step and the steps after it are run again
+        self.assertEqual(['steps.cluster_assembly', 'java'], self.get_steps_run())
+
+        # Without resume the checkpoints are ignored
+        os.remove(self.record_file)
+        run_local_workflow(params)
+        self.assertEqual(10, len(self.get_steps_run()))
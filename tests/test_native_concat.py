@@ -0,0 +1,103 @@
+import glob
+import os
+import shutil
+from unittest import TestCase
+
+from covid19dp_submission import ROOT_DIR
+from covid19dp_submission.bgzf import BgzfWriter, is_bgzf
+from covid19dp_submission.csi_index import index_bgzf_vcf
+from covid19dp_submission.steps.vcf_vertical_concat.native_concat import native_vcf_concat, VcfConcatError
+from covid19dp_submission.vcf_reader import DistinctLoci, iter_data_lines
+
+
+class TestNativeConcat(TestCase):
+    resources_folder = os.path.join(ROOT_DIR, 'tests', 'resources')
+    processing_dir = os.path.join(resources_folder, 'native_concat_run')
+    header = '##fileformat=VCFv4.1\n##contig=<ID=MN908947.3>\n' \
+             '##INFO=<ID=AF,Number=1,Type=Float,Description="Allele Frequency">\n' \
+             '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n'
+
+    def setUp(self) -> None:
+        shutil.rmtree(self.processing_dir, ignore_errors=True)
+        os.makedirs(self.processing_dir)
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.processing_dir, ignore_errors=True)
+
+    def write_vcf(self, name, records, header=None):
+        vcf_file = os.path.join(self.processing_dir, name)
+        with BgzfWriter(vcf_file) as writer:
+            writer.write(((header or self.header) + ''.join(record + '\n' for record in records)).encode())
+        return vcf_file
+
+    def read_records(self, vcf_file):
+        return [line.decode() for line in iter_data_lines(vcf_file)]
+
+    def test_remove_duplicates(self):
+        vcf1 = self.write_vcf('vcf1.vcf.gz', ['MN908947.3\t10\tfirst\tA\tG\t.\tPASS\t.',
+                                              'MN908947.3\t20\tfirst\tC\tT\t.\tPASS\t.',
+                                              'MN908947.3\t20\tfirst\tC\tT\t.\tPASS\t.'])
+        vcf2 = self.write_vcf('vcf2.vcf.gz', ['MN908947.3\t5\tsecond\tA\tG\t.\tPASS\t.',
+                                              'MN908947.3\t10\tsecond\tA\tG\t.\tPASS\t.',
+                                              'MN908947.3\t10\tsecond\tA\tC\t.\tPASS\t.',
+                                              'MN908947.3\t20\tsecond\tC\tT\t.\tPASS\t.'])
+        output_file = os.path.join(self.processing_dir, 'output.vcf.gz')
+        self.assertEqual(5, native_vcf_concat([vcf1, vcf2], output_file))
+        # The records of the first file are kept, including its own duplicates, and the ties follow the file order
+        self.assertEqual(['MN908947.3\t5\tsecond\tA\tG\t.\tPASS\t.',
+                          'MN908947.3\t10\tfirst\tA\tG\t.\tPASS\t.',
+                          'MN908947.3\t10\tsecond\tA\tC\t.\tPASS\t.',
+                          'MN908947.3\t20\tfirst\tC\tT\t.\tPASS\t.',
+                          'MN908947.3\t20\tfirst\tC\tT\t.\tPASS\t.'], self.read_records(output_file))
+        self.assertTrue(is_bgzf(output_file))
+        with open(output_file + '.csi', 'rb') as open_file:
+            written_index = open_file.read()
+        with open(index_bgzf_vcf(output_file, output_file + '.reindexed.csi'), 'rb') as open_file:
+            self.assertEqual(open_file.read(), written_index)
+
+    def test_float_formatting(self):
+        vcf1 = self.write_vcf('vcf1.vcf.gz', ['MN908947.3\t10\t.\tA\tG\t33631.0\tPASS\tAF=1.000000;DP=10',
+                                              'MN908947.3\t11\t.\tA\tG\t.\tPASS\tAF=0.998957'])
+        output_file = os.path.join(self.processing_dir, 'output.vcf.gz')
+        native_vcf_concat([vcf1], output_file)
+        self.assertEqual(['MN908947.3\t10\t.\tA\tG\t33631\tPASS\tAF=1;DP=10',
+                          'MN908947.3\t11\t.\tA\tG\t.\tPASS\tAF=0.998957'], self.read_records(output_file))
+
+    def test_batched_inputs(self):
+        vcf_files = [os.path.join(self.resources_folder, 'vcf_files', f'file{i}.vcf') for i in range(1, 6)]
+        output_file = os.path.join(self.processing_dir, 'output.vcf.gz')
+        batched_output_file = os.path.join(self.processing_dir, 'batched_output.vcf.gz')
+        native_vcf_concat(vcf_files, output_file)
+        native_vcf_concat(vcf_files, batched_output_file, max_open_files=2)
+        self.assertEqual(self.read_records(output_file), self.read_records(batched_output_file))
+        input_loci = DistinctLoci()
+        for vcf_file in vcf_files:
+            input_loci.add_vcf(vcf_file)
+        output_loci = DistinctLoci()
+        output_loci.add_vcf(output_file)
+        self.assertEqual(len(input_loci), output_loci.num_records)
+        self.assertEqual([], list(input_loci.difference(output_loci)))
+        # Only the output and its index are left
+        self.assertEqual(['batched_output.vcf.gz', 'batched_output.vcf.gz.csi', 'output.vcf.gz',
+                          'output.vcf.gz.csi'], sorted(os.listdir(self.processing_dir)))
+
+    def test_unsorted_input(self):
+        vcf1 = self.write_vcf('vcf1.vcf.gz', ['MN908947.3\t20\t.\tA\tG\t.\tPASS\t.',
+                                              'MN908947.3\t10\t.\tA\tG\t.\tPASS\t.'])
+        output_file = os.path.join(self.processing_dir, 'output.vcf.gz')
+        with self.assertRaises(VcfConcatError):
+            native_vcf_concat([vcf1], output_file)
+        self.assertEqual([], glob.glob(output_file + '*'))
+
+    def test_contigs_in_header_order(self):
+        header = '##fileformat=VCFv4.1\n##contig=<ID=chr1>\n##contig=<ID=chr2>\n' \
+                 '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n'
+        vcf1 = self.write_vcf('vcf1.vcf.gz', ['chr2\t5\t.\tA\tG\t.\tPASS\t.'], header)
+        vcf2 = self.write_vcf('vcf2.vcf.gz', ['chr1\t10\t.\tA\tG\t.\tPASS\t.',
+                                              'chr2\t7\t.\tA\tG\t.\tPASS\t.'], header)
+        output_file = os.path.join(self.processing_dir, 'output.vcf.gz')
+        # The first contig of the first file is not the first contig of the header
+        self.assertEqual(3, native_vcf_concat([vcf1, vcf2], output_file))
+        self.assertEqual(['chr1\t10\t.\tA\tG\t.\tPASS\t.',
+                          'chr2\t5\t.\tA\tG\t.\tPASS\t.',
+                          'chr2\t7\t.\tA\tG\t.\tPASS\t.'], self.read_records(output_file))
@@ -4,7 +4,8 @@ import shutil
 from unittest import TestCase
 
 from covid19dp_submission import ROOT_DIR
-from covid19dp_submission.steps.normalise_vcfs import normalise_all
+from covid19dp_submission.steps.normalise_vcfs import normalise_all, parse_normalisation_log, \
+    get_normalisation_log_file
 
 
 class TestNormaliseVCFs(TestCase):
@@ -36,3 +37,28 @@ class TestNormaliseVCFs(TestCase):
                       refseq_fasta_file=self.refseq_fasta_file)
         self.assertTrue(os.path.exists(output_file))
         self.assertEqual(1, len(glob.glob(f"{output_file}.csi")))
+
+    def test_normalise_vcfs_in_parallel(self):
+        download_dir = self.download_test_files()
+        for i in range(1, 4):
+            shutil.copy(os.path.join(download_dir, 'file_with_unnormalised_variants.vcf.gz'),
+                        os.path.join(download_dir, f'file{i}.vcf.gz'))
+        vcf_files = [f'file{i}.vcf.gz' for i in range(1, 4)]
+        output_files = normalise_all(download_dir, vcf_files=vcf_files, output_dir=self.output_dir,
+                                     bcftools_binary="bcftools", refseq_fasta_file=self.refseq_fasta_file,
+                                     num_workers=3)
+        self.assertEqual([f"{self.output_dir}/file{i}.vcf.gz" for i in range(1, 4)], output_files)
+        for output_file in output_files:
+            self.assertTrue(os.path.exists(f"{output_file}.csi"))
+            self.assertEqual(1, parse_normalisation_log(get_normalisation_log_file(output_file))['total'])
+        self.assertEqual([], glob.glob(f"{self.output_dir}/*.part"))
+
+    def test_parse_normalisation_log(self):
+        os.makedirs(self.output_dir)
+        log_file = os.path.join(self.output_dir, 'file.vcf.gz.normalise.log')
+        with open(log_file, 'w') as open_file:
+            open_file.write("Reference allele mismatch at NC_045512.2:100 .. REF_SEQ:'A' vs VCF:'C'\n"
+                            "Reference allele mismatch at NC_045512.2:200 .. REF_SEQ:'G' vs VCF:'T'\n"
+                            "Lines   total/split/joined/realigned/skipped:\t25/0/0/3/0\n")
+        stats = parse_normalisation_log(log_file)
+        self.assertEqual((25, 3, 2), (stats['total'], stats['realigned'], stats['ref_mismatch']))
@@ -0,0 +1,116 @@
+import glob
+import gzip
+import json
+import os
+import shutil
+from unittest import TestCase
+
+from covid19dp_submission import ROOT_DIR
+from covid19dp_submission.bgzf import is_bgzf
+from covid19dp_submission.steps.preprocess_vcfs import preprocess_vcfs, get_preprocessing_result_file, \
+    PreprocessingError
+from covid19dp_submission.vcf_summary import read_vcf_summary
+
+
+class TestPreprocessVcfs(TestCase):
+    resources_folder = os.path.join(ROOT_DIR, 'tests', 'resources')
+    vcf_files_folder = os.path.join(resources_folder, 'vcf_files')
+    preprocessing_test_run_folder = os.path.join(resources_folder, 'preprocessing_run')
+    output_dir = os.path.join(preprocessing_test_run_folder, 'output')
+    validation_dir = os.path.join(preprocessing_test_run_folder, 'validation')
+    assembly_report = os.path.join(resources_folder, 'GCA_009858895.3_ASM985889v3_assembly_report.txt')
+    fasta_file = os.path.join(resources_folder, 'GCA_009858895.3_ASM985889v3_genomic.fna')
+
+    def setUp(self) -> None:
+        shutil.rmtree(self.preprocessing_test_run_folder, ignore_errors=True)
+        os.makedirs(self.preprocessing_test_run_folder)
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.preprocessing_test_run_folder, ignore_errors=True)
+
+    def copy_test_files(self, file_names):
+        for file_name in file_names:
+            shutil.copy(os.path.join(self.vcf_files_folder, file_name), self.preprocessing_test_run_folder)
+        return [os.path.join(self.preprocessing_test_run_folder, file_name) for file_name in file_names]
+
+    def preprocess(self, vcf_files, cache_dir=None):
+        return preprocess_vcfs(vcf_files, self.output_dir, self.validation_dir,
+                               validator_binary='vcf_validator_linux',
+                               assembly_checker_binary='vcf_assembly_checker_linux',
+                               assembly_report=self.assembly_report, assembly_fasta=self.fasta_file, num_workers=2,
+                               cache_dir=cache_dir)
+
+    def test_preprocess_vcfs(self):
+        vcf_files = self.copy_test_files(['file1.vcf', 'file2.vcf', 'file_with_no_variants_only_headers.vcf.gz'])
+        output_files = self.preprocess(vcf_files)
+        for vcf_file, output_file in zip(vcf_files, output_files):
+            self.assertTrue(is_bgzf(output_file))
+            with open(vcf_file, 'rb') if vcf_file.endswith('.vcf') else gzip.open(vcf_file) as input_vcf, \
+                    gzip.open(output_file) as output_vcf:
+                self.assertEqual(input_vcf.read(), output_vcf.read())
+            with gzip.open(output_file + '.csi') as csi:
+                self.assertEqual(b'CSI\x01', csi.read(4))
+            with open(get_preprocessing_result_file(vcf_file, self.validation_dir)) as open_file:
+                result = json.load(open_file)
+            self.assertEqual('passed', result['status'])
+            # The validator runs on every file, even when no structure error was found
+            self.assertEqual('vcf_validator_linux', result['validator'])
+            self.assertEqual(0, result['num_structure_errors'])
+            self.assertTrue(os.path.exists(os.path.join(self.validation_dir,
+                                                        f'{os.path.basename(vcf_file)}.vcf_format.log')))
+        self.assertEqual(15, read_vcf_summary(output_files[0])['record_count'])
+        self.assertEqual(0, read_vcf_summary(output_files[2])['record_count'])
+
+    def test_preprocess_vcfs_with_failed_file(self):
+        vcf_files = self.copy_test_files(['file1.vcf', 'file_that_will_fail_asm_check.vcf.gz'])
+        with self.assertRaises(PreprocessingError):
+            self.preprocess(vcf_files)
+        # The other files of the batch are still processed but no output is written for the failed file
+        self.assertEqual([os.path.join(self.output_dir, 'file1.vcf.gz')],
+                         glob.glob(os.path.join(self.output_dir, '*.vcf.gz')))
+        with open(get_preprocessing_result_file(vcf_files[1], self.validation_dir)) as open_file:
+            self.assertEqual('vcf_assembly_checker_linux', json.load(open_file)['assembly_checker'])
+
+    def test_preprocess_vcfs_with_structure_errors(self):
+        vcf_files = self.copy_test_files(['file_with_errors.vcf.gz'])
+        with self.assertRaises(PreprocessingError):
+            self.preprocess(vcf_files)
+        with open(get_preprocessing_result_file(vcf_files[0], self.validation_dir)) as open_file:
+            result = json.load(open_file)
+        self.assertEqual(['Line 20: Invalid POS 241A'], result['structure_errors'])
+        self.assertEqual('vcf_validator_linux', result['validator'])
+        self.assertIn('Unacceptable VCF validation errors found', result['error'])
+
+    def test_preprocess_vcfs_without_validator_output(self):
+        vcf_files = self.copy_test_files(['file1.vcf'])
+        with self.assertRaises(PreprocessingError):
+            preprocess_vcfs(vcf_files, self.output_dir, self.validation_dir,
+                            validator_binary='binary_that_does_not_exist',
+                            assembly_checker_binary='vcf_assembly_checker_linux',
+                            assembly_report=self.assembly_report, assembly_fasta=self.fasta_file)
+        with open(get_preprocessing_result_file(vcf_files[0], self.validation_dir)) as open_file:
+            result = json.load(open_file)
+        # The log of the validator is pointed at rather than a report that does not exist
+        self.assertEqual(f'The VCF validator produced no output. See file '
+                         f'{self.validation_dir}/file1.vcf.vcf_format.log for details.', result['error'])
+
+    def test_preprocess_vcfs_with_cache(self):
+        cache_dir = os.path.join(self.preprocessing_test_run_folder, 'validation_cache')
+        vcf_files = self.copy_test_files(['file1.vcf', 'file2.vcf'])
+        self.preprocess(vcf_files, cache_dir)
+        for vcf_file in vcf_files:
+            with open(get_preprocessing_result_file(vcf_file, self.validation_dir)) as open_file:
+                result = json.load(open_file)
+            self.assertEqual('vcf_validator_linux', result['validator'])
+            self.assertEqual('in-process', result['assembly_checker'])
+        # The same content is not validated nor assembly checked again, but is still written to the output
+        shutil.rmtree(self.output_dir)
+        output_files = self.preprocess(vcf_files, cache_dir)
+        for vcf_file, output_file in zip(vcf_files, output_files):
+            with open(get_preprocessing_result_file(vcf_file, self.validation_dir)) as open_file:
+                result = json.load(open_file)
+            self.assertEqual('passed', result['status'])
+            self.assertEqual('cache', result['validator'])
+            self.assertEqual('cache', result['assembly_checker'])
+            self.assertTrue(is_bgzf(output_file))
+            self.assertTrue(os.path.exists(output_file + '.csi'))
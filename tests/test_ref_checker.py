@@ -0,0 +1,63 @@
+import glob
+import os
+import shutil
+from unittest import TestCase
+
+from covid19dp_submission import ROOT_DIR
+from covid19dp_submission.ref_checker import ReferenceAlleleChecker
+from covid19dp_submission.reference_fasta import MemoryMappedFasta, read_assembly_report_aliases
+
+
+class TestRefChecker(TestCase):
+    resources_folder = os.path.join(ROOT_DIR, 'tests', 'resources')
+    vcf_files_folder = os.path.join(resources_folder, 'vcf_files')
+    ref_check_test_run_folder = os.path.join(resources_folder, 'ref_check_run')
+    assembly_report = os.path.join(resources_folder, 'GCA_009858895.3_ASM985889v3_assembly_report.txt')
+    fasta_file = os.path.join(resources_folder, 'GCA_009858895.3_ASM985889v3_genomic.fna')
+
+    def setUp(self) -> None:
+        shutil.rmtree(self.ref_check_test_run_folder, ignore_errors=True)
+        os.makedirs(self.ref_check_test_run_folder)
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.ref_check_test_run_folder, ignore_errors=True)
+
+    def test_memory_mapped_fasta(self):
+        # Same sequence with lines of 10 lower case bases
+        fasta_file = os.path.join(self.ref_check_test_run_folder, 'reference.fa')
+        with open(fasta_file, 'w') as open_file:
+            open_file.write('>chr1 description\nacgtacgtac\ngtACGTACGT\nNNN\n>chr2\nTTTT\n')
+        with MemoryMappedFasta(fasta_file) as reference:
+            self.assertEqual(['chr1', 'chr2'], reference.contig_names)
+            self.assertEqual('ACGTACGTACGTACGTACGTNNN', reference.get_sequence('chr1', 1, 23))
+            self.assertEqual('CGTA', reference.get_sequence('chr1', 10, 13))
+            self.assertEqual('TTTT', reference.get_sequence('chr2', 1, 4))
+        # Reading the FASTA does not write an index next to it
+        self.assertFalse(os.path.exists(fasta_file + '.fai'))
+
+    def test_read_assembly_report_aliases(self):
+        aliases = read_assembly_report_aliases(self.assembly_report, {'MN908947.3'})
+        self.assertEqual('MN908947.3', aliases['MN908947.3'])
+        self.assertEqual('MN908947.3', aliases['NC_045512.2'])
+
+    def test_check_files(self):
+        vcf_files = [f'{self.vcf_files_folder}/file1.vcf', f'{self.vcf_files_folder}/file2.vcf',
+                     f'{self.vcf_files_folder}/file_that_will_fail_asm_check.vcf.gz']
+        with ReferenceAlleleChecker(self.fasta_file, self.assembly_report) as checker:
+            results = checker.check_files(vcf_files)
+        self.assertEqual(vcf_files, [result.vcf_file for result in results])
+        self.assertEqual([(15, 15), (22, 22), (15, 12)],
+                         [(result.num_records, result.num_matches) for result in results])
+        self.assertEqual([True, True, False], [result.passed for result in results])
+        self.assertEqual(80, results[2].match_percentage)
+
+    def test_check_files_undecidable(self):
+        vcf_file = os.path.join(self.ref_check_test_run_folder, 'unknown_contig.vcf')
+        with open(vcf_file, 'w') as open_file:
+            open_file.write('##fileformat=VCFv4.1\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n'
+                            'chrUn\t100\t.\tA\tT\t.\tPASS\t.\n')
+        with ReferenceAlleleChecker(self.fasta_file, self.assembly_report) as checker:
+            results = checker.check_files(glob.glob(f'{self.vcf_files_folder}/file1.vcf') + [vcf_file])
+        self.assertTrue(results[0].passed)
+        self.assertFalse(results[1].passed)
+        self.assertIn('chrUn', results[1].undecidable_reason)
@@ -1,8 +1,10 @@
+import json
 import os
 import shutil
 import subprocess
 
-from covid19dp_submission.steps.run_asm_checker import run_asm_checker, should_skip_asm_check
+from covid19dp_submission.steps.run_asm_checker import run_asm_checker, should_skip_asm_check, \
+    get_asm_check_result_file
 from covid19dp_submission import ROOT_DIR
 from ebi_eva_common_pyutils.command_utils import run_command_with_output
 from unittest import TestCase
@@ -57,3 +59,45 @@ class TestRunAsmChecker(TestCase):
             f'{os.path.basename(file_that_should_generate_error)}.assembly_check.log',
             return_process_output=True).strip()
         self.assertEqual("80%", asm_check_percentage_match)
+
+    def test_asm_check_batch_with_empty_file(self):
+        vcf_files = [f"{self.vcf_files_folder}/file_with_no_variants_only_headers.vcf.gz",
+                     f"{self.vcf_files_folder}/file_that_will_fail_asm_check.vcf.gz",
+                     f"{self.vcf_files_folder}/file1.vcf", f"{self.vcf_files_folder}/file2.vcf"]
+        # The empty file does not stop the other files from being checked
+        with self.assertRaises(subprocess.CalledProcessError):
+            run_asm_checker(vcf_files=vcf_files, assembly_checker_binary="vcf_assembly_checker_linux",
+                            assembly_report=self.assembly_report_url, assembly_fasta=self.fasta_file,
+                            output_dir=self.asm_check_test_run_folder, num_workers=3)
+        statuses = []
+        for vcf_file in vcf_files:
+            with open(get_asm_check_result_file(vcf_file, self.asm_check_test_run_folder)) as open_file:
+                statuses.append(json.load(open_file)['status'])
+        self.assertEqual(['skipped', 'failed', 'passed', 'passed'], statuses)
+
+    def test_asm_check_in_process(self):
+        vcf_files = [f"{self.vcf_files_folder}/file1.vcf", f"{self.vcf_files_folder}/file2.vcf"]
+        # Files whose REF alleles all match the reference do not need the assembly checker binary
+        results = run_asm_checker(vcf_files=vcf_files, assembly_checker_binary="binary_that_does_not_exist",
+                                  assembly_report=self.assembly_report_url, assembly_fasta=self.fasta_file,
+                                  output_dir=self.asm_check_test_run_folder)
+        self.assertEqual(['in-process', 'in-process'], [result['checker'] for result in results])
+        with open(f"{self.asm_check_test_run_folder}/file1.vcf.assembly_check.log") as open_file:
+            self.assertIn("15 out of 15 variants match the reference (100%)", open_file.read())
+
+    def test_asm_check_with_cache(self):
+        cache_dir = os.path.join(self.asm_check_test_run_folder, 'cache')
+        vcf_files = [f"{self.vcf_files_folder}/file1.vcf", f"{self.vcf_files_folder}/file2.vcf"]
+        run_asm_checker(vcf_files=vcf_files, assembly_checker_binary="vcf_assembly_checker_linux",
+                        assembly_report=self.assembly_report_url, assembly_fasta=self.fasta_file,
+                        output_dir=self.asm_check_test_run_folder, cache_dir=cache_dir)
+        results = run_asm_checker(vcf_files=vcf_files + [f"{self.vcf_files_folder}/file3.vcf"],
+                                  assembly_checker_binary="vcf_assembly_checker_linux",
+                                  assembly_report=self.assembly_report_url, assembly_fasta=self.fasta_file,
+                                  output_dir=self.asm_check_test_run_folder, cache_dir=cache_dir)
+        self.assertEqual(['cache', 'cache', 'in-process'], [result['checker'] for result in results])
+        with open(get_asm_check_result_file(vcf_files[0], self.asm_check_test_run_folder)) as open_file:
+            self.assertEqual('passed', json.load(open_file)['status'])
+        # The summaries used for the cache keys are not written next to the input files
+        self.assertFalse([file_name for file_name in os.listdir(self.vcf_files_folder)
+                          if file_name.endswith('.summary.json')])
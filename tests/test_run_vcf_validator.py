@@ -1,8 +1,9 @@
 import glob
+import json
 import os
 import shutil
 
-from covid19dp_submission.steps.run_vcf_validator import run_vcf_validation
+from covid19dp_submission.steps.run_vcf_validator import run_vcf_validation, get_validation_summary_file
 from covid19dp_submission import ROOT_DIR
 from unittest import TestCase
 
@@ -11,6 +12,7 @@ class TestRunVcfValidator(TestCase):
     resources_folder = os.path.join(ROOT_DIR, 'tests', 'resources')
     vcf_files_folder = os.path.join(resources_folder, 'vcf_files')
     validator_test_run_folder = os.path.join(resources_folder, 'validator_run')
+    cache_dir = os.path.join(validator_test_run_folder, 'cache')
 
     def setUp(self) -> None:
         shutil.rmtree(self.validator_test_run_folder, ignore_errors=True)
@@ -29,3 +31,33 @@ class TestRunVcfValidator(TestCase):
             run_vcf_validation(vcf_files=[f"{self.vcf_files_folder}/file_with_errors.vcf.gz"],
                                output_dir=self.validator_test_run_folder, validator_binary="vcf_validator_linux")
         self.assertEqual(exit_exception.exception.args[0], "FAIL: Unacceptable VCF validation errors found.")
+
+    def test_parallel_vcf_validation(self):
+        vcf_files = [f"{self.vcf_files_folder}/file{i}.vcf" for i in range(1, 6)] + \
+                    [f"{self.vcf_files_folder}/file_with_errors.vcf.gz"]
+        with self.assertRaises(SystemExit):
+            run_vcf_validation(vcf_files=vcf_files, output_dir=self.validator_test_run_folder,
+                               validator_binary="vcf_validator_linux", num_workers=4)
+        # Each file has its own reports and the scratch directories are removed
+        for vcf_file in vcf_files:
+            self.assertEqual(2, len(glob.glob(f"{self.validator_test_run_folder}/{os.path.basename(vcf_file)}"
+                                              f".errors.*.*")))
+        self.assertFalse(os.listdir(os.path.join(self.validator_test_run_folder, '.scratch')))
+        with open(get_validation_summary_file(vcf_files, self.validator_test_run_folder)) as open_file:
+            summary = json.load(open_file)
+        self.assertEqual(6, summary['num_files'])
+        self.assertEqual(1, summary['num_files_with_unacceptable_errors'])
+        failed_files = [result['vcf_file'] for result in summary['files'] if result['unacceptable_errors']]
+        self.assertEqual([f"{self.vcf_files_folder}/file_with_errors.vcf.gz"], failed_files)
+
+    def test_vcf_validation_with_cache(self):
+        vcf_files = [f"{self.vcf_files_folder}/file1.vcf", f"{self.vcf_files_folder}/file_with_errors.vcf.gz"]
+        for _ in range(2):
+            with self.assertRaises(SystemExit):
+                run_vcf_validation(vcf_files=vcf_files, output_dir=self.validator_test_run_folder,
+                                   validator_binary="vcf_validator_linux", cache_dir=self.cache_dir)
+            with open(get_validation_summary_file(vcf_files, self.validator_test_run_folder)) as open_file:
+                summary = json.load(open_file)
+        # Only the file without unacceptable errors is taken from the cache the second time
+        self.assertEqual([True, False], [result.get('cached', False) for result in summary['files']])
+        self.assertEqual(1, summary['num_files_with_unacceptable_errors'])
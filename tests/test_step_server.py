@@ -0,0 +1,91 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from unittest import TestCase
+
+from covid19dp_submission import ROOT_DIR
+
+CLIENT_PATH = os.path.join(ROOT_DIR, 'covid19dp_submission')
+TEST_STEP = '''import os
+import sys
+
+print(f"{os.getppid()} {os.getcwd()} {os.environ.get('TEST_STEP_VALUE')} {' '.join(sys.argv[1:])}")
+print("error output", file=sys.stderr)
+sys.exit(int(sys.argv[1]))
+'''
+
+
+class TestStepServer(TestCase):
+    resources_folder = os.path.join(ROOT_DIR, 'tests', 'resources')
+    processing_dir = os.path.join(resources_folder, 'step_server_run')
+    script_path = os.path.join(processing_dir, 'scripts')
+
+    def setUp(self) -> None:
+        shutil.rmtree(self.processing_dir, ignore_errors=True)
+        os.makedirs(os.path.join(self.script_path, 'steps'))
+        open(os.path.join(self.script_path, 'steps', '__init__.py'), 'w').close()
+        with open(os.path.join(self.script_path, 'steps', 'test_step.py'), 'w') as open_file:
+            open_file.write(TEST_STEP)
+        # Unix socket paths are limited to about 100 characters
+        self.socket_dir = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.socket_dir, 'steps.sock')
+        self.server = None
+
+    def tearDown(self) -> None:
+        if self.server:
+            self.server.terminate()
+            self.server.wait()
+        shutil.rmtree(self.processing_dir, ignore_errors=True)
+        shutil.rmtree(self.socket_dir, ignore_errors=True)
+
+    def start_server(self):
+        self.server = subprocess.Popen([sys.executable, '-m', 'covid19dp_submission.step_server',
+                                        '--socket', self.socket_path, '--script-path', self.script_path,
+                                        '--max-workers', '2'], cwd=ROOT_DIR)
+        for _ in range(100):
+            if os.path.exists(self.socket_path):
+                return
+            time.sleep(0.1)
+        self.fail('The step server did not start')
+
+    def run_client(self, exit_code, use_server):
+        env = {**os.environ, 'PYTHONPATH': os.pathsep.join([self.script_path, CLIENT_PATH]),
+               'TEST_STEP_VALUE': 'value'}
+        if use_server:
+            env['STEP_SERVER_SOCKET'] = self.socket_path
+        output_file = os.path.join(self.processing_dir, 'step.log')
+        with open(output_file, 'w') as open_file:
+            process = subprocess.run([sys.executable, '-m', 'step_client', 'steps.test_step', str(exit_code), 'arg'],
+                                     stdout=open_file, stderr=subprocess.STDOUT, env=env, cwd=self.processing_dir)
+        with open(output_file) as open_file:
+            return process.returncode, open_file.read().splitlines()
+
+    def test_run_on_server(self):
+        self.start_server()
+        for exit_code in (0, 3):
+            returncode, output = self.run_client(exit_code, use_server=True)
+            self.assertEqual(exit_code, returncode)
+            # The step ran in a process forked by the server, with the directory, environment and output of the client
+            self.assertEqual([f'{self.server.pid} {self.processing_dir} value {exit_code} arg', 'error output'],
+                             output)
+
+    def test_fall_back_without_server(self):
+        returncode, output = self.run_client(3, use_server=True)
+        self.assertEqual(3, returncode)
+        parent_pid, cwd, value, args = output[0].split(' ', 3)
+        self.assertEqual([self.processing_dir, 'value', '3 arg'], [cwd, value, args])
+        self.assertEqual('error output', output[1])
+
+    def test_deferred_dependencies_preloaded(self):
+        # The steps only import these when they use them, the forked processes should still start with them imported
+        preload_script = ('import sys\n'
+                          'from covid19dp_submission.lazy_imports import DEFERRED_MODULES\n'
+                          'from covid19dp_submission.step_server import preload_step_modules\n'
+                          f'preload_step_modules({CLIENT_PATH!r})\n'
+                          'print(" ".join(module for module in DEFERRED_MODULES if module not in sys.modules))\n')
+        process = subprocess.run([sys.executable, '-c', preload_script], stdout=subprocess.PIPE, cwd=ROOT_DIR,
+                                 universal_newlines=True, check=True)
+        self.assertEqual('', process.stdout.strip())
@@ -0,0 +1,35 @@
+import os
+from unittest import TestCase
+
+import covid19dp_submission
+from benchmarks.benchmark_step_startup import FORBIDDEN_PACKAGES, SCRIPT_PATH, get_imported_packages, \
+    get_step_modules, run_with_import_time
+
+# Far above the import time of any step, only meant to catch an import of a whole new stack
+MAX_IMPORT_MS = 1000
+
+
+class TestStepStartup(TestCase):
+
+    def test_steps_do_not_import_heavy_packages(self):
+        step_modules = get_step_modules()
+        self.assertIn('steps.preprocess_vcfs', step_modules)
+        for step_module in step_modules:
+            with self.subTest(step_module=step_module):
+                returncode, import_times = run_with_import_time(['-c', f'import {step_module}'])
+                self.assertEqual(0, returncode)
+                imported_packages = get_imported_packages(import_times)
+                self.assertEqual(set(), set(imported_packages).intersection(FORBIDDEN_PACKAGES))
+                self.assertLess(import_times[step_module] / 1000, MAX_IMPORT_MS)
+
+    def test_arguments_parsed_before_logging_setup(self):
+        # A step called with wrong arguments exits before importing the logging of ebi_eva_common_pyutils
+        returncode, import_times = run_with_import_time(['-m', 'steps.run_vcf_validator', '--unknown-argument'])
+        self.assertEqual(2, returncode)
+        self.assertNotIn('ebi_eva_common_pyutils.logger', import_times)
+
+    def test_version_read_when_asked_for(self):
+        with open(os.path.join(SCRIPT_PATH, 'VERSION')) as open_file:
+            self.assertEqual(open_file.read().strip(), covid19dp_submission.__version__)
+        with self.assertRaises(AttributeError):
+            covid19dp_submission.__author__
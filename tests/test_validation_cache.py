@@ -0,0 +1,58 @@
+import os
+import shutil
+import time
+from unittest import TestCase
+
+from covid19dp_submission import ROOT_DIR
+from covid19dp_submission.validation_cache import ValidationCache
+
+
+class TestValidationCache(TestCase):
+    resources_folder = os.path.join(ROOT_DIR, 'tests', 'resources')
+    vcf_files_folder = os.path.join(resources_folder, 'vcf_files')
+    cache_test_run_folder = os.path.join(resources_folder, 'validation_cache_run')
+    cache_dir = os.path.join(cache_test_run_folder, 'cache')
+    fasta_file = os.path.join(resources_folder, 'GCA_009858895.3_ASM985889v3_genomic.fna')
+    assembly_report = os.path.join(resources_folder, 'GCA_009858895.3_ASM985889v3_assembly_report.txt')
+
+    def setUp(self) -> None:
+        shutil.rmtree(self.cache_test_run_folder, ignore_errors=True)
+        os.makedirs(self.cache_test_run_folder)
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.cache_test_run_folder, ignore_errors=True)
+
+    def test_key(self):
+        cache = ValidationCache(self.cache_dir)
+        vcf_file = os.path.join(self.vcf_files_folder, 'file1.vcf')
+        renamed_vcf_file = os.path.join(self.cache_test_run_folder, 'renamed.vcf')
+        shutil.copy(vcf_file, renamed_vcf_file)
+        key = cache.get_key(vcf_file, 'vcf_validation', 'ls')
+        # The key only depends on the content of the file, the check, the tool and the assembly
+        self.assertEqual(key, cache.get_key(renamed_vcf_file, 'vcf_validation', 'ls'))
+        self.assertNotEqual(key, cache.get_key(os.path.join(self.vcf_files_folder, 'file2.vcf'),
+                                               'vcf_validation', 'ls'))
+        self.assertNotEqual(key, cache.get_key(vcf_file, 'assembly_check', 'ls'))
+        self.assertNotEqual(key, cache.get_key(vcf_file, 'vcf_validation', 'cat'))
+        self.assertNotEqual(key, cache.get_key(vcf_file, 'vcf_validation', 'ls',
+                                               (self.fasta_file, self.assembly_report)))
+
+    def test_get_and_put(self):
+        cache = ValidationCache(self.cache_dir)
+        self.assertIsNone(cache.get('a' * 64))
+        cache.put('a' * 64, {'status': 'passed'})
+        self.assertEqual({'status': 'passed'}, cache.get('a' * 64))
+        self.assertEqual((1, 1), (cache.hits, cache.misses))
+
+    def test_evict_least_recently_used(self):
+        cache = ValidationCache(self.cache_dir)
+        for key in ('a' * 64, 'b' * 64, 'c' * 64):
+            cache.put(key, {'status': 'passed', 'padding': 'x' * 100})
+            time.sleep(0.01)
+        # Reading the first entry makes the second one the least recently used
+        cache.get('a' * 64)
+        cache.max_size_bytes = 2.5 * os.path.getsize(cache._get_entry_file('a' * 64))
+        self.assertEqual(1, cache.evict())
+        self.assertIsNone(cache.get('b' * 64))
+        self.assertIsNotNone(cache.get('a' * 64))
+        self.assertIsNotNone(cache.get('c' * 64))
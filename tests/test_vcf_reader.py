@@ -0,0 +1,70 @@
+import gzip
+import os
+import shutil
+from unittest import TestCase
+
+from covid19dp_submission import ROOT_DIR
+from covid19dp_submission.bgzf import BgzfWriter, is_bgzf, MAX_BLOCK_DATA_SIZE
+from covid19dp_submission.vcf_reader import count_records, iter_decompressed_chunks, iter_data_lines, DistinctLoci
+
+
+class TestVcfReader(TestCase):
+    resources_folder = os.path.join(ROOT_DIR, 'tests', 'resources')
+    vcf_files_folder = os.path.join(resources_folder, 'vcf_files')
+    vcf_reader_folder = os.path.join(resources_folder, 'vcf_reader')
+
+    def setUp(self) -> None:
+        shutil.rmtree(self.vcf_reader_folder, ignore_errors=True)
+        os.makedirs(self.vcf_reader_folder)
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.vcf_reader_folder, ignore_errors=True)
+
+    def test_count_records(self):
+        # Plain, gzip and BGZF files
+        assert count_records(os.path.join(self.vcf_files_folder, 'file1.vcf')) == 15
+        assert count_records(os.path.join(self.vcf_files_folder, 'file_with_errors.vcf.gz')) == 15
+        assert count_records(os.path.join(self.vcf_files_folder, 'file_with_unnormalised_variants.vcf.gz')) == 1
+        assert count_records(os.path.join(self.vcf_files_folder, 'file_with_no_variants_only_headers.vcf.gz')) == 0
+
+    def test_count_records_in_multiple_bgzf_blocks(self):
+        header = b'##fileformat=VCFv4.1\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n'
+        records = [f'MN908947.3\t{pos}\t.\tA\tG\t.\t.\t.\n'.encode() for pos in range(1, 20001)]
+        content = header + b''.join(records)
+        bgzf_file = os.path.join(self.vcf_reader_folder, 'multiple_blocks.vcf.gz')
+        with BgzfWriter(bgzf_file) as writer:
+            writer.write(content)
+        assert is_bgzf(bgzf_file)
+        assert len(content) > 8 * MAX_BLOCK_DATA_SIZE
+        # BGZF files are valid gzip files
+        with gzip.open(bgzf_file) as open_file:
+            assert open_file.read() == content
+        for num_threads in (1, 4):
+            assert b''.join(iter_decompressed_chunks(bgzf_file, num_threads)) == content
+            assert count_records(bgzf_file, num_threads) == 20000
+
+    def test_count_records_across_chunk_boundaries(self):
+        bgzf_file = os.path.join(self.vcf_reader_folder, 'boundaries.vcf.gz')
+        with BgzfWriter(bgzf_file) as writer:
+            for line in (b'##fileformat=VCFv4.1\n', b'#CHROM\tPOS\n', b'chr1\t1\n'):
+                writer.write(line)
+                # Force a block boundary after each line
+                writer.flush()
+            writer.write(b'chr1\t')
+            writer.flush()
+            writer.write(b'2\n#comment\nchr1\t3')
+        assert count_records(bgzf_file, num_threads=2) == 3
+        assert list(iter_data_lines(bgzf_file, num_threads=2)) == [b'chr1\t1', b'chr1\t2', b'chr1\t3']
+
+    def test_distinct_loci(self):
+        loci = DistinctLoci()
+        loci.add_vcf(os.path.join(self.vcf_files_folder, 'file1.vcf'))
+        loci.add_vcf(os.path.join(self.vcf_files_folder, 'file1.vcf'))
+        assert loci.num_records == 30
+        assert len(loci) == 15
+        other_loci = DistinctLoci()
+        other_loci.add(b'chr2', 10, b'A', b'T')
+        for chrom, pos, ref, alt in list(loci)[1:]:
+            other_loci.add(chrom.encode(), pos, ref.encode(), alt.encode())
+        assert list(loci.difference(other_loci)) == [next(iter(loci))]
+        assert list(other_loci.difference(loci)) == [('chr2', 10, 'A', 'T')]
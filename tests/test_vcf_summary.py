@@ -0,0 +1,73 @@
+import json
+import os
+import shutil
+import time
+from unittest import TestCase
+from unittest.mock import patch
+
+from covid19dp_submission import ROOT_DIR
+from covid19dp_submission.bgzf import BgzfWriter
+from covid19dp_submission.vcf_summary import get_summary_file, get_vcf_summary, read_vcf_summary, summarise_vcf, \
+    write_vcf_summary
+
+
+class TestVcfSummary(TestCase):
+    resources_folder = os.path.join(ROOT_DIR, 'tests', 'resources')
+    vcf_files_folder = os.path.join(resources_folder, 'vcf_files')
+    summary_folder = os.path.join(resources_folder, 'vcf_summary')
+
+    def setUp(self) -> None:
+        shutil.rmtree(self.summary_folder, ignore_errors=True)
+        os.makedirs(self.summary_folder)
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.summary_folder, ignore_errors=True)
+
+    def test_summarise_vcf(self):
+        vcf_file = os.path.join(self.summary_folder, 'file.vcf.gz')
+        with BgzfWriter(vcf_file) as writer:
+            writer.write(b'##fileformat=VCFv4.1\n#CHROM\tPOS\tID\tREF\tALT\n'
+                         b'chr1\t10\t.\tA\tG\nchr1\t10\t.\tA\tG\nchr1\t12\t.\tC\tT\n'
+                         b'chr2\t5\t.\tA\tC\nchr1\t8\t.\tG\tA\n')
+        summary = summarise_vcf(vcf_file)
+        assert summary['record_count'] == 5
+        assert summary['distinct_loci'] == 4
+        assert (summary['min_pos'], summary['max_pos']) == (5, 12)
+        assert summary['contigs'] == ['chr1', 'chr2']
+        # chr1 appears again after chr2
+        assert summary['is_sorted'] is False
+        assert summary['file_size'] == os.path.getsize(vcf_file)
+
+        sorted_file = os.path.join(self.summary_folder, 'file1.vcf')
+        shutil.copy(os.path.join(self.vcf_files_folder, 'file1.vcf'), sorted_file)
+        summary = summarise_vcf(sorted_file)
+        assert summary['record_count'] == 15
+        assert summary['is_sorted'] is True
+        # Same content compressed or not gives the same hash
+        with open(sorted_file, 'rb') as open_file, BgzfWriter(sorted_file + '.gz') as writer:
+            writer.write(open_file.read())
+        assert summarise_vcf(sorted_file + '.gz')['content_md5'] == summary['content_md5']
+
+    def test_get_vcf_summary_uses_sidecar(self):
+        vcf_file = os.path.join(self.summary_folder, 'file1.vcf')
+        shutil.copy(os.path.join(self.vcf_files_folder, 'file1.vcf'), vcf_file)
+        assert read_vcf_summary(vcf_file) is None
+        # Without a sidecar, the summary is computed but not written
+        summary = get_vcf_summary(vcf_file)
+        assert not os.path.exists(get_summary_file(vcf_file))
+        assert write_vcf_summary(vcf_file) == summary
+        with open(get_summary_file(vcf_file)) as open_file:
+            assert json.load(open_file) == summary
+        with patch('covid19dp_submission.vcf_summary.summarise_vcf') as mock_summarise:
+            assert get_vcf_summary(vcf_file) == summary
+            mock_summarise.assert_not_called()
+        # A symbolic link to the file uses the same summary
+        os.symlink(vcf_file, os.path.join(self.summary_folder, 'link.vcf'))
+        assert read_vcf_summary(os.path.join(self.summary_folder, 'link.vcf')) == summary
+
+        # Changing the file invalidates the summary
+        time.sleep(0.01)
+        with open(vcf_file, 'a') as open_file:
+            open_file.write('MN908947.3\t29000\t.\tA\tG\t.\t.\t.\tGT\t1\n')
+        assert read_vcf_summary(vcf_file) is None
+        assert get_vcf_summary(vcf_file)['record_count'] == 16
@@ -1,4 +1,5 @@
 import glob
+import gzip
 import os
 import shutil
 from unittest import TestCase
@@ -8,7 +9,8 @@ from ebi_eva_common_pyutils.command_utils import run_command_with_output
 from covid19dp_submission import ROOT_DIR
 from covid19dp_submission.steps.bgzip_and_index_vcf import bgzip_and_index
 from covid19dp_submission.steps.vcf_vertical_concat.run_vcf_vertical_concat_pipeline \
-    import run_vcf_vertical_concat_pipeline, get_output_vcf_file_name
+    import run_vcf_vertical_concat_pipeline, get_output_vcf_file_name, validate_vertical_concat, \
+    get_concat_result_file_name
 
 
 class TestVCFVerticalConcat(TestCase):
@@ -70,3 +72,105 @@ class TestVCFVerticalConcat(TestCase):
                                         return_process_output=True)
         self.assertEqual("", diffs.strip())
 
+    # Tests require bcftools installed locally and in PATH
+    def test_concat_dynamic_scheduler(self):
+        download_target_dir = self.download_test_files()
+        for vcf_file in glob.glob(f"{download_target_dir}/*.vcf"):
+            bgzip_and_index(vcf_file, vcf_file + '.gz',  "bcftools")
+        run_vcf_vertical_concat_pipeline(toplevel_vcf_dir=download_target_dir,
+                                         concat_processing_dir=self.processing_dir,
+                                         concat_chunk_size=2, bcftools_binary="bcftools",
+                                         nextflow_binary="nextflow", nextflow_config_file=None, resume=False,
+                                         scheduler='dynamic', num_workers=2)
+        # The result is where the following steps expect it whatever the shape of the tree
+        output_vcf_from_dynamic_concat = get_concat_result_file_name(self.processing_dir, 5, 2)
+        input_vcfs = sorted(glob.glob(f"{download_target_dir}/*.vcf.gz"))
+        output_vcf_from_single_stage_concat = f"{self.processing_dir}/single_stage_concat_result.vcf.gz"
+        run_command_with_output("Concatenate VCFs with single stage...", f"bcftools concat {' '.join(input_vcfs)} "
+                                                                         f"--allow-overlaps --remove-duplicates "
+                                                                         f"-O z "
+                                                                         f"-o {output_vcf_from_single_stage_concat}"
+                                )
+        diffs = run_command_with_output("Compare outputs from single stage and dynamic concat processes...",
+                                        f'bash -c "diff '
+                                        f'<(zcat {output_vcf_from_single_stage_concat} | grep -v ^#) '
+                                        f'<(zcat {output_vcf_from_dynamic_concat} | grep -v ^#)"',
+                                        return_process_output=True)
+        self.assertEqual("", diffs.strip())
+
+    # Tests require bcftools installed locally and in PATH
+    def test_concat_local_executor(self):
+        download_target_dir = self.download_test_files()
+        for vcf_file in glob.glob(f"{download_target_dir}/*.vcf"):
+            bgzip_and_index(vcf_file, vcf_file + '.gz',  "bcftools")
+        run_vcf_vertical_concat_pipeline(toplevel_vcf_dir=download_target_dir,
+                                         concat_processing_dir=self.processing_dir,
+                                         concat_chunk_size=2, bcftools_binary="bcftools",
+                                         nextflow_binary="nextflow", nextflow_config_file=None, resume=False,
+                                         num_workers=2, executor='local')
+        # Same stages as the Nextflow pipeline
+        stage_dirs = glob.glob(f"{self.processing_dir}/vertical_concat/stage*")
+        self.assertEqual(3, len(stage_dirs))
+        output_vcf_from_local_concat = get_concat_result_file_name(self.processing_dir, 5, 2)
+        result_mtime = os.path.getmtime(output_vcf_from_local_concat)
+        # Nothing is run again when resuming a completed concatenation
+        run_vcf_vertical_concat_pipeline(toplevel_vcf_dir=download_target_dir,
+                                         concat_processing_dir=self.processing_dir,
+                                         concat_chunk_size=2, bcftools_binary="bcftools",
+                                         nextflow_binary="nextflow", nextflow_config_file=None, resume=True,
+                                         num_workers=2, executor='local')
+        self.assertEqual(result_mtime, os.path.getmtime(output_vcf_from_local_concat))
+
+    # Tests require bcftools installed locally and in PATH
+    def test_concat_native_engine(self):
+        download_target_dir = self.download_test_files()
+        for vcf_file in glob.glob(f"{download_target_dir}/*.vcf"):
+            bgzip_and_index(vcf_file, vcf_file + '.gz',  "bcftools")
+        run_vcf_vertical_concat_pipeline(toplevel_vcf_dir=download_target_dir,
+                                         concat_processing_dir=self.processing_dir,
+                                         concat_chunk_size=2, bcftools_binary="bcftools",
+                                         nextflow_binary="nextflow", nextflow_config_file=None, resume=False,
+                                         engine='native')
+        output_vcf_from_native_concat = get_concat_result_file_name(self.processing_dir, 5, 2)
+        self.assertTrue(os.path.exists(output_vcf_from_native_concat + '.csi'))
+        input_vcfs = sorted(glob.glob(f"{download_target_dir}/*.vcf.gz"))
+        output_vcf_from_single_stage_concat = f"{self.processing_dir}/single_stage_concat_result.vcf.gz"
+        run_command_with_output("Concatenate VCFs with single stage...", f"bcftools concat {' '.join(input_vcfs)} "
+                                                                         f"--allow-overlaps --remove-duplicates "
+                                                                         f"-O z "
+                                                                         f"-o {output_vcf_from_single_stage_concat}"
+                                )
+        diffs = run_command_with_output("Compare outputs from bcftools and native concat processes...",
+                                        f'bash -c "diff '
+                                        f'<(zcat {output_vcf_from_single_stage_concat} | grep -v ^#) '
+                                        f'<(zcat {output_vcf_from_native_concat} | grep -v ^#)"',
+                                        return_process_output=True)
+        self.assertEqual("", diffs.strip())
+
+    def test_validate_vertical_concat(self):
+        download_target_dir = self.download_test_files()
+        input_records = set()
+        for i in range(1, 6):
+            vcf_file = os.path.join(download_target_dir, f'file{i}.vcf')
+            with open(vcf_file, 'rb') as open_file, gzip.open(vcf_file + '.gz', 'wb') as open_gzip_file:
+                content = open_file.read()
+                open_gzip_file.write(content)
+            input_records.update(line for line in content.split(b'\n') if line and not line.startswith(b'#'))
+        # Keep a single record per locus like bcftools concat --remove-duplicates
+        records_per_locus = {tuple(record.split(b'\t')[i] for i in (0, 1, 3, 4)): record
+                             for record in sorted(input_records)}
+        os.makedirs(self.processing_dir)
+        concat_vcf_file = os.path.join(self.processing_dir, 'concat.vcf.gz')
+        with gzip.open(concat_vcf_file, 'wb') as open_file:
+            open_file.write(b'##fileformat=VCFv4.1\n' + b'\n'.join(records_per_locus.values()) + b'\n')
+        self.assertTrue(validate_vertical_concat(download_target_dir, concat_vcf_file))
+
+        missing_locus = sorted(records_per_locus)[3]
+        del records_per_locus[missing_locus]
+        with gzip.open(concat_vcf_file, 'wb') as open_file:
+            open_file.write(b'##fileformat=VCFv4.1\n' + b'\n'.join(records_per_locus.values()) + b'\n')
+        with self.assertLogs('covid19dp_submission.steps.vcf_vertical_concat.run_vcf_vertical_concat_pipeline',
+                             level='ERROR') as logs:
+            self.assertFalse(validate_vertical_concat(download_target_dir, concat_vcf_file))
+        chrom, pos, ref, alt = (field.decode() for field in missing_locus)
+        self.assertIn(f"('{chrom}', {pos}, '{ref}', '{alt}')", logs.output[0])